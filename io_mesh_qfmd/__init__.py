@@ -39,20 +39,37 @@ bl_info = {
 # reload everything
 if "bpy" in locals():
     import imp
+    # the shared modules first, so the formats pick up the reloaded names
+    imp.reload(safewrite)
+    imp.reload(quakenorm)
+    imp.reload(capture)
+    imp.reload(cache)
+    imp.reload(workers)
+    imp.reload(exportcache)
+    imp.reload(decimate)
+    imp.reload(atlas)
+    imp.reload(keyframes)
+    imp.reload(batch)
+    imp.reload(progress)
+    imp.reload(vat)
     imp.reload(import_mdl)
     imp.reload(export_mdl)
     imp.reload(import_md2)
     imp.reload(export_md2)
     imp.reload(import_md3)
     imp.reload(export_md3)
+    imp.reload(export_vat)
+    imp.reload(multiexport)
 else:
+	from . import safewrite, quakenorm, capture, cache, workers, exportcache
+	from . import decimate, atlas, keyframes, batch, progress, multiexport
 	from .mdl import import_mdl, export_mdl
 	from .md2 import import_md2, export_md2
-	from .md3 import import_md3, export_md3
+	from .md3 import vat, import_md3, export_md3, export_vat
 
 # MDL
 import bpy
-from bpy.props import StringProperty, EnumProperty, FloatVectorProperty, PointerProperty, BoolProperty
+from bpy.props import StringProperty, EnumProperty, FloatVectorProperty, PointerProperty, BoolProperty, CollectionProperty, IntProperty, FloatProperty
 from bpy_extras.io_utils import ExportHelper, ImportHelper, path_reference_mode, axis_conversion
 
 PALETTE=(
@@ -61,6 +78,12 @@ PALETTE=(
     #('PAL_CUSTOM', "Custom", "Custom palette from file"),
 )
 
+SKIN_STORAGE=(
+    ('PACK', "Pack", "Pack skins into the .blend as PNG immediately"),
+    ('GENERATED', "Generated", "Keep skins as generated images; they are packed when the .blend is saved"),
+    ('CACHE', "Cache Directory", "Write skins once as indexed PNGs to the skin cache directory; they are packed when the .blend is saved"),
+)
+
 SYNCTYPE=(
     ('ST_SYNC', "Syncronized", "Automatic animations are all together"),
     ('ST_RAND', "Random", "Automatic animations have random offsets"),
@@ -111,7 +134,7 @@ class QFMDLSettings(bpy.types.PropertyGroup):
         name="16-bit",
         description="16 bit vertex coordinates: QuakeForge only")
 
-class ImportMDL6(bpy.types.Operator, ImportHelper):
+class ImportMDL6(bpy.types.Operator, ImportHelper, progress.ModalJob):
     '''Load a Quake MDL (v6) File'''
     bl_idname = "import_mesh.quake_mdl_v6"
     bl_label = "Import MDL"
@@ -124,12 +147,37 @@ class ImportMDL6(bpy.types.Operator, ImportHelper):
         items=PALETTE,
         name="Palette",
         description="Palette")
+    cache: BoolProperty(
+        name="Reuse Imported Data",
+        description="Reuse meshes, images and materials already imported "
+                    "from identical data",
+        default=True)
+    skin_storage: EnumProperty(
+        items=SKIN_STORAGE,
+        name="Skin Storage",
+        description="How to store the imported skin images",
+        default='PACK')
+    skin_cache: StringProperty(
+        name="Skin Cache Directory",
+        description="Where to write skins for the Cache Directory storage "
+                    "(default: the user data directory)",
+        subtype='DIR_PATH')
+
+    files: CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN', 'SKIP_SAVE'})
+    directory: StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN', 'SKIP_SAVE'})
 
     def execute(self, context):
-        keywords = self.as_keywords (ignore=("filter_glob",))
-        return import_mdl.import_mdl(self, context, **keywords)
+        keywords = self.as_keywords (ignore=("filter_glob", "files",
+                                             "directory"))
+        keywords["filepaths"] = batch.import_paths(self)
+        return self.run_job(context,
+                            import_mdl.import_mdl(self, context, **keywords))
 
-class ExportMDL6(bpy.types.Operator, ExportHelper):
+class ExportMDL6(bpy.types.Operator, ExportHelper, progress.ModalJob):
     '''Save a Quake MDL (v6) File'''
 
     bl_idname = "export_mesh.quake_mdl_v6"
@@ -166,6 +214,29 @@ class ExportMDL6(bpy.types.Operator, ExportHelper):
     md16: BoolProperty(
         name="16-bit",
         description="16 bit vertex coordinates: QuakeForge only")
+    onseam: BoolProperty(
+        name="Onseam",
+        description="Share the seam vertices of front/back half skin layouts instead of duplicating them",
+        default=False)
+    workers: IntProperty(
+        name="Worker processes",
+        description="Capture the frames in this many background blender processes, leaving this blender's scene untouched (0: in this blender)",
+        default=0, min=0, max=64)
+    use_cache: BoolProperty(
+        name="Frame cache",
+        description="Reuse frames and skins converted by earlier exports when nothing affecting them has changed (stored in the user data directory, up to 512 MB)",
+        default=False)
+    use_atlas: BoolProperty(
+        name="Texture atlas",
+        description="Pack the images of all materials into a single skin",
+        default=False)
+    batch: EnumProperty(
+        items=(('OFF', "Off", "Export the selected objects as one model"),
+               ('OBJECT', "Objects", "Export each selected object to its own file, named after it"),
+               ('COLLECTION', "Collections", "Export the selected objects of each child collection of the active collection to its own file, named after it")),
+        name="Batch",
+        description="Export several models from one sweep of the timeline",
+        default='OFF')
 
     @classmethod
     def poll(cls, context):
@@ -173,8 +244,14 @@ class ExportMDL6(bpy.types.Operator, ExportHelper):
                 and type(context.active_object.data) == bpy.types.Mesh)
 
     def execute(self, context):
-        keywords = self.as_keywords (ignore=("check_existing", "filter_glob"))
-        return export_mdl.export_mdl(self, context, **keywords)
+        keywords = self.as_keywords (ignore=("check_existing", "filter_glob",
+                                             "batch"))
+        if self.batch != 'OFF':
+            job = multiexport.export_batch(self, context, export_mdl.export_mdl,
+                                           self.batch, **keywords)
+        else:
+            job = export_mdl.export_mdl(self, context, **keywords)
+        return self.run_job(context, job)
 
 class OBJECT_PT_MDLPanel(bpy.types.Panel):
     bl_label = "MDL Properties"
@@ -212,7 +289,7 @@ class QFMD2Settings(bpy.types.PropertyGroup):
         description="Auto-apply location/rotation/scale when exporting",
         default=True)
 
-class ImportMD2(bpy.types.Operator, ImportHelper):
+class ImportMD2(bpy.types.Operator, ImportHelper, progress.ModalJob):
     '''Load a Quake II MD2 File'''
     bl_idname = "import_mesh.quake2_md2"
     bl_label = "Import MD2"
@@ -221,11 +298,37 @@ class ImportMD2(bpy.types.Operator, ImportHelper):
     filename_ext = ".md2"
     filter_glob = StringProperty(default="*.md2", options={'HIDDEN'})
 
+    cache: BoolProperty(
+        name="Reuse Imported Data",
+        description="Reuse meshes, images and materials already imported "
+                    "from identical data",
+        default=True)
+    skin_storage: EnumProperty(
+        items=SKIN_STORAGE,
+        name="Skin Storage",
+        description="How to store the imported skin images",
+        default='PACK')
+    skin_cache: StringProperty(
+        name="Skin Cache Directory",
+        description="Where to write skins for the Cache Directory storage "
+                    "(default: the user data directory)",
+        subtype='DIR_PATH')
+
+    files: CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN', 'SKIP_SAVE'})
+    directory: StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN', 'SKIP_SAVE'})
+
     def execute(self, context):
-        keywords = self.as_keywords (ignore=("filter_glob",))
-        return import_md2.import_md2(self, context, **keywords)
+        keywords = self.as_keywords (ignore=("filter_glob", "files",
+                                             "directory"))
+        keywords["filepaths"] = batch.import_paths(self)
+        return self.run_job(context,
+                            import_md2.import_md2(self, context, **keywords))
 
-class ExportMD2(bpy.types.Operator, ExportHelper):
+class ExportMD2(bpy.types.Operator, ExportHelper, progress.ModalJob):
     '''Save a Quake II MD2 File'''
     bl_idname = "export_mesh.quake2_md2"
     bl_label = "Export MD2"
@@ -238,6 +341,33 @@ class ExportMD2(bpy.types.Operator, ExportHelper):
         name="Auto transform",
         description="Auto-apply location/rotation/scale when exporting",
         default=True)
+    workers: IntProperty(
+        name="Worker processes",
+        description="Capture the frames in this many background blender processes, leaving this blender's scene untouched (0: in this blender)",
+        default=0, min=0, max=64)
+    use_cache: BoolProperty(
+        name="Frame cache",
+        description="Reuse frames and skins converted by earlier exports when nothing affecting them has changed (stored in the user data directory, up to 512 MB)",
+        default=False)
+    use_atlas: BoolProperty(
+        name="Texture atlas",
+        description="Pack the images of all materials into a single skin",
+        default=False)
+    use_reduce: BoolProperty(
+        name="Reduce frames",
+        description="Leave out frames the engine can interpolate from their neighbours. Later frames are renumbered; the source frame of each is written to model_frames.txt",
+        default=False)
+    reduce_tolerance: FloatProperty(
+        name="Reduction tolerance",
+        description="How far, in quantization steps, an interpolated frame may be from the captured one",
+        default=1.0, min=0.0, max=16.0)
+    batch: EnumProperty(
+        items=(('OFF', "Off", "Export the selected objects as one model"),
+               ('OBJECT', "Objects", "Export each selected object to its own file, named after it"),
+               ('COLLECTION', "Collections", "Export the selected objects of each child collection of the active collection to its own file, named after it")),
+        name="Batch",
+        description="Export several models from one sweep of the timeline",
+        default='OFF')
 
     @classmethod
     def poll(cls, context):
@@ -245,8 +375,14 @@ class ExportMD2(bpy.types.Operator, ExportHelper):
                 and type(context.active_object.data) == bpy.types.Mesh)
 
     def execute(self, context):
-        keywords = self.as_keywords (ignore=("check_existing", "filter_glob"))
-        return export_md2.export_md2(self, context, **keywords)
+        keywords = self.as_keywords (ignore=("check_existing", "filter_glob",
+                                             "batch"))
+        if self.batch != 'OFF':
+            job = multiexport.export_batch(self, context, export_md2.export_md2,
+                                           self.batch, **keywords)
+        else:
+            job = export_md2.export_md2(self, context, **keywords)
+        return self.run_job(context, job)
 
 class OBJECT_PT_MD2Panel(bpy.types.Panel):
     bl_label = "MD2 Properties"
@@ -277,7 +413,7 @@ class QFMD3Settings(bpy.types.PropertyGroup):
         description="Auto-apply location/rotation/scale when exporting",
         default=True)
 
-class ImportMD3(bpy.types.Operator, ImportHelper):
+class ImportMD3(bpy.types.Operator, ImportHelper, progress.ModalJob):
     '''Load a Quake III MD# File'''
     bl_idname = "import_mesh.quake3_md3"
     bl_label = "Import MD3"
@@ -286,12 +422,38 @@ class ImportMD3(bpy.types.Operator, ImportHelper):
     filename_ext = ".md3"
     filter_glob = StringProperty(default="*.md3", options={'HIDDEN'})
 
+    cache: BoolProperty(
+        name="Reuse Imported Data",
+        description="Reuse meshes, images and materials already imported "
+                    "from identical data",
+        default=True)
+    skin_storage: EnumProperty(
+        items=SKIN_STORAGE,
+        name="Skin Storage",
+        description="How to store the imported skin images",
+        default='PACK')
+    skin_cache: StringProperty(
+        name="Skin Cache Directory",
+        description="Where to write skins for the Cache Directory storage "
+                    "(default: the user data directory)",
+        subtype='DIR_PATH')
+
+    files: CollectionProperty(
+        type=bpy.types.OperatorFileListElement,
+        options={'HIDDEN', 'SKIP_SAVE'})
+    directory: StringProperty(
+        subtype='DIR_PATH',
+        options={'HIDDEN', 'SKIP_SAVE'})
+
     def execute(self, context):
-        keywords = self.as_keywords (ignore=("filter_glob",))
-        return import_md3.import_md3(self, context, **keywords)
+        keywords = self.as_keywords (ignore=("filter_glob", "files",
+                                             "directory"))
+        keywords["filepaths"] = batch.import_paths(self)
+        return self.run_job(context,
+                            import_md3.import_md3(self, context, **keywords))
 
 
-class ExportMD3(bpy.types.Operator, ExportHelper):
+class ExportMD3(bpy.types.Operator, ExportHelper, progress.ModalJob):
     '''Save a Quake III MD3 File'''
     bl_idname = "export_mesh.quake3_md3"
     bl_label = "Export MD3"
@@ -304,6 +466,88 @@ class ExportMD3(bpy.types.Operator, ExportHelper):
         name="Auto transform",
         description="Auto-apply location/rotation/scale when exporting",
         default=True)
+    workers: IntProperty(
+        name="Worker processes",
+        description="Capture the frames in this many background blender processes, leaving this blender's scene untouched (0: in this blender)",
+        default=0, min=0, max=64)
+    use_cache: BoolProperty(
+        name="Frame cache",
+        description="Reuse frames and skins converted by earlier exports when nothing affecting them has changed (stored in the user data directory, up to 512 MB)",
+        default=False)
+    lods: IntProperty(
+        name="Levels of detail",
+        description="Also write this many decimated levels of detail (_1, _2)",
+        default=0, min=0, max=2)
+    lod_ratio: FloatProperty(
+        name="LOD ratio",
+        description="Fraction of the triangles kept by each level of detail",
+        default=0.5, min=0.05, max=0.95)
+    max_verts: IntProperty(
+        name="Surface vertex limit",
+        description="Split surfaces with more vertices than this (quake 3 draws at most 1000 at once)",
+        default=1000, min=3, max=4096)
+    max_tris: IntProperty(
+        name="Surface triangle limit",
+        description="Split surfaces with more triangles than this (quake 3 draws at most 2000 at once)",
+        default=2000, min=1, max=8192)
+    use_reduce: BoolProperty(
+        name="Reduce frames",
+        description="Leave out frames the engine can interpolate from their neighbours. Later frames are renumbered; the source frame of each is written to model_frames.txt",
+        default=False)
+    reduce_tolerance: FloatProperty(
+        name="Reduction tolerance",
+        description="How far, in quantization steps, an interpolated frame may be from the captured one",
+        default=1.0, min=0.0, max=16.0)
+    batch: EnumProperty(
+        items=(('OFF', "Off", "Export the selected objects as one model"),
+               ('OBJECT', "Objects", "Export each selected object to its own file, named after it"),
+               ('COLLECTION', "Collections", "Export the selected objects of each child collection of the active collection to its own file, named after it")),
+        name="Batch",
+        description="Export several models from one sweep of the timeline",
+        default='OFF')
+
+    @classmethod
+    def poll(cls, context):
+        return (context.active_object != None
+                and type(context.active_object.data) == bpy.types.Mesh)
+
+    def execute(self, context):
+        keywords = self.as_keywords (ignore=("check_existing", "filter_glob",
+                                             "batch"))
+        if self.batch != 'OFF':
+            job = multiexport.export_batch(self, context, export_md3.export_md3,
+                                           self.batch, **keywords)
+        else:
+            job = export_md3.export_md3(self, context, **keywords)
+        return self.run_job(context, job)
+
+class ExportVAT(bpy.types.Operator, ExportHelper, progress.ModalJob):
+    '''Save a static MD3 with vertex animation textures'''
+    bl_idname = "export_mesh.quake3_vat"
+    bl_label = "Export MD3 VAT"
+    bl_options = {'PRESET'}
+
+    filename_ext = ".md3"
+    filter_glob = StringProperty(default="*.md3", options={'HIDDEN'})
+
+    xform: BoolProperty(
+        name="Auto transform",
+        description="Auto-apply location/rotation/scale when exporting",
+        default=True)
+    workers: IntProperty(
+        name="Worker processes",
+        description="Capture the frames in this many background blender processes, leaving this blender's scene untouched (0: in this blender)",
+        default=0, min=0, max=64)
+    use_cache: BoolProperty(
+        name="Frame cache",
+        description="Reuse frames and skins converted by earlier exports when nothing affecting them has changed (stored in the user data directory, up to 512 MB)",
+        default=False)
+    vat_format: EnumProperty(
+        items=(('RGBA16F', "RGBA16F", "Half float texels"),
+               ('RGB10A2', "RGB10A2", "10 bits per channel, half the size")),
+        name="Texture format",
+        description="Texel format of the position and normal textures",
+        default='RGBA16F')
 
     @classmethod
     def poll(cls, context):
@@ -312,7 +556,52 @@ class ExportMD3(bpy.types.Operator, ExportHelper):
 
     def execute(self, context):
         keywords = self.as_keywords (ignore=("check_existing", "filter_glob"))
-        return export_md3.export_md3(self, context, **keywords)
+        return self.run_job(context,
+                            export_vat.export_vat(self, context, **keywords))
+
+class ExportQuakeAll(bpy.types.Operator, ExportHelper, progress.ModalJob):
+    '''Save the model as MDL, MD2 and MD3 from one capture of the animation'''
+    bl_idname = "export_mesh.quake_all"
+    bl_label = "Export MDL, MD2 and MD3"
+    bl_options = {'PRESET'}
+
+    filename_ext = ".mdl"
+    filter_glob = StringProperty(default="*.mdl;*.md2;*.md3", options={'HIDDEN'})
+
+    xform: BoolProperty(
+        name="Auto transform",
+        description="Auto-apply location/rotation/scale when exporting",
+        default=True)
+    workers: IntProperty(
+        name="Worker processes",
+        description="Capture the frames in this many background blender processes, leaving this blender's scene untouched (0: in this blender)",
+        default=0, min=0, max=64)
+    use_cache: BoolProperty(
+        name="Frame cache",
+        description="Reuse frames and skins converted by earlier exports when nothing affecting them has changed (stored in the user data directory, up to 512 MB)",
+        default=False)
+    use_mdl: BoolProperty(
+        name="MDL",
+        description="Write a Quake MDL",
+        default=True)
+    use_md2: BoolProperty(
+        name="MD2",
+        description="Write a Quake II MD2",
+        default=True)
+    use_md3: BoolProperty(
+        name="MD3",
+        description="Write a Quake III MD3",
+        default=True)
+
+    @classmethod
+    def poll(cls, context):
+        return (context.active_object != None
+                and type(context.active_object.data) == bpy.types.Mesh)
+
+    def execute(self, context):
+        keywords = self.as_keywords (ignore=("check_existing", "filter_glob"))
+        return self.run_job(context,
+                            multiexport.export_all(self, context, **keywords))
 
 class OBJECT_PT_MD3Panel(bpy.types.Panel):
     bl_label = "MD3 Properties"
@@ -346,6 +635,10 @@ def menu_func_export(self, context):
     self.layout.operator(ExportMDL6.bl_idname, text="Quake MDL (.mdl)")
     self.layout.operator(ExportMD2.bl_idname, text="Quake II MD2 (.md2)")
     self.layout.operator(ExportMD3.bl_idname, text="Quake III MD3 (.md3)")
+    self.layout.operator(ExportVAT.bl_idname,
+                         text="Quake III MD3 + vertex animation textures (.md3)")
+    self.layout.operator(ExportQuakeAll.bl_idname,
+                         text="Quake MDL, MD2 and MD3 (.mdl, .md2, .md3)")
 
 classes = (
     QFMDLSettings,
@@ -361,7 +654,10 @@ classes = (
     QFMD3Settings,
     OBJECT_PT_MD3Panel,
     ImportMD3,
-    ExportMD3
+    ExportMD3,
+    ExportVAT,
+
+    ExportQuakeAll
 )
 
 def register():
@@ -375,6 +671,8 @@ def register():
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.append(menu_func_export)
 
+    bpy.app.handlers.save_pre.append(cache.pack_deferred)
+
 def unregister():
     for cls in classes:
         bpy.utils.unregister_class(cls)
@@ -382,5 +680,7 @@ def unregister():
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
     bpy.types.TOPBAR_MT_file_export.remove(menu_func_export)
 
+    bpy.app.handlers.save_pre.remove(cache.pack_deferred)
+
 if __name__ == "__main__":
     register()
@@ -0,0 +1,150 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Texture atlas for exporting multi-material meshes to single skin formats.
+#
+# The image of every material (the single image texture node of its node
+# tree, as make_skin finds it) is packed into one atlas with shelf packing,
+# tallest first, with each image's edge pixels repeated into a padding
+# border so filtering doesn't bleed between neighbours. Each material slot
+# then gets a transform from its UVs into the atlas, applied to the loops of
+# the faces using it.
+
+import math
+import os
+
+import bpy
+import numpy as np
+
+PADDING = 2     # texels repeated around each image
+ALIGN = 4       # quake wants skin widths that are a multiple of 4
+MAX_HEIGHT = 480    # quake and quake 2 refuse taller skins (MAX_LBM_HEIGHT)
+MAX_WIDTH = 4096
+
+def material_image(mat):
+    if not mat or not mat.use_nodes:
+        return None
+    nodes = [node for node in mat.node_tree.nodes if node.type == 'TEX_IMAGE']
+    if len(nodes) != 1:
+        return None
+    return nodes[0].image
+
+def image_pixels(image):
+    # (height, width, 4), bottom row first as blender stores them
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(image.size[1], image.size[0], 4)
+
+def shelves(sizes, width, padding):
+    # shelf packing, tallest first, into the given width
+    padded = [(w + 2 * padding, h + 2 * padding) for w, h in sizes]
+    order = sorted(range(len(sizes)), key=lambda i: -padded[i][1])
+    pos = [None] * len(sizes)
+    x = y = shelf = 0
+    for i in order:
+        w, h = padded[i]
+        if x + w > width:
+            y += shelf
+            x = shelf = 0
+        pos[i] = (x + padding, y + padding)
+        x += w
+        shelf = max(shelf, h)
+    return pos, y + shelf
+
+def pack(sizes, padding=PADDING, align=ALIGN, max_height=MAX_HEIGHT):
+    # returns the (x, y) of each rectangle and the (width, height) of the
+    # atlas. Starts out square, but widens the atlas while it's too tall.
+    padded = [(w + 2 * padding, h + 2 * padding) for w, h in sizes]
+    area = sum(w * h for w, h in padded)
+    width = max([int(math.ceil(math.sqrt(area)))] + [w for w, h in padded])
+    width = -(-width // align) * align
+    pos, height = shelves(sizes, width, padding)
+    while height > max_height and width < MAX_WIDTH:
+        width += align
+        pos, height = shelves(sizes, width, padding)
+    height = -(-height // align) * align
+    return pos, (width, max(height, align))
+
+class Atlas:
+    def __init__(self, objects):
+        # one image per material slot of every object, None for slots
+        # without one
+        self.slots = [[material_image(slot.material)
+                       for slot in obj.material_slots] for obj in objects]
+        # images without pixels (missing files) are as good as none
+        self.slots = [[image if image and all(image.size) else None
+                       for image in slots] for slots in self.slots]
+        images = []
+        for slots in self.slots:
+            for image in slots:
+                if image and image not in images:
+                    images.append(image)
+        self.images = images
+        sizes = [tuple(image.size) for image in images]
+        self.pos, self.size = pack(sizes)
+        width, height = self.size
+        self.pixels = np.zeros((height, width, 4), dtype=np.float32)
+        self.pixels[..., 3] = 1
+        p = PADDING
+        for image, (x, y) in zip(images, self.pos):
+            w, h = image.size
+            self.pixels[y - p:y + h + p, x - p:x + w + p] = np.pad(
+                image_pixels(image), ((p, p), (p, p), (0, 0)), mode='edge')
+
+    def transforms(self, index):
+        # per material slot of object index: (u offset, v offset, u scale,
+        # v scale) into the atlas. Slots without an image map to the
+        # corner texel.
+        width, height = self.size
+        xforms = np.zeros((max(len(self.slots[index]), 1), 4))
+        for slot, image in enumerate(self.slots[index]):
+            if image:
+                x, y = self.pos[self.images.index(image)]
+                w, h = image.size
+                xforms[slot] = (x / width, y / height, w / width, h / height)
+        return xforms
+
+    def remap(self, index, uv, material):
+        # uv: (loops, 2), material: the material index of each loop. UVs
+        # outside the image can't tile in an atlas, so they're clamped.
+        xforms = self.transforms(index)[np.minimum(material,
+                                                   len(self.slots[index]) - 1)]
+        uv = np.clip(uv, 0, 1)
+        return xforms[:, :2] + uv * xforms[:, 2:]
+
+    def fits(self):
+        width, height = self.size
+        return width <= MAX_WIDTH and height <= MAX_HEIGHT
+
+    def save(self, filepath):
+        # as a png image file, for formats that refer to their skins by
+        # name
+        width, height = self.size
+        name = os.path.basename(filepath)
+        image = bpy.data.images.new(name, width, height, alpha=True)
+        try:
+            image.pixels.foreach_set(self.pixels.ravel())
+            image.filepath_raw = filepath
+            image.file_format = 'PNG'
+            image.save()
+        finally:
+            bpy.data.images.remove(image)
+        return name
@@ -0,0 +1,55 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Pipelined multi-file import.
+#
+# Reading and decoding a model (file I/O, struct parsing and the numpy work
+# done by the importers' decode functions) does not need blender, so it is
+# done in a thread pool. Only the creation of datablocks has to happen on
+# the main thread, and it is done for each model as soon as it has been
+# decoded.
+
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def import_paths(operator):
+    # the file browser's multi-select, or just filepath when run from a script
+    files = getattr(operator, "files", None)
+    if files and files[0].name:
+        return [os.path.join(operator.directory, f.name) for f in files]
+    return [operator.filepath]
+
+def decoded(filepaths, decode, workers=0):
+    # decode must not touch bpy: it runs in the worker threads
+    if len(filepaths) == 1:
+        yield decode(filepaths[0])
+        return
+    if not workers:
+        workers = min(len(filepaths), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(decode, path) for path in filepaths]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # don't bother decoding models that won't be built
+            for future in futures:
+                future.cancel()
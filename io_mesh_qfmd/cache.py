@@ -0,0 +1,179 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Content addressed import cache.
+#
+# Datablocks created by the importers are tagged with a hash of the data
+# they were made from (the model file for meshes, the pixel data for images
+# and materials). Importing the same data again, even from another file,
+# finds the tagged datablock and reuses it instead of decoding everything
+# again. The tags are custom properties, so they are saved with the .blend.
+
+import hashlib
+import os
+import zlib
+from struct import pack
+
+import bpy
+import numpy as np
+
+HASH_PROP = "qfmd_hash"
+PACK_PROP = "qfmd_pack"
+
+def data_hash(*parts):
+    h = hashlib.sha1()
+    for p in parts:
+        if isinstance(p, str):
+            p = p.encode()
+        h.update(p)
+        h.update(b"\0")
+    return h.hexdigest()
+
+def file_hash(filepath, *extra):
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return data_hash(h.hexdigest(), *extra)
+
+def tag(id, key):
+    id[HASH_PROP] = key
+    return id
+
+def find(collection, key):
+    # datablocks without users will be thrown away on save, so don't
+    # resurrect them
+    for id in collection:
+        if id.users and id.get(HASH_PROP) == key:
+            return id
+    return None
+
+def cached_keys(collection):
+    # snapshot for the import threads, which must not touch bpy.data
+    return set(id.get(HASH_PROP) for id in collection if id.users)
+
+def link_mesh(context, name, mesh):
+    obj = bpy.data.objects.new(name, mesh)
+    context.scene.collection.objects.link(obj)
+    obj.select_set(True)
+    context.view_layer.objects.active = obj
+    return obj
+
+def copy_settings(obj, attr):
+    # the add-on's per-object settings (eg, qfmdl) don't live on the mesh,
+    # so take them from another object using the same mesh
+    for other in bpy.data.objects:
+        if other.data == obj.data and other != obj:
+            src = getattr(other, attr)
+            dst = getattr(obj, attr)
+            for prop in src.bl_rna.properties:
+                if prop.identifier == "rna_type" or prop.is_readonly:
+                    continue
+                setattr(dst, prop.identifier, getattr(src, prop.identifier))
+            return
+
+def set_frame_range(context, mesh):
+    # what build_shape_keys would have done
+    context.scene.frame_start = 1
+    context.scene.frame_end = 1
+    if mesh.shape_keys:
+        context.scene.frame_end = max(1, len(mesh.shape_keys.key_blocks) - 1)
+
+# Skin storage.
+#
+# PNG packing every imported skin on the main thread can cost more than
+# decoding the model, so skins can instead be left as generated buffers or
+# written once as indexed PNGs to a cache directory (named by skin hash, so
+# later imports just load them). Either way, packing is deferred until the
+# .blend is saved (see pack_deferred).
+
+def write_indexed_png(path, pixels, width, height, palette):
+    def chunk(type, data):
+        crc = zlib.crc32(type + data) & 0xffffffff
+        return pack(">I", len(data)) + type + data + pack(">I", crc)
+    # every row starts with filter type 0 (none)
+    rows = np.zeros((height, width + 1), dtype=np.uint8)
+    rows[:, 1:] = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width)
+    png = (b"\x89PNG\r\n\x1a\n"
+           + chunk(b"IHDR", pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0))
+           + chunk(b"PLTE", np.asarray(palette, dtype=np.uint8).tobytes())
+           + chunk(b"IDAT", zlib.compress(rows.tobytes(), 1))
+           + chunk(b"IEND", b""))
+    # other imports may be looking for the same file
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(png)
+    os.replace(tmp, path)
+
+def skin_cache_dir(path=""):
+    if not path:
+        path = bpy.utils.user_resource('DATAFILES', path="qfmd_skins",
+                                       create=True)
+    path = bpy.path.abspath(path)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def new_skin(name, key, width, height, pixels, palette,
+             storage='PACK', cache_dir=""):
+    # pixels are palette indices in quake order (top to bottom)
+    if storage == 'CACHE':
+        path = os.path.join(skin_cache_dir(cache_dir), key + ".png")
+        if not os.path.exists(path):
+            write_indexed_png(path, pixels, width, height, palette)
+        img = bpy.data.images.load(path)
+        img.name = name
+        img[PACK_PROP] = True
+    else:
+        pal = np.asarray(palette, dtype=np.float32) / 255.0
+        ind = np.frombuffer(pixels, dtype=np.uint8).reshape(height, width)
+        rgba = np.ones((height, width, 4), dtype=np.float32)
+        # quake textures are top to bottom, but blender images
+        # are bottom to top
+        rgba[..., :3] = pal[ind[::-1]]
+        img = bpy.data.images.new(name, width, height)
+        img.pixels.foreach_set(rgba.ravel())
+        if storage == 'PACK':
+            img.pack()
+        else:
+            img[PACK_PROP] = True
+    img.use_fake_user = True
+    return tag(img, key)
+
+class KeepDeferred:
+    # with KeepDeferred(): saves made inside (eg, the copy given to export
+    # worker processes) leave the deferred skins alone
+    depth = 0
+
+    def __enter__(self):
+        KeepDeferred.depth += 1
+
+    def __exit__(self, *exc):
+        KeepDeferred.depth -= 1
+
+@bpy.app.handlers.persistent
+def pack_deferred(*args):
+    if KeepDeferred.depth:
+        return
+    for img in bpy.data.images:
+        if img.get(PACK_PROP):
+            if not img.packed_file:
+                img.pack()
+            del img[PACK_PROP]
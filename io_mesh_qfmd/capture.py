@@ -0,0 +1,630 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Frame capture for the exporters.
+#
+# Vertex positions and normals are pulled out of the evaluated meshes with
+# foreach_get into float32 buffers that are reused from frame to frame, and
+# the object transform is applied to the whole array at once. The exporters
+# gather the vertices they need out of the buffers (np.take with their vertex
+# maps) into (frames, verts, 3) arrays.
+#
+# The timeline is swept frame-major: the scene is evaluated once per frame
+# and every exported object's mesh is taken from that one depsgraph.
+#
+# Objects animated purely by shape keys (eg, anything imported by this
+# add-on) skip the depsgraph altogether: the key F-curves are evaluated
+# directly and the frame is the weighted sum of the keys. Likewise, meshes
+# deformed only by an armature driven by its action are skinned here (linear
+# blend skinning) from pose matrices computed from the action. An object is
+# only given such a fast path if it matches the depsgraph on a few sample
+# frames, and if no object needs the depsgraph, the timeline isn't stepped
+# at all.
+
+import re
+
+import numpy as np
+
+def normal_matrix(matrix):
+    # normals transform by the inverse transpose
+    return np.array(matrix.to_3x3().inverted_safe().transposed(),
+                    dtype=np.float32)
+
+class VertexCapture:
+    def __init__(self):
+        self.co = np.empty((0, 3), dtype=np.float32)
+        self.no = np.empty((0, 3), dtype=np.float32)
+
+    def buffers(self, n):
+        if len(self.co) < n:
+            self.co = np.empty((n, 3), dtype=np.float32)
+            self.no = np.empty((n, 3), dtype=np.float32)
+        return self.co[:n], self.no[:n]
+
+    def capture(self, mesh, matrix=None):
+        # the returned arrays are only good until the next capture
+        co, no = self.buffers(len(mesh.vertices))
+        mesh.vertices.foreach_get("co", co.ravel())
+        mesh.vertices.foreach_get("normal", no.ravel())
+        return self.transform(co, no, matrix)
+
+    def transform(self, co, no, matrix):
+        if matrix is not None:
+            m = np.array(matrix, dtype=np.float32)
+            np.matmul(co, m[:3, :3].T, out=co)
+            co += m[:3, 3]
+            np.matmul(no, normal_matrix(matrix).T, out=no)
+            length = np.linalg.norm(no, axis=1, keepdims=True)
+            np.divide(no, length, out=no, where=length > 0)
+        return co, no
+
+# The static mesh data the exporters build their triangles from.
+
+def mesh_loops(mesh):
+    # the loops of the mesh's triangles, in quake order, and the vertex and
+    # uv of every loop
+    mesh.calc_loop_triangles()
+    loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int64)
+    mesh.loop_triangles.foreach_get("loops", loops)
+    # blender's and quake's vertex order are opposed
+    loops = loops.reshape(-1, 3)[:, [0, 2, 1]].ravel()
+    verts = np.empty(len(mesh.loops), dtype=np.int64)
+    mesh.loops.foreach_get("vertex_index", verts)
+    uv = np.empty(len(mesh.loops) * 2, dtype=np.float32)
+    mesh.uv_layers.active.data.foreach_get("uv", uv)
+    return loops, verts, uv.reshape(-1, 2)
+
+def tri_materials(mesh):
+    material = np.empty(len(mesh.loop_triangles), dtype=np.int64)
+    mesh.loop_triangles.foreach_get("material_index", material)
+    return material
+
+def texels(mdl, uv, rounded=False):
+    # the skin texel of each uv: mdl rounds to the nearest, md2 truncates
+    uv = uv.astype(np.float64)
+    if not (mdl.skinwidth and mdl.skinheight):
+        return np.zeros(len(uv), np.int64), np.zeros(len(uv), np.int64)
+    half = 0.5 if rounded else 0
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    s = (uv[:, 0] * (mdl.skinwidth - 1) + half).astype(np.int64)
+    t = ((1 - uv[:, 1]) * (mdl.skinheight - 1) + half).astype(np.int64)
+    # ensure st is within the skin
+    return s % mdl.skinwidth, t % mdl.skinheight
+
+class Unsupported(Exception):
+    pass
+
+def _strip_at(track, fno):
+    # the strip of the track that is evaluated at fno, and the frame at
+    # which it is evaluated (extrapolation holds the first or last frame)
+    strips = [s for s in track.strips if not s.mute]
+    before = None
+    for strip in strips:
+        if strip.frame_start <= fno <= strip.frame_end:
+            return strip, fno
+        if strip.frame_end < fno:
+            before = strip
+    if before and before.extrapolation in ('HOLD', 'HOLD_FORWARD'):
+        return before, before.frame_end
+    if strips and fno < strips[0].frame_start:
+        if strips[0].extrapolation == 'HOLD':
+            return strips[0], strips[0].frame_start
+    return None, fno
+
+def _strip_time(strip, fno):
+    # action frame for scene frame fno (nlastrip_get_frame_actionclip)
+    length = strip.action_frame_end - strip.action_frame_start
+    cycle = length * strip.scale
+    offset = fno - strip.frame_start
+    t = offset % cycle if cycle else 0.0
+    if t == 0 and offset > 0:
+        return strip.action_frame_end
+    return strip.action_frame_start + t / strip.scale
+
+def _strip_influence(strip, fno):
+    if strip.use_animated_influence:
+        return strip.influence
+    if strip.blend_in and fno < strip.frame_start + strip.blend_in:
+        return (fno - strip.frame_start) / strip.blend_in
+    if strip.blend_out and fno > strip.frame_end - strip.blend_out:
+        return (strip.frame_end - fno) / strip.blend_out
+    return 1.0
+
+def _blend(values, curves, t, blend_type, influence):
+    for index, fc in curves:
+        v = fc.evaluate(t)
+        if blend_type == 'REPLACE':
+            values[index] += (v - values[index]) * influence
+        else:
+            values[index] += v * influence
+
+class Channels:
+    # Evaluates the F-curves of some animation data, through its NLA stack
+    # if it has one, into an array of channel values. channel maps an
+    # F-curve's (data path, array index) to a channel index, or None to
+    # ignore the curve, and raises Unsupported for curves that would need
+    # the depsgraph. Channels that nothing animates keep their static value,
+    # those animated by the NLA start from their default value.
+    def __init__(self, anim, channel, static, default):
+        self.anim = anim
+        self.channel = channel
+        self.static = np.array(static, dtype=np.float64)
+        self.default = np.array(default, dtype=np.float64)
+        self.curve_cache = {}
+        self.tracks = []
+        if not anim:
+            return
+        if anim.use_tweak_mode or anim.drivers:
+            raise Unsupported
+        if anim.use_nla:
+            self.tracks = [t for t in anim.nla_tracks if not t.mute]
+            if any(t.is_solo for t in self.tracks):
+                self.tracks = [t for t in self.tracks if t.is_solo]
+        nla = set()
+        for track in self.tracks:
+            for strip in track.strips:
+                if (strip.type != 'CLIP' or strip.use_reverse
+                    or strip.blend_type not in ('REPLACE', 'ADD')):
+                    raise Unsupported
+                if strip.action:
+                    nla.update(i for i, fc in self.curves(strip.action))
+        self.nla_channels = sorted(nla)
+        if anim.action:
+            if anim.action_blend_type not in ('REPLACE', 'ADD'):
+                raise Unsupported
+            self.curves(anim.action)
+
+    def curves(self, action):
+        # (channel index, fcurve) pairs for an action, looked up once
+        if action not in self.curve_cache:
+            curves = []
+            for fc in action.fcurves:
+                index = self.channel(fc.data_path, fc.array_index)
+                if index is not None and not fc.mute:
+                    curves.append((index, fc))
+            self.curve_cache[action] = curves
+        return self.curve_cache[action]
+
+    def evaluate(self, fno):
+        values = self.static.copy()
+        if self.tracks:
+            values[self.nla_channels] = self.default[self.nla_channels]
+            for track in self.tracks:
+                strip, t = _strip_at(track, fno)
+                if strip and strip.action:
+                    _blend(values, self.curves(strip.action),
+                           _strip_time(strip, t), strip.blend_type,
+                           _strip_influence(strip, t))
+        if self.anim and self.anim.action:
+            _blend(values, self.curves(self.anim.action), fno,
+                   self.anim.action_blend_type, self.anim.action_influence)
+        return values
+
+class DeformCapture(VertexCapture):
+    # base for the captures that compute the deformed mesh themselves
+
+    def __init__(self, mesh):
+        VertexCapture.__init__(self)
+        self.num_verts = len(mesh.vertices)
+        # topology for the vertex normals
+        num_loops = len(mesh.loops)
+        self.loop_verts = np.empty(num_loops, dtype=np.int64)
+        mesh.loops.foreach_get("vertex_index", self.loop_verts)
+        loop_start = np.empty(len(mesh.polygons), dtype=np.int64)
+        loop_total = np.empty(len(mesh.polygons), dtype=np.int64)
+        mesh.polygons.foreach_get("loop_start", loop_start)
+        mesh.polygons.foreach_get("loop_total", loop_total)
+        self.loop_start = loop_start
+        self.loop_poly = np.repeat(np.arange(len(loop_start)), loop_total)
+        first = loop_start[self.loop_poly]
+        last = first + loop_total[self.loop_poly] - 1
+        loops = np.arange(num_loops)
+        self.next_loop = np.where(loops == last, first, loops + 1)
+        self.prev_loop = np.where(loops == first, last, loops - 1)
+
+    def vertex_normals(self, co):
+        # as blender does it: face normals (newell) weighted by the angle
+        # of each face corner
+        lc = co.astype(np.float64)[self.loop_verts]
+        nc = lc[self.next_loop]
+        pc = lc[self.prev_loop]
+        fn = np.add.reduceat(np.cross(lc, nc), self.loop_start, axis=0)
+        fn /= np.maximum(np.linalg.norm(fn, axis=1, keepdims=True), 1e-30)
+        dn = nc - lc
+        dp = pc - lc
+        dn /= np.maximum(np.linalg.norm(dn, axis=1, keepdims=True), 1e-30)
+        dp /= np.maximum(np.linalg.norm(dp, axis=1, keepdims=True), 1e-30)
+        angle = np.arccos(np.clip(np.sum(dn * dp, axis=1), -1, 1))
+        weighted = fn[self.loop_poly] * angle[:, None]
+        no = np.empty((len(co), 3), dtype=np.float64)
+        for i in range(3):
+            no[:, i] = np.bincount(self.loop_verts, weighted[:, i],
+                                   minlength=len(co))
+        length = np.linalg.norm(no, axis=1, keepdims=True)
+        # loose vertices get their position as normal
+        loose = length[:, 0] == 0
+        no[loose] = co[loose]
+        length[loose] = np.linalg.norm(no[loose], axis=1, keepdims=True)
+        return no / np.maximum(length, 1e-30)
+
+    def evaluate(self, fno, matrix=None):
+        co, no = self.buffers(self.num_verts)
+        co[:] = self.deform(fno)
+        no[:] = self.vertex_normals(co)
+        return self.transform(co, no, matrix)
+
+    def matches(self, mesh, fno):
+        ref_co, ref_no = VertexCapture().capture(mesh)
+        co, no = self.evaluate(fno)
+        size = max(1.0, float(np.abs(ref_co).max(initial=0)))
+        return (np.abs(co - ref_co).max(initial=0) <= 1e-4 * size
+                and np.abs(no - ref_no).max(initial=0) <= 1e-3)
+
+def _unanimated(*ids):
+    for id in ids:
+        anim = id.animation_data
+        if anim and (anim.action or anim.drivers or anim.nla_tracks):
+            return False
+    return True
+
+_transform_paths = ("location", "rotation_euler", "rotation_quaternion",
+                    "rotation_axis_angle", "scale", "delta_location",
+                    "delta_rotation_euler", "delta_rotation_quaternion",
+                    "delta_scale", "matrix_parent_inverse")
+
+def static_transform(obj):
+    # whether obj's world matrix is the same on every frame: nothing
+    # animates, drives or constrains the transform of obj or its parents
+    while obj:
+        if obj.constraints:
+            return False
+        if obj.parent and obj.parent_type != 'OBJECT':
+            return False        # bones, vertices
+        anim = obj.animation_data
+        if anim:
+            if anim.drivers:
+                return False
+            actions = [anim.action]
+            for track in anim.nla_tracks:
+                actions += [strip.action for strip in track.strips]
+            for action in actions:
+                if action and any(fc.data_path in _transform_paths
+                                  for fc in action.fcurves):
+                    return False
+        obj = obj.parent
+    return True
+
+class ShapeKeyCapture(DeformCapture):
+    key_path = re.compile(r'^key_blocks\["(.*)"\]\.value$')
+
+    @staticmethod
+    def usable(obj):
+        # nothing but the shape keys may change the mesh or its transform
+        key = obj.type == 'MESH' and obj.data.shape_keys
+        if not key or not key.use_relative or obj.show_only_shape_key:
+            return False
+        if obj.parent or obj.constraints:
+            return False
+        if any(mod.show_viewport for mod in obj.modifiers):
+            return False
+        if not _unanimated(obj, obj.data):
+            return False
+        return not any(kb.vertex_group for kb in key.key_blocks)
+
+    def __init__(self, obj):
+        DeformCapture.__init__(self, obj.data)
+        key = obj.data.shape_keys
+        blocks = key.key_blocks
+        coords = np.empty((len(blocks), self.num_verts * 3), dtype=np.float32)
+        for i, kb in enumerate(blocks):
+            kb.data.foreach_get("co", coords[i])
+        self.basis = coords[0]
+        rel = [blocks.find(kb.relative_key.name) for kb in blocks]
+        self.deltas = coords - coords[rel]
+        self.mute = np.array([kb.mute for kb in blocks])
+        self.mute[0] = True     # the reference key is the base
+        self.limits = np.array([(kb.slider_min, kb.slider_max)
+                                for kb in blocks])
+        names = dict((kb.name, i) for i, kb in enumerate(blocks))
+
+        def channel(path, index):
+            m = ShapeKeyCapture.key_path.match(path)
+            if not m:
+                raise Unsupported
+            return names.get(m.group(1))
+        self.channels = Channels(key.animation_data, channel,
+                                 [kb.value for kb in blocks],
+                                 [0.0] * len(blocks))
+
+    def deform(self, fno):
+        w = self.channels.evaluate(fno)
+        w = np.clip(w, self.limits[:, 0], self.limits[:, 1])
+        w[self.mute] = 0
+        keys = np.flatnonzero(w)
+        co = self.basis + w[keys].astype(np.float32) @ self.deltas[keys]
+        return co.reshape(-1, 3)
+
+class ArmatureCapture(DeformCapture):
+    # Linear blend skinning of a mesh whose only modifier is an armature.
+    # The pose is computed from the armature's action, so nothing but the
+    # action may move the bones.
+    bone_path = re.compile(r'^pose\.bones\["(.*)"\]\.(\w+)$')
+    # per bone channels
+    props = {'location': 0, 'rotation_quaternion': 3, 'rotation_euler': 7,
+             'rotation_axis_angle': 10, 'scale': 14}
+    num_channels = 17
+
+    @staticmethod
+    def usable(obj):
+        if obj.type != 'MESH' or obj.data.shape_keys or obj.constraints:
+            return False
+        mods = [mod for mod in obj.modifiers if mod.show_viewport]
+        if len(mods) != 1 or mods[0].type != 'ARMATURE':
+            return False
+        mod = mods[0]
+        arm = mod.object
+        if (not arm or not mod.use_vertex_groups or mod.use_bone_envelopes
+            or mod.use_deform_preserve_volume or mod.use_multi_modifier
+            or mod.vertex_group):
+            return False
+        if obj.parent and (obj.parent != arm or obj.parent_type != 'OBJECT'):
+            return False
+        if arm.parent or arm.constraints:
+            return False
+        if not _unanimated(obj, obj.data, arm.data):
+            return False
+        for pb in arm.pose.bones:
+            bone = pb.bone
+            if (pb.constraints or not bone.use_inherit_rotation
+                or bone.inherit_scale != 'FULL'
+                or not bone.use_local_location
+                or (bone.use_deform and bone.bbone_segments > 1)):
+                return False
+        return True
+
+    def __init__(self, obj):
+        DeformCapture.__init__(self, obj.data)
+        mesh = obj.data
+        arm = [mod for mod in obj.modifiers if mod.show_viewport][0].object
+        bones = arm.pose.bones
+        index = dict((pb.name, i) for i, pb in enumerate(bones))
+
+        # the modifier works in armature space
+        premat = arm.matrix_world.inverted() @ obj.matrix_world
+        self.postmat = np.array(premat.inverted(), dtype=np.float64)
+        co = np.empty(self.num_verts * 3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", co)
+        m = np.array(premat, dtype=np.float64)
+        self.rest = co.reshape(-1, 3) @ m[:3, :3].T + m[:3, 3]
+
+        # the weights as a sparse (verts x bones) matrix: one entry per
+        # (vertex, deforming bone) pair
+        group_bone = {}
+        for vg in obj.vertex_groups:
+            if vg.name in index and bones[vg.name].bone.use_deform:
+                group_bone[vg.index] = index[vg.name]
+        rows, cols, weights = [], [], []
+        for v in mesh.vertices:
+            for g in v.groups:
+                if g.group in group_bone and g.weight > 0:
+                    rows.append(v.index)
+                    cols.append(group_bone[g.group])
+                    weights.append(g.weight)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.cols = np.array(cols, dtype=np.int64)
+        self.weights = np.array(weights, dtype=np.float64)
+        self.total = np.bincount(self.rows, self.weights,
+                                 minlength=self.num_verts)
+        self.skinned = self.total > 0.0001
+
+        # bone hierarchy, parents first
+        self.parents = []
+        self.offsets = []
+        self.rest_inv = []
+        self.modes = []
+        for pb in bones:
+            bone = pb.bone
+            parent = pb.parent
+            self.parents.append(index[parent.name] if parent else -1)
+            if parent:
+                offset = parent.bone.matrix_local.inverted() @ bone.matrix_local
+            else:
+                offset = bone.matrix_local.copy()
+            self.offsets.append(offset)
+            self.rest_inv.append(bone.matrix_local.inverted())
+            self.modes.append(pb.rotation_mode)
+        self.order = []
+        done = set()
+
+        def visit(i):
+            if i not in done:
+                if self.parents[i] >= 0:
+                    visit(self.parents[i])
+                done.add(i)
+                self.order.append(i)
+        for i in range(len(bones)):
+            visit(i)
+
+        static = []
+        default = []
+        for pb in bones:
+            static += (list(pb.location) + list(pb.rotation_quaternion)
+                       + list(pb.rotation_euler)
+                       + list(pb.rotation_axis_angle) + list(pb.scale))
+            default += [0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 1, 1, 1]
+
+        def channel(path, array_index):
+            m = ArmatureCapture.bone_path.match(path)
+            if not m:
+                raise Unsupported   # the armature object itself moves
+            name, prop = m.groups()
+            if name not in index or prop not in ArmatureCapture.props:
+                return None
+            return (index[name] * ArmatureCapture.num_channels
+                    + ArmatureCapture.props[prop] + array_index)
+        self.channels = Channels(arm.animation_data, channel, static,
+                                 default)
+
+    def pose(self, fno):
+        # bone deform matrices in armature space, (bones, 4, 4)
+        from mathutils import Matrix, Quaternion, Euler, Vector
+        values = self.channels.evaluate(fno)
+        values = values.reshape(-1, ArmatureCapture.num_channels)
+        mats = [None] * len(self.parents)
+        for i in self.order:
+            c = values[i]
+            mode = self.modes[i]
+            if mode == 'QUATERNION':
+                rot = Quaternion(c[3:7]).normalized().to_matrix()
+            elif mode == 'AXIS_ANGLE':
+                rot = Matrix.Rotation(c[10], 3, Vector(c[11:14]))
+            else:
+                rot = Euler(c[7:10], mode).to_matrix()
+            basis = Matrix.LocRotScale(Vector(c[0:3]), rot, Vector(c[14:17]))
+            local = self.offsets[i] @ basis
+            parent = self.parents[i]
+            mats[i] = local if parent < 0 else mats[parent] @ local
+        return np.array([mats[i] @ self.rest_inv[i]
+                         for i in range(len(mats))], dtype=np.float64)
+
+    def skin(self, mats):
+        m = mats[self.cols]
+        v = self.rest[self.rows]
+        moved = np.einsum('nij,nj->ni', m[:, :3, :3], v) + m[:, :3, 3]
+        moved *= self.weights[:, None]
+        co = self.rest.copy()
+        for i in range(3):
+            acc = np.bincount(self.rows, moved[:, i],
+                              minlength=self.num_verts)
+            co[self.skinned, i] = (acc[self.skinned]
+                                   / self.total[self.skinned])
+        return co
+
+    def deform(self, fno):
+        co = self.skin(self.pose(fno))
+        return co @ self.postmat[:3, :3].T + self.postmat[:3, 3]
+
+class FrameSweep:
+    # Iterating yields (frame number, [(co, no) for each object]), with the
+    # object's matrix object's (see __init__) world transform applied. The
+    # arrays are only good until the next frame.
+    samples = 3     # frames checked against the depsgraph per object
+
+    def __init__(self, context, objects, frames, matrices=None):
+        # matrices: the objects whose world matrix transforms each
+        # object, or None for no transform
+        self.context = context
+        self.objects = objects
+        self.frames = frames
+        self.matrices = matrices
+        for obj in objects:
+            obj.update_from_editmode()
+        self.captures = []
+        for obj in objects:
+            cap = VertexCapture()
+            for kind in (ShapeKeyCapture, ArmatureCapture):
+                if kind.usable(obj):
+                    try:
+                        cap = kind(obj)
+                    except Unsupported:
+                        pass
+                    break
+            self.captures.append(cap)
+        self.validate()
+        self.fast = sum(isinstance(cap, DeformCapture)
+                        for cap in self.captures)
+        # the matrices don't change unless the depsgraph is stepped, so
+        # that's only skipped when they can't change anyway
+        self.evaluate = (self.fast < len(objects)
+                         or not all(static_transform(obj)
+                                    for obj in matrices or ()))
+
+    def validate(self):
+        fast = [i for i, cap in enumerate(self.captures)
+                if isinstance(cap, DeformCapture)]
+        if not fast or not self.frames:
+            return
+        step = max(1, len(self.frames) // (FrameSweep.samples - 1))
+        samples = sorted(set(self.frames[::step]) | {self.frames[-1]})
+        for fno in samples:
+            self.context.scene.frame_set(fno)
+            depsgraph = self.context.evaluated_depsgraph_get()
+            for i in fast:
+                cap = self.captures[i]
+                if not isinstance(cap, DeformCapture):
+                    continue
+                ob = self.objects[i].evaluated_get(depsgraph)
+                ok = cap.matches(ob.to_mesh(), fno)
+                ob.to_mesh_clear()
+                if not ok:
+                    self.captures[i] = VertexCapture()
+
+    def matrix(self, i):
+        if self.matrices is None:
+            return None
+        return self.matrices[i].matrix_world
+
+    def __iter__(self):
+        for fno in self.frames:
+            if self.evaluate:
+                self.context.scene.frame_set(fno)
+                depsgraph = self.context.evaluated_depsgraph_get()
+            verts = []
+            evaluated = []
+            try:
+                for i, cap in enumerate(self.captures):
+                    if isinstance(cap, DeformCapture):
+                        verts.append(cap.evaluate(fno, self.matrix(i)))
+                        continue
+                    ob = self.objects[i].evaluated_get(depsgraph)
+                    evaluated.append(ob)
+                    verts.append(cap.capture(ob.to_mesh(), self.matrix(i)))
+                yield fno, verts
+            finally:
+                for ob in evaluated:
+                    ob.to_mesh_clear()
+
+def make_sweep(operator, context, objects, frames, matrices, workers,
+               use_cache, recorded=None):
+    # generator: the sweep an exporter takes its frames from, returned once
+    # any worker processes are done. recorded: a multiexport recording to
+    # replay instead of sweeping the timeline.
+    # both of these are built on FrameSweep, so can't be imported up top
+    from .workers import ProcessSweep
+    from .exportcache import CachedSweep
+    if recorded is not None:
+        # already captured, for several formats at once
+        return recorded.view(matrices, objects)
+    if workers:
+        sweep = ProcessSweep(context, objects, frames, matrices, workers)
+        yield from sweep.run()
+    elif use_cache:
+        sweep = CachedSweep(context, objects, frames, matrices)
+        if sweep.hits:
+            operator.report({'INFO'}, "%d of %d frames taken from the "
+                            "export cache" % (sweep.hits, len(frames)))
+    else:
+        sweep = FrameSweep(context, objects, frames, matrices)
+    if sweep.fast:
+        operator.report({'INFO'}, "%d of %d objects evaluated without the "
+                        "depsgraph" % (sweep.fast, len(objects)))
+    return sweep
@@ -0,0 +1,210 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Quadric error mesh simplification for generating levels of detail.
+#
+# Edges are collapsed in order of quadric error (Garland and Heckbert), but
+# only ever onto one of their own vertices (half-edge collapses). The
+# simplified mesh thus uses a subset of the original vertices, so every
+# frame of an animation can be gathered from the full resolution frames
+# with the same vertex indices.
+#
+# As exported, a UV seam is a boundary: the vertices are split along it,
+# one copy per side at the same position. A seam vertex may still collapse
+# along the seam, as long as its copy on the other side collapses onto the
+# matching copy at the same time, which keeps both sides, and the texture
+# mapping, consistent. Anything else on a boundary (the edges of open
+# meshes, the ends and junctions of seams) never moves.
+
+import heapq
+
+import numpy as np
+
+def quadrics(co, tris):
+    # per vertex sum of the squared distance to the planes of its faces
+    v = co[tris]
+    n = np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])
+    length = np.linalg.norm(n, axis=1, keepdims=True)
+    n /= np.maximum(length, 1e-30)
+    planes = np.hstack((n, -np.sum(n * v[:, 0], axis=1, keepdims=True)))
+    k = planes[:, :, None] * planes[:, None, :]
+    q = np.zeros((len(co), 4, 4))
+    for i in range(3):
+        np.add.at(q, tris[:, i], k)
+    return q
+
+def boundary_edges(tris):
+    edges = np.sort(np.concatenate((tris[:, [0, 1]], tris[:, [1, 2]],
+                                    tris[:, [2, 0]])), axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    return edges[counts == 1]
+
+def seams(co, tris):
+    # Returns the locked vertices, the position id of every vertex, and the
+    # seam neighbours of each vertex that may slide along a seam. A seam
+    # edge is a boundary edge with exactly one other boundary edge between
+    # the same two positions.
+    num_verts = len(co)
+    _, pos = np.unique(co, axis=0, return_inverse=True)
+    pos = pos.ravel()
+    edges = boundary_edges(tris)
+    locked = np.zeros(num_verts, dtype=bool)
+    locked[edges.ravel()] = True
+    keys = np.sort(pos[edges], axis=1)
+    _, group, counts = np.unique(keys, axis=0, return_inverse=True,
+                                 return_counts=True)
+    seam = counts[group.ravel()] == 2
+    # open boundaries stay put
+    free = np.ones(num_verts, dtype=bool)
+    free[edges[~seam].ravel()] = False
+    adj = [set() for _ in range(num_verts)]
+    for u, v in edges[seam]:
+        adj[u].add(v)
+        adj[v].add(u)
+    copies = np.bincount(pos, minlength=num_verts)[pos]
+    for v in np.flatnonzero(locked):
+        # a seam passes straight through, between exactly two sides
+        if free[v] and len(adj[v]) == 2 and copies[v] == 2:
+            locked[v] = False
+    return locked, pos, adj
+
+def simplify(co, tris, target):
+    # co: (verts, 3) positions of the reference frame, tris: (tris, 3)
+    # vertex indices. Returns the remaining triangles, still indexing co,
+    # with at most target of them if that can be done.
+    co = co.astype(np.float64)
+    tris = np.array(tris, dtype=np.int64).reshape(-1, 3)
+    if len(tris) <= target:
+        return tris
+    q = quadrics(co, tris)
+    locked, pos, seam_adj = seams(co, tris)
+    faces = [set() for _ in range(len(co))]
+    for f, tri in enumerate(tris):
+        for v in tri:
+            faces[v].add(f)
+    alive = np.ones(len(tris), dtype=bool)
+    version = np.zeros(len(co), dtype=np.int64)
+    heap = []
+    # the copy of each seam vertex on the other side of its seam
+    twin = np.full(len(co), -1, dtype=np.int64)
+    for v in range(len(co)):
+        if seam_adj[v] and not locked[v]:
+            for w in np.flatnonzero(pos == pos[v]):
+                if w != v:
+                    twin[v] = w
+
+    def cost(a, b):
+        p = np.append(co[b], 1.0)
+        return float(p @ (q[a] + q[b]) @ p)
+
+    def partner(a, b):
+        # the collapse that has to go with a -> b on the other side of a
+        # seam: None if there is none to go with it, False if it can't be
+        if twin[a] < 0:
+            return None
+        a2 = twin[a]
+        for b2 in seam_adj[a2]:
+            if pos[b2] == pos[b] and b2 != b and a2 != b:
+                return a2, b2
+        return False
+
+    def push(a, b):
+        if locked[a]:
+            return
+        if twin[a] >= 0 and b not in seam_adj[a]:
+            return      # seam vertices only slide along the seam
+        c = cost(a, b)
+        other = partner(a, b)
+        if other is False:
+            return
+        if other:
+            c += cost(*other)
+        heapq.heappush(heap, (c, a, b, version[a], version[b]))
+
+    def normal(tri):
+        v = co[tri]
+        return np.cross(v[1] - v[0], v[2] - v[0])
+
+    def flips(a, b):
+        # moving a onto b must not fold or degenerate any remaining face
+        for f in faces[a]:
+            tri = tris[f]
+            if b in tri:
+                continue
+            old = normal(tri)
+            new = normal(np.where(tri == a, b, tri))
+            if np.dot(old, new) <= 1e-6 * np.dot(old, old):
+                return True
+        return False
+
+    def collapse(a, b):
+        removed = 0
+        for f in list(faces[a]):
+            tri = tris[f]
+            if b in tri:
+                alive[f] = False
+                removed += 1
+                for v in tri:
+                    faces[v].discard(f)
+            else:
+                tri[tri == a] = b
+                faces[b].add(f)
+        faces[a].clear()
+        q[b] += q[a]
+        version[a] += 1
+        version[b] += 1
+        if seam_adj[a]:
+            for c in seam_adj[a]:
+                seam_adj[c].discard(a)
+                if c != b:
+                    seam_adj[c].add(b)
+                    seam_adj[b].add(c)
+            seam_adj[b].discard(a)
+            seam_adj[a] = set()
+        return removed
+
+    def repush(b):
+        neighbours = set()
+        for f in faces[b]:
+            neighbours.update(tris[f])
+        neighbours.discard(b)
+        for n in neighbours:
+            push(n, b)
+            push(b, n)
+
+    for tri in tris:
+        for i in range(3):
+            push(tri[i], tri[(i + 1) % 3])
+            push(tri[(i + 1) % 3], tri[i])
+    count = len(tris)
+    while count > target and heap:
+        c, a, b, va, vb = heapq.heappop(heap)
+        if va != version[a] or vb != version[b] or not faces[a]:
+            continue
+        other = partner(a, b)
+        if other is False or flips(a, b) or (other and flips(*other)):
+            continue
+        count -= collapse(a, b)
+        repush(b)
+        if other:
+            count -= collapse(*other)
+            repush(other[1])
+    return tris[alive]
@@ -0,0 +1,375 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# On-disk cache for repeated exports.
+#
+# Every captured frame is stored under a fingerprint of what went into it:
+# a hash of everything about the object (and whatever it depends on) that
+# can't change over time, such as mesh data, shape keys, weights, bones and
+# modifier settings, plus the values of all its animation channels at that
+# frame. The channels are evaluated straight from the F-curves (see
+# capture.Channels), so working out which frames changed needs neither the
+# depsgraph nor the timeline. Only frames whose fingerprint isn't in the
+# cache are captured again. Anything the fingerprint can't account for
+# (drivers, constraints, simulation or texture driven modifiers, ...) makes
+# the object uncacheable and it's captured every time, as before.
+#
+# Converted skins are likewise cached under a hash of their pixels.
+#
+# The cache lives in the add-on's user data directory (next to the skin
+# cache) and is kept under MAX_SIZE by dropping the least recently used
+# entries after each export that added to it.
+
+import hashlib
+import os
+
+import bpy
+import numpy as np
+
+from .capture import FrameSweep, Channels, Unsupported
+
+VERSION = "1"   # bump when the captured data changes meaning
+MAX_SIZE = 512 << 20    # bytes kept, the least recently used go first
+
+class Uncacheable(Exception):
+    pass
+
+def cache_dir():
+    return bpy.utils.user_resource('DATAFILES', path="qfmd_export_cache",
+                                   create=True)
+
+def cache_path(key, ext):
+    return os.path.join(cache_dir(), key[:2], key + ext)
+
+def store(path, save):
+    # written under another name and renamed into place, so a reader never
+    # sees a partial entry
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp, "wb") as f:
+        save(f)
+    os.replace(tmp, path)
+
+def touch(path):
+    # for evict, which goes by modification time
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def evict(max_size=MAX_SIZE):
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cache_dir()):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def load_frame(key):
+    path = cache_path(key, ".npy")
+    try:
+        data = np.load(path)
+    except (OSError, ValueError):
+        return None
+    touch(path)
+    if data.ndim != 3 or data.shape[0] != 2:
+        return None
+    return data[0], data[1]
+
+def store_frame(key, co, no):
+    store(cache_path(key, ".npy"), lambda f: np.save(f, np.stack((co, no))))
+
+def load_skin(key):
+    path = cache_path(key, ".skin")
+    try:
+        with open(path, "rb") as f:
+            pixels = bytearray(f.read())
+    except OSError:
+        return None
+    touch(path)
+    return pixels
+
+def store_skin(key, pixels):
+    store(cache_path(key, ".skin"), lambda f: f.write(pixels))
+
+def pixels_key(pixels, *extra):
+    h = hashlib.sha1(VERSION.encode())
+    h.update(repr((pixels.shape, pixels.dtype.str) + extra).encode())
+    h.update(np.ascontiguousarray(pixels).tobytes())
+    return h.hexdigest()
+
+def foreach(collection, attr, width, dtype):
+    data = np.empty(len(collection) * width, dtype=dtype)
+    collection.foreach_get(attr, data)
+    return data
+
+class Fingerprint:
+    # modifiers whose result depends only on their settings and inputs
+    modifiers = {'ARMATURE', 'ARRAY', 'BEVEL', 'CAST', 'CORRECTIVE_SMOOTH',
+                 'DECIMATE', 'EDGE_SPLIT', 'HOOK', 'LAPLACIANSMOOTH',
+                 'MIRROR', 'SHRINKWRAP', 'SIMPLE_DEFORM',
+                 'SMOOTH', 'SOLIDIFY', 'SUBSURF', 'TRIANGULATE', 'WELD',
+                 'WEIGHTED_NORMAL'}
+    object_props = ("type", "location", "rotation_mode", "rotation_euler",
+                    "rotation_quaternion", "rotation_axis_angle", "scale",
+                    "delta_location", "delta_rotation_euler",
+                    "delta_rotation_quaternion", "delta_scale",
+                    "parent_type", "parent_bone", "matrix_parent_inverse",
+                    "show_only_shape_key", "active_shape_key_index")
+    key_block_props = ("name", "value", "slider_min", "slider_max", "mute",
+                       "vertex_group", "interpolation")
+    bone_props = ("name", "use_deform", "use_connect", "use_inherit_rotation",
+                  "inherit_scale", "use_local_location", "bbone_segments",
+                  "envelope_distance", "envelope_weight", "head_radius",
+                  "tail_radius", "matrix_local")
+    pose_bone_props = ("location", "rotation_mode", "rotation_quaternion",
+                       "rotation_euler", "rotation_axis_angle", "scale")
+
+    def __init__(self, obj, matrix_obj=None):
+        self.hash = hashlib.sha1(VERSION.encode())
+        self.channels = []
+        self.seen = set()
+        self.add_object(obj)
+        if matrix_obj:
+            self.update("matrix", matrix_obj.name)
+            self.add_object(matrix_obj)
+        self.static = self.hash.digest()
+
+    def key(self, fno):
+        h = hashlib.sha1(self.static)
+        for channels in self.channels:
+            h.update(channels.evaluate(fno).tobytes())
+        return h.hexdigest()
+
+    def update(self, *data):
+        for d in data:
+            if isinstance(d, np.ndarray):
+                self.hash.update(d.tobytes())
+            else:
+                self.hash.update(repr(d).encode())
+
+    def add_props(self, struct, prefix, props, paths):
+        # animated properties are in the channels instead
+        for prop in props:
+            if prefix + prop in paths:
+                continue
+            value = getattr(struct, prop)
+            if isinstance(value, set):
+                value = sorted(value)   # enum flags
+            elif hasattr(value, "__len__") and not isinstance(value, str):
+                value = tuple(tuple(v) if hasattr(v, "__len__") else v
+                              for v in value)
+            self.update(prop, value)
+
+    def add_struct(self, struct, prefix, paths):
+        # every setting of a modifier
+        for prop in struct.bl_rna.properties:
+            ident = prop.identifier
+            if ident == "rna_type" or prefix + ident in paths:
+                continue
+            if prop.type == 'COLLECTION':
+                continue
+            value = getattr(struct, ident)
+            if prop.type == 'POINTER':
+                if isinstance(value, bpy.types.Object):
+                    self.add_object(value)
+                    value = value.name
+                elif isinstance(value, bpy.types.ID):
+                    raise Uncacheable   # eg, a displacement texture
+                elif value is not None:
+                    continue
+                self.update(ident, value)
+            else:
+                self.add_props(struct, prefix, (ident,), paths)
+
+    def add_anim(self, id):
+        # the channels animating id, and their data paths
+        anim = id.animation_data
+        if not anim:
+            return set()
+        if anim.drivers:
+            raise Uncacheable
+        actions = [anim.action]
+        for track in anim.nla_tracks:
+            actions += [strip.action for strip in track.strips]
+        curves = set()
+        for action in actions:
+            if action:
+                curves.update((fc.data_path, fc.array_index)
+                              for fc in action.fcurves)
+        curves = sorted(curves)
+        index = dict((c, i) for i, c in enumerate(curves))
+        zeros = [0.0] * len(curves)
+        try:
+            channels = Channels(anim, lambda path, i: index[(path, i)],
+                                zeros, zeros)
+        except Unsupported:
+            raise Uncacheable
+        self.update(id.name, curves)
+        self.channels.append(channels)
+        return set(path for path, i in curves)
+
+    def add_object(self, obj):
+        if obj.as_pointer() in self.seen:
+            return
+        self.seen.add(obj.as_pointer())
+        if obj.type not in ('MESH', 'ARMATURE', 'EMPTY') or obj.constraints:
+            raise Uncacheable
+        paths = self.add_anim(obj)
+        self.update("object", obj.name)
+        self.add_props(obj, "", Fingerprint.object_props, paths)
+        if obj.parent:
+            self.update("parent", obj.parent.name)
+            self.add_object(obj.parent)
+        if obj.type == 'MESH':
+            self.add_mesh(obj)
+        elif obj.type == 'ARMATURE':
+            self.add_armature(obj, paths)
+        for mod in obj.modifiers:
+            if not mod.show_viewport:
+                continue
+            if mod.type not in Fingerprint.modifiers:
+                raise Uncacheable
+            self.update("modifier", mod.type)
+            self.add_struct(mod, 'modifiers["%s"].' % mod.name, paths)
+
+    def add_mesh(self, obj):
+        mesh = obj.data
+        self.add_anim(mesh)
+        self.update("mesh", mesh.name,
+                    foreach(mesh.vertices, "co", 3, np.float32),
+                    foreach(mesh.edges, "vertices", 2, np.int32),
+                    foreach(mesh.loops, "vertex_index", 1, np.int32),
+                    foreach(mesh.polygons, "loop_total", 1, np.int32))
+        key = mesh.shape_keys
+        # the weights only matter to modifiers, armature parents and vertex
+        # group shape keys
+        if obj.vertex_groups and (
+                any(mod.show_viewport for mod in obj.modifiers)
+                or obj.parent_type == 'ARMATURE'
+                or (key and any(kb.vertex_group for kb in key.key_blocks))):
+            self.update([vg.name for vg in obj.vertex_groups])
+            # there's no bulk access to the weights, but each vertex's can
+            # at least go straight into one array
+            counts = np.array([len(v.groups) for v in mesh.vertices],
+                              dtype=np.int32)
+            ends = np.cumsum(counts)
+            groups = np.empty(ends[-1] if len(ends) else 0, dtype=np.int32)
+            weights = np.empty(len(groups), dtype=np.float32)
+            for v, end, n in zip(mesh.vertices, ends.tolist(),
+                                 counts.tolist()):
+                if n:
+                    v.groups.foreach_get("group", groups[end - n:end])
+                    v.groups.foreach_get("weight", weights[end - n:end])
+            self.update(counts, groups, weights)
+        if key:
+            paths = self.add_anim(key)
+            self.update("key", key.use_relative)
+            for kb in key.key_blocks:
+                prefix = 'key_blocks["%s"].' % kb.name
+                self.add_props(kb, prefix, Fingerprint.key_block_props,
+                               paths)
+                self.update(kb.relative_key.name,
+                            foreach(kb.data, "co", 3, np.float32))
+
+    def add_armature(self, obj, paths):
+        arm = obj.data
+        self.add_anim(arm)
+        self.update("armature", arm.name, arm.pose_position)
+        for bone in arm.bones:
+            self.add_props(bone, "", Fingerprint.bone_props, ())
+            self.update(bone.parent.name if bone.parent else None)
+        for pb in obj.pose.bones:
+            if pb.constraints:
+                raise Uncacheable
+            prefix = 'pose.bones["%s"].' % pb.name
+            self.add_props(pb, prefix, Fingerprint.pose_bone_props, paths)
+
+class CachedSweep:
+    # A FrameSweep over only the frames that aren't in the cache; the rest
+    # are loaded from it. Iterates just like FrameSweep.
+
+    def __init__(self, context, objects, frames, matrices=None):
+        self.context = context
+        self.objects = objects
+        self.matrices = matrices
+        fingerprints = []
+        for i, obj in enumerate(objects):
+            obj.update_from_editmode()
+            try:
+                fingerprints.append(Fingerprint(obj, matrices and matrices[i]))
+            except Uncacheable:
+                fingerprints.append(None)
+        self.frames = list(frames)
+        self.keys = [[fp and fp.key(fno) for fp in fingerprints]
+                     for fno in self.frames]
+        self.missing = set()
+        for fno, keys in zip(self.frames, self.keys):
+            for key in keys:
+                if not key or not os.path.exists(cache_path(key, ".npy")):
+                    self.missing.add(fno)
+                    break
+        self.hits = len(self.frames) - len(self.missing)
+        self.sweep = FrameSweep(context, objects,
+                                [fno for fno in self.frames
+                                 if fno in self.missing], matrices)
+        self.fast = self.sweep.fast
+        self.stored = False
+
+    def recapture(self, fno):
+        # an entry that was there when checked but can't be loaded now
+        # (removed or damaged meanwhile) is a miss after all
+        sweep = FrameSweep(self.context, self.objects, [fno], self.matrices)
+        for fno, verts in sweep:
+            return [(co.copy(), no.copy()) for co, no in verts]
+
+    def store(self, keys, verts):
+        for key, (co, no) in zip(keys, verts):
+            if key:
+                store_frame(key, co, no)
+                self.stored = True
+
+    def __iter__(self):
+        captured = iter(self.sweep)
+        for fno, keys in zip(self.frames, self.keys):
+            if fno in self.missing:
+                fno, verts = next(captured)
+                self.store(keys, verts)
+            else:
+                verts = [load_frame(key) for key in keys]
+                if None in verts:
+                    verts = self.recapture(fno)
+                    self.store(keys, verts)
+            yield fno, verts
+        if self.stored:
+            evict()
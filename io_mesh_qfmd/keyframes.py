@@ -0,0 +1,111 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Keyframe reduction for formats whose engines lerp between frames.
+#
+# Within each animation, frames are dropped greedily: starting from a kept
+# frame, the next kept frame is pushed as far as it can go while every frame
+# in between stays within the tolerance of the linear interpolation of the
+# two. The tolerance is in quantization steps of the dropped frame, so what
+# the engine draws differs from the full animation by no more than rounding
+# already does. The first and last frame of each animation are always kept,
+# so no interpolation crosses from one animation into the next.
+#
+# Dropping frames renumbers all the later ones, so the exporters write a
+# frame table (model_frames.txt) next to the model, giving the scene frame
+# each model frame came from.
+
+import os
+import re
+
+import numpy as np
+
+def anim_name(frame_name):
+    # frames are named after their animation: "run1", "run2", ...
+    return re.sub(r"\d+$", "", frame_name)
+
+def anim_starts(names, frames, markers=()):
+    # indices of the frames that begin an animation: where the name prefix
+    # changes, and at timeline markers
+    markers = set(markers)
+    starts = []
+    for f, (name, fno) in enumerate(zip(names, frames)):
+        if (not f or fno in markers
+            or anim_name(name) != anim_name(names[f - 1])):
+            starts.append(f)
+    return starts
+
+def lerp_error(co, steps, a, b):
+    # worst error, in steps, of the frames between a and b when lerped
+    t = ((np.arange(a + 1, b) - a) / (b - a))[:, None, None]
+    lerp = co[a] + t * (co[b].astype(np.float64) - co[a])
+    err = np.abs(co[a + 1:b] - lerp) / steps[a + 1:b, None, :]
+    return float(err.max()) if err.size else 0.0
+
+def reduce_frames(co, steps, starts, tolerance=1.0):
+    # co: (frames, verts, 3) positions, steps: (frames, 3) the quantization
+    # step of each frame. Returns the indices of the kept frames and the
+    # worst error of the dropped ones, in steps.
+    num_frames = len(co)
+    steps = np.maximum(np.asarray(steps, dtype=np.float64), 1e-9)
+    bounds = sorted(set(starts) | {0}) + [num_frames]
+    kept = []
+    worst = 0.0
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start >= end:
+            continue
+        a = start
+        kept.append(a)
+        b = a + 1
+        error = 0.0
+        while b < end:
+            if b + 1 < end:
+                e = lerp_error(co, steps, a, b + 1)
+                if e <= tolerance:
+                    b += 1
+                    error = e
+                    continue
+            kept.append(b)
+            worst = max(worst, error)
+            a, b, error = b, b + 1, 0.0
+    return kept, worst
+
+def frame_ranges(frames):
+    # "1-4, 7, 9-12" for reporting frame numbers
+    ranges = []
+    for fno in frames:
+        if ranges and ranges[-1][1] == fno - 1:
+            ranges[-1][1] = fno
+        else:
+            ranges.append([fno, fno])
+    return ", ".join(str(a) if a == b else "%d-%d" % (a, b)
+                     for a, b in ranges)
+
+def frame_table(frames, names):
+    # save(path) for the frame table: model frame, scene frame and name
+    def save(path):
+        with open(path, "w") as f:
+            for i, (fno, name) in enumerate(zip(frames, names)):
+                f.write("%d %d %s\n" % (i, fno, name))
+    return save
+
+def frame_table_path(filepath):
+    return os.path.splitext(filepath)[0] + "_frames.txt"
@@ -19,11 +19,19 @@
 
 # <pep8 compliant>
 
+import os
+import tempfile
+
 import bpy
 from bpy_extras.object_utils import object_data_add
 from mathutils import Vector,Matrix
+import numpy as np
 
-from ..quakenorm import map_normal
+from ..quakenorm import encode_anorms
+from ..capture import make_sweep, mesh_loops, tri_materials, texels
+from ..atlas import Atlas
+from ..keyframes import reduce_frames, anim_starts, frame_ranges
+from ..keyframes import frame_table, frame_table_path
 from .md2 import MD2
 
 def check_faces(mesh):
@@ -68,49 +76,43 @@ def make_skin(operator, mdl, mesh):
             skin = image.name
             mdl.skins.append(MD2.Skin(skin))
 
-def build_tris(meshes):
-    stverts = []
-    tris = []
-    vuvdict = {}
+def build_tris(mdl, meshes, atlas=None):
+    # UVs are welded on the texel they land on, so UVs that differ only by
+    # float noise share an stvert
+    verts = []
+    sts = []
     vert_offset = 0
 
-    for m in range(len(meshes)):
-        uvfaces = meshes[m].uv_layers.active.data
-        for face in meshes[m].polygons:
-            fv = list(face.vertices)
-            uv = uvfaces[face.loop_start:face.loop_start + face.loop_total]
-            uv = list(map(lambda a: a.uv, uv))
-            for i in range(1, len(fv) - 1):
-                uvs = [tuple(uv[0]), tuple(uv[i + 1]), tuple(uv[i])]
-
-                for st in uvs:
-                    if st not in vuvdict:
-                        vuvdict[st] = len(stverts)
-                        stverts.append(MD2.STVert(st))
-
-                # blender's and quake's vertex order are opposed
-                tris.append(MD2.Tri((fv[0] + vert_offset, fv[i + 1] + vert_offset, fv[i] + vert_offset), (vuvdict[uvs[0]], vuvdict[uvs[1]], vuvdict[uvs[2]])))
-        vert_offset = vert_offset + len(meshes[m].vertices)
-        print(vert_offset)
-    return tris, stverts
+    for m, mesh in enumerate(meshes):
+        loops, loop_verts, uv = mesh_loops(mesh)
+        uv = uv[loops]
+        if atlas:
+            uv = atlas.remap(m, uv, tri_materials(mesh).repeat(3))
+        verts.append(loop_verts[loops] + vert_offset)
+        sts.append(np.stack(texels(mdl, uv), axis=1))
+        vert_offset = vert_offset + len(mesh.vertices)
 
-def convert_stverts(mdl, stverts):
-    for i, st in enumerate(stverts):
-        # quake textures are top to bottom, but blender images
-        # are bottom to top
-        st.s = int(st.s * (mdl.skinwidth - 1))
-        st.t = int((1 - st.t) * (mdl.skinheight - 1))
-        # ensure st is within the skin
-        if (mdl.skinwidth and mdl.skinheight):
-          st.s = ((st.s % mdl.skinwidth) + mdl.skinwidth) % mdl.skinwidth
-          st.t = ((st.t % mdl.skinheight) + mdl.skinheight) % mdl.skinheight
-        else:
-          st.s = st.t = 0
+    verts = np.concatenate(verts) if verts else np.empty(0, np.int64)
+    sts = np.concatenate(sts) if sts else np.empty((0, 2), np.int64)
+    # one stvert per texel, numbered in order of first use
+    keys = sts[:, 1] * max(mdl.skinwidth, 1) + sts[:, 0]
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    tris = np.zeros(len(verts) // 3, dtype=MD2.Tri.dtype)
+    tris['verts'] = verts.reshape(-1, 3)
+    tris['tcs'] = rank[inverse.ravel()].reshape(-1, 3)
+    stverts = np.zeros(len(order), dtype=MD2.STVert.dtype)
+    stverts['s'] = sts[first[order], 0]
+    stverts['t'] = sts[first[order], 1]
+    return tris, stverts
 
-def make_frame(frame, mesh):
-    for mv in mesh.vertices:
-        vert = MD2.Vert(tuple(mv.co), map_normal(mv.normal))
-        frame.add_vert(vert)
+def make_frame(co, ni, mco, mno):
+    # co and ni are this object's slice of the frame's vertex arrays
+    co[:] = mco
+    ni[:] = encode_anorms(mno)
 
 def name_frame(frame_number):
     if bpy.context.object.data.shape_keys:
@@ -122,18 +124,74 @@ def name_frame(frame_number):
     else:
         return "frame" + str(frame_number)
 
+def write_reduced(operator, context, mdl, filepath, sweep, frames, offsets,
+                  tolerance):
+    # Reducing needs the whole animation, so the captured frames are
+    # spilled to a temporary file and only the kept ones are written. Each
+    # md2 frame is quantized to its own bounds, and so is the tolerance.
+    record = np.dtype([('co', '<f4', (offsets[-1], 3)),
+                       ('ni', 'u1', offsets[-1])])
+    with tempfile.TemporaryFile() as spill:
+        data = np.memmap(spill, dtype=record, mode='w+', shape=len(frames))
+        co, ni = data['co'], data['ni']
+        names = []
+        steps = np.empty((len(frames), 3))
+        for f, (fno, verts) in enumerate(sweep):
+            yield ("Frames", f, len(frames))
+            names.append(name_frame(fno))
+            for i, (mco, mno) in enumerate(verts):
+                start, end = offsets[i], offsets[i + 1]
+                make_frame(co[f, start:end], ni[f, start:end], mco, mno)
+            steps[f] = (co[f].max(axis=0) - co[f].min(axis=0)) / 255.0
+        markers = [m.frame for m in context.scene.timeline_markers]
+        kept, error = reduce_frames(co, steps,
+                                    anim_starts(names, frames, markers),
+                                    tolerance)
+        operator.report({'INFO'}, "Kept %d of %d frames (%s), max error "
+                        "%.2f steps" % (len(kept), len(frames),
+                                        frame_ranges([frames[f] for f in kept]),
+                                        error))
+        table = frame_table_path(filepath)
+        mdl.companions.append((table, frame_table([frames[f] for f in kept],
+                                                  [names[f] for f in kept])))
+        operator.report({'INFO'}, "Frames renumbered, see %s"
+                        % os.path.basename(table))
+        mdl.begin_write(filepath)
+        try:
+            mdl.write_header(len(kept), offsets[-1])
+            frame = MD2.Frame()
+            for n, f in enumerate(kept):
+                yield ("Writing", n, len(kept))
+                frame.name = names[f]
+                frame.quantize(co[f], ni[f])
+                frame.write(mdl)
+        except BaseException:
+            mdl.end_write(False)
+            raise
+        mdl.end_write()
+        del co, ni, data
+
 def export_md2(
     operator,
     context,
     filepath = "",
-    xform = True
+    xform = True,
+    workers = 0,
+    use_cache = False,
+    use_atlas = False,
+    use_reduce = False,
+    reduce_tolerance = 1.0,
+    objects = None,
+    sweep = None
     ):
 
     print("Start MD2 Export...\n")
 
     meshes = []
-    objects = context.selected_objects
+    if objects is None:
+        objects = context.selected_objects
     for i in range(len(objects)):
+        yield ("Preparing", i, len(objects))
         print("Object name: " + str(objects[i].name))
         bpy.ops.object.select_all(action='DESELECT')
         objects[i].select_set(True)
@@ -146,27 +204,54 @@ def export_md2(
         if i == 0:
             mdl = MD2(objects[0].name)
             mdl.obj = objects[0]
-            make_skin(operator, mdl, mesh)
-    mdl.tris, mdl.stverts = build_tris(meshes)
+            if not use_atlas:
+                make_skin(operator, mdl, mesh)
+    atlas = None
+    if use_atlas:
+        # every material's image packed into one skin, saved next to the
+        # model
+        atlas = Atlas(objects)
+        if not atlas.fits():
+            operator.report({'WARNING'}, "%dx%d atlas, larger than quake 2 "
+                            "skins may be" % atlas.size)
+        mdl.skinwidth, mdl.skinheight = atlas.size
+        path = os.path.splitext(filepath)[0] + "_atlas.png"
+        mdl.skins = [MD2.Skin(os.path.basename(path))]
+        mdl.companions.append((path, atlas.save))
+    mdl.tris, mdl.stverts = build_tris(mdl, meshes, atlas)
+    # every object's vertices are exported, one after the other
+    offsets = np.cumsum([0] + [len(mesh.vertices) for mesh in meshes])
+    for obj in objects:
+        obj.evaluated_get(depsgraph).to_mesh_clear()
+    del meshes
 
-    if not mdl.frames:
-        for fno in range(context.scene.frame_start, context.scene.frame_end + 1):
-            context.scene.frame_set(fno)
-            frame = MD2.Frame()
+    frames = range(context.scene.frame_start, context.scene.frame_end + 1)
+    matrices = [mdl.obj] * len(objects) if xform else None
+    sweep = yield from make_sweep(operator, context, objects, frames,
+                                  matrices, workers, use_cache, sweep)
+    if use_reduce:
+        yield from write_reduced(operator, context, mdl, filepath, sweep,
+                                 frames, offsets, reduce_tolerance)
+        return {'FINISHED'}
+
+    # MD2 frames are self-contained, so each frame is written as soon as
+    # it's captured and only one frame is ever held in memory
+    co = np.empty((offsets[-1], 3), dtype=np.float32)
+    ni = np.empty(offsets[-1], dtype=np.uint8)
+    frame = MD2.Frame()
+    mdl.begin_write(filepath)
+    try:
+        mdl.write_header(len(frames), offsets[-1])
+        for f, (fno, verts) in enumerate(sweep):
+            yield ("Frames", f, len(frames))
+            for i, (mco, mno) in enumerate(verts):
+                start, end = offsets[i], offsets[i + 1]
+                make_frame(co[start:end], ni[start:end], mco, mno)
             frame.name = name_frame(fno)
-            for i in range(len(objects)):
-                objects[i].update_from_editmode()
-                depsgraph = context.evaluated_depsgraph_get()
-                ob_eval = objects[i].evaluated_get(depsgraph)
-                mesh = ob_eval.to_mesh()
-                if xform:
-                    mesh.transform(mdl.obj.matrix_world)
-                    mesh.calc_normals_split()
-                make_frame(frame, mesh)
-            frame.calc_scale()
-            frame.scale_verts()
-            mdl.frames.append(frame)
-
-    convert_stverts(mdl, mdl.stverts)
-    mdl.write(filepath)
+            frame.quantize(co, ni)
+            frame.write(mdl)
+    except BaseException:
+        mdl.end_write(False)
+        raise
+    mdl.end_write()
     return {'FINISHED'}
@@ -21,69 +21,66 @@
 
 import bpy
 from mathutils import Vector,Matrix
+import numpy as np
 
+from ..quakenorm import decode_anorms, set_custom_normals
+from ..cache import data_hash, file_hash, tag, find, link_mesh, copy_settings, set_frame_range, new_skin, cached_keys
+from ..batch import decoded
+from ..progress import Snapshot
 from .md2 import MD2
 
+def frame_verts(frame: MD2.Frame):
+    s = np.array(frame.scale, dtype=np.float32)
+    o = np.array(frame.translate, dtype=np.float32)
+    return frame.verts['r'] * s + o
+
 def make_verts(mdl: MD2, framenum: int):
-    frame: MD2.Frame = mdl.frames[framenum]
-    verts = []
-    s = Vector(frame.scale)
-    o = Vector(frame.translate)
-    m = Matrix(((s.x,  0,  0,o.x),
-                (  0,s.y,  0,o.y),
-                (  0,  0,s.z,o.z),
-                (  0,  0,  0,  1)))
-    for v in frame.verts:
-        verts.append(m @ Vector(v.r))
-    return verts
+    return frame_verts(mdl.frames[framenum])
+
+def make_normals(mdl: MD2, framenum: int):
+    return decode_anorms(mdl.frames[framenum].verts['ni'])
 
 def make_faces(mdl: MD2):
-    faces = []
-    uvs = []
-    for tri in mdl.tris:
-        tv = list(tri.verts)
-        sts = []
-        for v in tri.tcs:
-            stv = mdl.stverts[v]
-            s = stv.s
-            t = stv.t
-            # quake textures are top to bottom, but blender images
-            # are bottom to top
-            sts.append((s / mdl.skinwidth, 1 - (t / mdl.skinheight)))
-        # blender's and quake's vertex order seem to be opposed
-        tv.reverse()
-        sts.reverse()
-        # annoyingly, blender can't have 0 in the final vertex, so rotate the
-        # face vertices and uvs
-        if not tv[2]:
-            tv = [tv[2]] + tv[:2]
-            sts = [sts[2]] + sts[:2]
-        faces.append(tv)
-        uvs.append(sts)
+    st = mdl.stverts[mdl.tris['tcs']]
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    uvs = np.stack((st['s'] / np.float32(mdl.skinwidth),
+                    1 - st['t'] / np.float32(mdl.skinheight)), axis=-1)
+    # blender's and quake's vertex order seem to be opposed
+    faces = mdl.tris['verts'][:, ::-1]
+    uvs = uvs[:, ::-1]
+    # annoyingly, blender can't have 0 in the final vertex, so rotate the
+    # face vertices and uvs
+    rot = faces[:, 2] == 0
+    faces = np.where(rot[:, None], np.roll(faces, 1, axis=1), faces)
+    uvs = np.where(rot[:, None, None], np.roll(uvs, 1, axis=1), uvs)
     return faces, uvs
 
 def load_skins(mdl: MD2):
     def load_skin(skin: MD2.Skin):
-        img = bpy.data.images.new(skin.name, mdl.skinwidth, mdl.skinheight)
+        # the skins are external files, so the name is the data
+        skin.key = data_hash(skin.name,
+                             "%dx%d" % (mdl.skinwidth, mdl.skinheight))
+        img = mdl.cache and find(bpy.data.images, skin.key)
+        if img:
+            mdl.images.append(img)
+            return
+        # the real skin isn't loaded, so this is just a black placeholder,
+        # and not worth a file in the skin cache
+        storage = mdl.skin_storage
+        if storage == 'CACHE':
+            storage = 'GENERATED'
+        pixels = bytes(mdl.skinwidth * mdl.skinheight)
+        img = new_skin(skin.name, skin.key, mdl.skinwidth, mdl.skinheight,
+                       pixels, ((0, 0, 0),), storage)
         mdl.images.append(img)
-        p = [0.0] * mdl.skinwidth * mdl.skinheight * 4
-        for j in range(mdl.skinheight):
-            for k in range(mdl.skinwidth):
-                l = ((mdl.skinheight - 1 - j) * mdl.skinwidth + k) * 4
-                p[l + 0] = 0
-                p[l + 1] = 0
-                p[l + 2] = 0
-                p[l + 3] = 1.0
-        img.pixels[:] = p[:]
-        img.pack()
-        img.use_fake_user = True
 
     mdl.images=[]
     for i, skin in enumerate(mdl.skins):
         load_skin(skin)
 
-def setup_main_material(mdl: MD2):
-    mat = bpy.data.materials.new(mdl.name)
+def setup_main_material(mdl: MD2, key):
+    mat = tag(bpy.data.materials.new(mdl.name), key)
     mat.blend_method = 'OPAQUE'
     mat.diffuse_color = (1, 1, 1, 1)
     mat.metallic = 1
@@ -95,15 +92,16 @@ def setup_main_material(mdl: MD2):
 def setup_skins(mdl: MD2, uvs):
     load_skins(mdl)
     uvloop = mdl.mesh.uv_layers.new(name = mdl.name)
-    for i in range(len(mdl.mesh.polygons)):
-        poly = mdl.mesh.polygons[i]
-        mdl_uv = uvs[i]
-        for j,k in enumerate(poly.loop_indices):
-            uvloop.data[k].uv = mdl_uv[j]
+    # from_pydata creates the loops in face order
+    uvloop.data.foreach_set("uv", uvs.ravel())
 
     #Load all skins
     for i, skin in enumerate(mdl.skins):
-        mat = setup_main_material(mdl)
+        mat = mdl.cache and find(bpy.data.materials, skin.key)
+        if mat:
+            mdl.mesh.materials.append(mat)
+            continue
+        mat = setup_main_material(mdl, skin.key)
 
         # TODO: turn transform to True and position it properly in editor
         emissionNode = mat.node_tree.nodes.new("ShaderNodeEmission")
@@ -128,14 +126,7 @@ def make_shape_key(mdl: MD2, framenum):
     frame.key = mdl.obj.shape_key_add(name=frame.name)
     frame.key.value = 0.0
     mdl.keys.append(frame.key)
-    s = Vector(frame.scale)
-    o = Vector(frame.translate)
-    m = Matrix(((s.x,  0,  0,o.x),
-                (  0,s.y,  0,o.y),
-                (  0,  0,s.z,o.z),
-                (  0,  0,  0,  1)))
-    for i, v in enumerate(frame.verts):
-        frame.key.data[i].co = m @ Vector(v.r)
+    frame.key.data.foreach_set("co", frame.co.ravel())
 
 def build_shape_keys(mdl):
     mdl.keys = []
@@ -147,6 +138,7 @@ def build_shape_keys(mdl):
         frame = mdl.frames[i]
         make_shape_key(mdl, i)
         bpy.context.scene.frame_end += 1
+        yield ("%s: frames" % mdl.name, i + 1, len(mdl.frames))
 
     bpy.context.scene.frame_start = 1
 
@@ -182,35 +174,99 @@ def build_actions(mdl):
         track.strips.new(act.name, start_frame, act)
         start_frame += 1
 
-def import_md2(operator, context, filepath):
-    bpy.context.preferences.edit.use_global_undo = False
-
-    for obj in bpy.context.scene.collection.objects:
-        obj.select_set(False)
+def import_cached(context, filepath, key):
+    mesh = find(bpy.data.meshes, key)
+    if not mesh:
+        return False
+    name = filepath.split('/')[-1].split('.')[0]
+    obj = link_mesh(context, name, mesh)
+    copy_settings(obj, "qfmd2")
+    set_frame_range(context, mesh)
+    return True
 
+def decode_md2(filepath, cached=()):
+    # runs in an import thread: no bpy allowed
     mdl = MD2()
-    if not mdl.read(filepath):
-        operator.report({'ERROR'},
-            "Unrecognized format: %s %d" % (mdl.ident, mdl.version))
-        return {'CANCELLED'}
-    faces, uvs = make_faces(mdl)
-    verts = make_verts(mdl, 0)
-    mdl.mesh = bpy.data.meshes.new(mdl.name)
-    mdl.mesh.from_pydata(verts, [], faces)
+    mdl.filepath = filepath
+    mdl.key = None
+    mdl.decoded = False
+    mdl.error = None
+    try:
+        mdl.key = file_hash(filepath)
+        if mdl.key in cached:
+            return mdl
+        if not mdl.read(filepath):
+            mdl.error = "Unrecognized format: %s %d" % (mdl.ident,
+                                                          mdl.version)
+            return mdl
+        mdl.faces, mdl.uvs = make_faces(mdl)
+        mdl.verts = make_verts(mdl, 0)
+        mdl.normals = make_normals(mdl, 0)
+        for frame in mdl.frames:
+            frame.co = frame_verts(frame)
+        mdl.decoded = True
+    except Exception as err:
+        # a damaged file fails on its own, without stopping the rest of a
+        # multi-file import
+        mdl.error = "%s: %s" % (type(err).__name__, err)
+    return mdl
+
+def build_md2(operator, context, mdl: MD2, cache, skin_storage, skin_cache):
+    if (not mdl.error and cache
+            and import_cached(context, mdl.filepath, mdl.key)):
+        return True
+    if not mdl.decoded and not mdl.error:
+        # it was cached when the import started, but isn't now
+        mdl = decode_md2(mdl.filepath)
+    if mdl.error:
+        operator.report({'ERROR'}, "%s: %s" % (mdl.filepath, mdl.error))
+        return False
+    mdl.cache = cache
+    mdl.skin_storage = skin_storage
+    mdl.skin_cache = skin_cache
+    mdl.mesh = tag(bpy.data.meshes.new(mdl.name), mdl.key)
+    mdl.mesh.from_pydata(mdl.verts.tolist(), [], mdl.faces.tolist())
+    set_custom_normals(mdl.mesh, mdl.normals)
     mdl.obj = bpy.data.objects.new(mdl.name, mdl.mesh)
 
     bpy.context.scene.collection.objects.link(mdl.obj)
     mdl.obj.select_set(True)
     bpy.context.view_layer.objects.active = mdl.obj
-    setup_skins(mdl, uvs)
+    setup_skins(mdl, mdl.uvs)
 
     bpy.context.scene.frame_start = 1
     bpy.context.scene.frame_end = 1
     if len(mdl.frames) > 1:
-        build_shape_keys(mdl)
+        yield from build_shape_keys(mdl)
         build_actions(mdl)
 
     mdl.mesh.update()
+    return True
+
+def import_md2(operator, context, filepath = "", cache = True,
+               skin_storage = 'PACK', skin_cache = "", filepaths = ()):
+    bpy.context.preferences.edit.use_global_undo = False
+
+    for obj in bpy.context.scene.collection.objects:
+        obj.select_set(False)
 
-    bpy.context.preferences.edit.use_global_undo = True
-    return {'FINISHED'}
\ No newline at end of file
+    filepaths = filepaths or [filepath]
+    cached = cached_keys(bpy.data.meshes) if cache else set()
+    decode = lambda path: decode_md2(path, cached)
+    imported = 0
+    try:
+        for i, mdl in enumerate(decoded(filepaths, decode)):
+            yield ("Importing", i, len(filepaths))
+            # a cancelled or failed model is removed entirely; finished
+            # ones stay
+            snapshot = Snapshot()
+            try:
+                if (yield from build_md2(operator, context, mdl, cache,
+                                         skin_storage, skin_cache)):
+                    imported += 1
+            except BaseException:
+                snapshot.rollback()
+                raise
+    finally:
+        bpy.context.preferences.edit.use_global_undo = True
+    return {'FINISHED'} if imported else {'CANCELLED'}
@@ -20,10 +20,12 @@
 # <pep8 compliant>
 
 from struct import unpack, pack
+import numpy as np
 from mathutils import Vector
-from sys import maxsize
 
-class MD2:
+from ..safewrite import SafeWrite
+
+class MD2(SafeWrite):
     class Skin:
         def __init__(self, name=''):
             self.name = name
@@ -34,6 +36,7 @@ class MD2:
             mdl.write_path(self.name)
 
     class STVert:
+        dtype = np.dtype([('s', '<i2'), ('t', '<i2')])
         def __init__(self, st=None):
             if not st:
                 st = (0, 0)
@@ -46,6 +49,7 @@ class MD2:
             mdl.write_short((self.s, self.t))
 
     class Tri:
+        dtype = np.dtype([('verts', '<i2', 3), ('tcs', '<i2', 3)])
         def __init__(self, verts=None, tcs=None):
             if not verts:
                 verts = (0, 0, 0)
@@ -67,22 +71,18 @@ class MD2:
             self.translate = [0, 0, 0]
             self.name = ""
             self.verts = []
-        def add_vert(self, vert: 'Vert'):
-            self.verts.append(vert)
-        def calc_scale(self):
-            # only used for writing
-            mins = [maxsize, maxsize, maxsize]
-            maxs = [-(maxsize - 1), -(maxsize - 1), -(maxsize - 1)]
-
-            for vert in self.verts:
-                for i, v in enumerate(vert.r):
-                    mins[i] = min(mins[i], v)
-                    maxs[i] = max(maxs[i], v)
-            self.scale = tuple(map(lambda x: x / 255.0, (Vector(maxs) - Vector(mins))))
-            self.translate = mins
-        def scale_verts(self):
-            for vert in self.verts:
-                vert.scale(self)
+        def quantize(self, co, ni):
+            # only used for writing: co is the (verts, 3) positions in
+            # blender units, ni the normal indices
+            mins = co.min(axis=0).astype(np.float64)
+            maxs = co.max(axis=0).astype(np.float64)
+            self.scale = tuple(map(float, (maxs - mins) / 255.0))
+            self.translate = tuple(map(float, mins))
+            s = np.array(self.scale)
+            s[s == 0] = 1       # flat along that axis
+            self.verts = np.empty(len(co), dtype=MD2.Vert.dtype)
+            self.verts['r'] = ((co - mins) / s).astype(np.int64) & 255
+            self.verts['ni'] = ni
         def read(self, mdl: 'MD2', numverts):
             self.read_bounds(mdl)
             self.read_name(mdl)
@@ -106,14 +106,12 @@ class MD2:
             mdl.write_float(self.scale)
             mdl.write_float(self.translate)
         def read_verts(self, mdl: 'MD2', num):
-            self.verts = []
-            for i in range(num):
-                self.verts.append(MD2.Vert().read(mdl))
+            self.verts = mdl.read_array(MD2.Vert.dtype, num)
         def write_verts(self, mdl: 'MD2'):
-            for vert in self.verts:
-                vert.write(mdl)
+            mdl.write_array(self.verts)
 
     class Vert:
+        dtype = np.dtype([('r', 'u1', 3), ('ni', 'u1')])
         def __init__(self, r=None, ni=0):
             if not r:
                 r = (0, 0, 0)
@@ -128,9 +126,6 @@ class MD2:
             r = tuple(map(lambda a: int(a) & 255, self.r))
             mdl.write_byte(r)
             mdl.write_byte(self.ni)
-        def scale(self, frame):
-            self.r = tuple(map(lambda x, s, t: (x - t) / s,
-                               self.r, frame.scale, frame.translate))
 
     def read_byte(self, count=1):
         size = 1 * count
@@ -167,6 +162,10 @@ class MD2:
     def read_bytes(self, size):
         return self.file.read(size)
 
+    def read_array(self, dtype, count):
+        data = self.file.read(dtype.itemsize * count)
+        return np.frombuffer(data, dtype=dtype, count=count)
+
     def read_string(self, size):
         data = self.file.read(size)
         s = ""
@@ -194,6 +193,9 @@ class MD2:
             data = (data,)
         self.file.write(pack(("<%df" % len(data)), *data))
 
+    def write_array(self, data):
+        self.file.write(np.ascontiguousarray(data).tobytes())
+
     def write_bytes(self, data, size=-1):
         if size == -1:
             size = len(data)
@@ -225,6 +227,7 @@ class MD2:
         self.stverts = []
         self.tris = []
         self.frames = []
+        self.companions = []    # see SafeWrite
 
     def read(self, filepath):
         self.file = open(filepath, "rb")
@@ -245,35 +248,32 @@ class MD2:
         for i in range(numskins):
             self.skins.append(MD2.Skin().read(self))
         #read in the st verts (uv map)
-        self.stverts = []
         self.file.seek(ofst)
-        for i in range(numst):
-            self.stverts.append(MD2.STVert().read(self))
+        self.stverts = self.read_array(MD2.STVert.dtype, numst)
         #read in the tris
-        self.tris = []
         self.file.seek(oftris)
-        for i in range(numtris):
-            self.tris.append(MD2.Tri().read(self))
+        self.tris = self.read_array(MD2.Tri.dtype, numtris)
         #read in the frames
         self.frames = []
         self.file.seek(offrames)
         for i in range(numframes):
             self.frames.append(MD2.Frame().read(self, numverts))
+        self.file.close()
         return self
 
-    def write(self, filepath):
-        self.file = open(filepath, "wb")
+    def write_header(self, numframes, numverts):
+        # everything up to the frames, which follow in order
         self.write_string(self.ident, 4)
         self.write_int(self.version)
         self.write_int((self.skinwidth, self.skinheight))
-        framesize = 40 + (4 * len(self.frames[0].verts))
+        framesize = 40 + (4 * numverts)
         self.write_int(framesize)
         self.write_int(len(self.skins))
-        self.write_int(len(self.frames[0].verts))
+        self.write_int(numverts)
         self.write_int(len(self.stverts))
         self.write_int(len(self.tris))
         self.write_int(0)
-        self.write_int(len(self.frames))
+        self.write_int(numframes)
         pos = self.file.tell() + (6 * 4)
         self.write_int(pos) # skin offset
         pos += 64 * len(self.skins)
@@ -282,19 +282,25 @@ class MD2:
         self.write_int(pos) # tris offset
         pos += 12 * len(self.tris)
         self.write_int(pos) # frame offset
-        pos += framesize * len(self.frames)
+        pos += framesize * numframes
         self.write_int(pos) # glcmds
         self.write_int(pos) # end
         # write out the skin data
         for skin in self.skins:
             skin.write(self)
         #write out the st verts (uv map)
-        for st in self.stverts:
-            st.write(self)
+        self.write_array(self.stverts.astype(MD2.STVert.dtype))
         #write out the tris
-        for tri in self.tris:
-            tri.write(self)
-        #write out the frames
-        for frame in self.frames:
-            frame.write(self)
-        self.file.close()
+        self.write_array(self.tris.astype(MD2.Tri.dtype))
+
+    def write(self, filepath):
+        self.begin_write(filepath)
+        try:
+            self.write_header(len(self.frames), len(self.frames[0].verts))
+            #write out the frames
+            for frame in self.frames:
+                frame.write(self)
+        except BaseException:
+            self.end_write(False)
+            raise
+        self.end_write()
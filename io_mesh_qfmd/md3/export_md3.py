@@ -19,125 +19,351 @@
 
 # <pep8 compliant>
 
+import os
+
 import bpy
 from bpy_extras.object_utils import object_data_add
 from mathutils import Vector,Matrix
+import numpy as np
 
-from ..quakenorm import encode_md3_normal
+from ..quakenorm import encode_md3_normals
+from ..capture import make_sweep, mesh_loops, tri_materials
+from ..decimate import simplify
+from ..atlas import material_image
+from ..keyframes import reduce_frames, anim_starts, frame_ranges
+from ..keyframes import frame_table, frame_table_path
 from .md3 import *
 
-def make_shader(operator, surface, mesh):
-    materials = bpy.context.object.data.materials
+# Q3's renderer draws a surface in one batch, and can't take more than
+# SHADER_MAX_VERTEXES vertices or SHADER_MAX_INDEXES / 3 triangles at once.
+MAX_VERTS = 1000
+MAX_TRIS = 2000
+
+def slot_shaders(obj):
+    # the shader (image name) of each material slot, "" where there is none
+    shaders = []
+    for slot in obj.material_slots:
+        image = material_image(slot.material)
+        shaders.append(image.name if image else "")
+    return shaders or [""]
+
+def first_use(keys):
+    # the first occurrence of each distinct row of keys, in order of first
+    # use, and the index of each row's distinct value in that order
+    _, first, inverse = np.unique(keys, axis=0, return_index=True,
+                                  return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.ravel()]
+
+def gather_tris(objects, meshes):
+    # every triangle of every mesh: its corners' vertices (numbered across
+    # all the meshes), their md3 uvs, its shader and its object
+    verts, uvs, shaders, objs = [], [], [], []
+    names = {}
+    offset = 0
+    for i, (obj, mesh) in enumerate(zip(objects, meshes)):
+        loops, loop_verts, uv = mesh_loops(mesh)
+        slots = [names.setdefault(name, len(names))
+                 for name in slot_shaders(obj)]
+        material = np.minimum(tri_materials(mesh), len(slots) - 1)
+        uv = uv[loops] + 0.0     # no -0, which would be another uv
+        uv[:, 1] = 1 - uv[:, 1]
+        verts.append((loop_verts[loops] + offset).reshape(-1, 3))
+        uvs.append(uv.reshape(-1, 3, 2))
+        shaders.append(np.array(slots, dtype=np.int64)[material])
+        objs.append(np.full(len(material), i, dtype=np.int64))
+        offset += len(mesh.vertices)
+    names = sorted(names, key=names.get)
+    if not verts:
+        return (np.empty((0, 3), np.int64), np.empty((0, 3, 2), np.float32),
+                np.empty(0, np.int64), np.empty(0, np.int64), names)
+    return (np.concatenate(verts), np.concatenate(uvs),
+            np.concatenate(shaders), np.concatenate(objs), names)
+
+def components(tris, num_verts):
+    # connected component of each vertex, by hooking roots onto the
+    # smaller of each edge's roots and pointer jumping until no edge
+    # crosses components
+    parent = np.arange(num_verts)
+    a = tris.ravel()
+    b = tris[:, [1, 2, 0]].ravel()
+    while True:
+        ra, rb = parent[a], parent[b]
+        cross = ra != rb
+        if not cross.any():
+            return parent
+        np.minimum.at(parent, np.maximum(ra, rb)[cross],
+                      np.minimum(ra, rb)[cross])
+        while True:
+            up = parent[parent]
+            if np.array_equal(up, parent):
+                break
+            parent = up
 
-    if not len(materials):
-        return
+def split_tris(tris, num_verts, max_verts, max_tris):
+    # triangle index lists within the limits. Connected components are kept
+    # whole and packed together where they fit; a component too big on its
+    # own is cut in halves, in triangle order, until the pieces fit.
+    def fits(t):
+        return (len(t) <= max_tris
+                and len(np.unique(tris[t])) <= max_verts)
 
-    for mat in materials:
-        allTextureNodes = list(filter(lambda node: node.type == "TEX_IMAGE", mat.node_tree.nodes))
-        if len(allTextureNodes) != 1:
+    def pieces(t):
+        if len(t) <= 1 or fits(t):
+            return [t]
+        half = len(t) // 2
+        return pieces(t[:half]) + pieces(t[half:])
+
+    if len(tris) <= max_tris and num_verts <= max_verts:
+        return [np.arange(len(tris))]
+    comp = components(tris, num_verts)[tris[:, 0]]
+    order = np.argsort(comp, kind='stable')
+    bounds = np.flatnonzero(np.diff(comp[order])) + 1
+    chunks = []
+    current, nverts, ntris = [], 0, 0
+    for part in np.split(order, bounds):
+        for piece in pieces(part):
+            pverts = len(np.unique(tris[piece]))
+            if current and (ntris + len(piece) > max_tris
+                            or nverts + pverts > max_verts):
+                chunks.append(np.sort(np.concatenate(current)))
+                current, nverts, ntris = [], 0, 0
+            current.append(piece)
+            nverts += pverts
+            ntris += len(piece)
+    if current:
+        chunks.append(np.sort(np.concatenate(current)))
+    return chunks
+
+def build_surfaces(objects, meshes, max_verts=MAX_VERTS, max_tris=MAX_TRIS):
+    # one surface per shader, whatever objects and material slots use it,
+    # split where it goes over the limits. Returns the surfaces and, for
+    # each, the vertex (numbered across all meshes) of each md3 vertex.
+    verts, uvs, shaders, objs, names = gather_tris(objects, meshes)
+    surfaces = []
+    vertlists = []
+    used = set()
+    for shader in range(len(names)):
+        group = np.flatnonzero(shaders == shader)
+        if not len(group):
             continue
-        node = allTextureNodes[0]
-        if node.type == "TEX_IMAGE":
-            image = node.image
-            skin = image.name
-            surface.shaders.append(MD3Shader(skin))
-
-def build_tris(mesh, surface: MD3Surface):
-    vertlist = []
-
-    for face in mesh.polygons:
-        ntri = MD3Triangle([ 0, 0, 0 ])
-        l_i = face.loop_indices
-        for v,vert_index in enumerate(face.vertices):
-            uv_map = mesh.uv_layers.active.data[l_i[v]].uv ## UNWRAP ## see log for details ##
-            uv = (uv_map.x, 1.0 - uv_map.y)
-            match = 0
-            match_index = 0
-            for i,vi in enumerate(vertlist):
-                if vi == vert_index:
-                    if surface.texcoords[i].st == uv:
-                        match = 1
-                        match_index = i
-            if match == 0:
-                ntri.v[v] = len(vertlist) ## TRIANGULATE ## see log for details ##
-                ntex = MD3TexCoord(uv)
-                surface.texcoords.append(ntex)
-                vertlist.append(vert_index)
-            else:
-                ntri.v[v] = match_index
-        ntri.v = (ntri.v[0], ntri.v[2], ntri.v[1])
-        surface.triangles.append(ntri)
-
-    return vertlist
-
-def make_surface(surface, mesh, vertlist):
-    for vi in vertlist:
-        mv = mesh.vertices[vi]
-        surface.verts.append(MD3Vertex(tuple(mv.co), encode_md3_normal(mv.normal)))
-
-def name_frame(frame_number):
-    if bpy.context.object.data.shape_keys:
-        shape_keys_amount = len(bpy.context.object.data.shape_keys.key_blocks)
-        if shape_keys_amount > frame_number:
-            return bpy.context.object.data.shape_keys.key_blocks[frame_number].name
+        # one md3 vertex per (vertex, uv)
+        keys = np.concatenate((verts[group].reshape(-1, 1),
+                               uvs[group].reshape(-1, 2).view(np.int32)),
+                              axis=1)
+        first, tris = first_use(keys)
+        tris = tris.reshape(-1, 3)
+        chunks = split_tris(tris, len(first), max_verts, max_tris)
+        for chunk in chunks:
+            vfirst, ctris = first_use(tris[chunk].reshape(-1, 1))
+            # the corner of the group each of the chunk's vertices came from
+            corner = first[tris[chunk].ravel()[vfirst]]
+            name = objects[objs[group[chunk[0]]]].name
+            base, n = name, 0
+            while name in used:
+                n += 1
+                name = "%s_%d" % (base, n)
+            used.add(name)
+            surf = MD3Surface(name)
+            if names[shader]:
+                surf.shaders.append(MD3Shader(names[shader]))
+            surf.triangles = np.zeros(len(chunk), dtype=MD3Triangle.dtype)
+            surf.triangles['v'] = ctris.reshape(-1, 3)
+            surf.texcoords = np.zeros(len(corner), dtype=MD3TexCoord.dtype)
+            surf.texcoords['st'] = uvs[group].reshape(-1, 2)[corner]
+            surfaces.append(surf)
+            vertlists.append(verts[group].ravel()[corner])
+    return surfaces, vertlists
+
+def make_surface(co, normal, mco, mno, vertlist):
+    # co and normal are the surface's vertex arrays for this frame
+    np.take(mco, vertlist, axis=0, out=co)
+    normal[:] = encode_md3_normals(np.take(mno, vertlist, axis=0))
+
+def scale_surface(surface, co, normal):
+    # co is (frames, verts, 3)
+    surface.verts = np.empty(co.shape[0] * co.shape[1], dtype=MD3Vertex.dtype)
+    xyz = (co.reshape(-1, 3) * MD3Vertex.Scale).astype(np.int64)
+    if np.any((xyz < -32768) | (xyz > 32767)):
+        raise ValueError("%s: vertices out of md3 range" % surface.name)
+    surface.verts['xyz'] = xyz
+    surface.verts['normal'] = normal.ravel()
+
+def name_frame(obj, frame_number):
+    # frames are named after obj's shape keys, where it has them
+    key = obj and obj.type == 'MESH' and obj.data.shape_keys
+    if key and len(key.key_blocks) > frame_number:
+        return key.key_blocks[frame_number].name
 
     return "frame" + str(frame_number)
 
+def frame_bounds(mdl, num_frames):
+    # per frame bounds of all surfaces, from the quantized positions so they
+    # enclose what the engine sees, and the radius of the sphere around
+    # their center
+    xyz = [surf.verts['xyz'].reshape(num_frames, -1, 3) / MD3Vertex.Scale
+           for surf in mdl.surfaces]
+    xyz = [c for c in xyz if c.shape[1]]
+    if not xyz:
+        zero = np.zeros((num_frames, 3))
+        return zero, zero, zero, np.zeros(num_frames)
+    mins = np.min([c.min(axis=1) for c in xyz], axis=0)
+    maxs = np.max([c.max(axis=1) for c in xyz], axis=0)
+    origin = (mins + maxs) / 2
+    radius = np.max([np.linalg.norm(c - origin[:, None], axis=2).max(axis=1)
+                     for c in xyz], axis=0)
+    return mins, maxs, origin, radius
+
+def make_frames(mdl, frames, obj):
+    mins, maxs, origin, radius = frame_bounds(mdl, len(frames))
+    for f, fno in enumerate(frames):
+        frame = MD3Frame(name_frame(obj, fno))
+        frame.min_bounds = tuple(map(float, mins[f]))
+        frame.max_bounds = tuple(map(float, maxs[f]))
+        frame.local_origin = tuple(map(float, origin[f]))
+        frame.radius = float(radius[f])
+        mdl.frames.append(frame)
+
+def lod_surface(surface, tris, co, normal):
+    # tris index the full resolution surface's vertices, whose frames are
+    # co and normal
+    used, tris = np.unique(tris, return_inverse=True)
+    # numpy 2 keeps the input's shape for the inverse, older ones flatten it
+    tris = tris.reshape(-1, 3)
+    lod = MD3Surface(surface.name)
+    lod.flags = surface.flags
+    lod.shaders = surface.shaders
+    lod.triangles = np.zeros(len(tris), dtype=MD3Triangle.dtype)
+    lod.triangles['v'] = tris
+    lod.texcoords = surface.texcoords[used]
+    scale_surface(lod, co[:, used], normal[:, used])
+    return lod
+
+def reduce_anim(operator, context, obj, frames, co, normal, tolerance):
+    # drops the frames the engine can lerp, from co and normal in place.
+    # md3 positions are quantized to a fixed 1/64 unit.
+    names = [name_frame(obj, fno) for fno in frames]
+    markers = [m.frame for m in context.scene.timeline_markers]
+    allco = np.concatenate(co, axis=1) if co else np.empty((len(frames), 0, 3))
+    steps = np.full((len(frames), 3), 1 / MD3Vertex.Scale)
+    kept, error = reduce_frames(allco, steps,
+                                anim_starts(names, frames, markers), tolerance)
+    del allco
+    for i in range(len(co)):
+        co[i] = co[i][kept]
+        normal[i] = normal[i][kept]
+    kept = [frames[f] for f in kept]
+    operator.report({'INFO'}, "Kept %d of %d frames (%s), max error %.2f steps"
+                    % (len(kept), len(frames), frame_ranges(kept), error))
+    return kept
+
 def export_md3(
     operator,
     context,
     filepath = "",
-    xform = True
+    xform = True,
+    workers = 0,
+    use_cache = False,
+    lods = 0,
+    lod_ratio = 0.5,
+    max_verts = MAX_VERTS,
+    max_tris = MAX_TRIS,
+    use_reduce = False,
+    reduce_tolerance = 1.0,
+    objects = None,
+    sweep = None
     ):
 
     print("Start MD3 Export...\n")
 
-    objects = context.selected_objects
+    if objects is None:
+        objects = context.selected_objects
     mdl = MD3(filepath)
 
+    # frames are named by the last object, as they always were
+    name_obj = objects[-1] if objects else None
+
     # set up surfaces
-    for obj in objects:
-        print("Surface name: " + str(obj.name))
-        bpy.ops.object.select_all(action='DESELECT')
-        obj.select_set(True)
-        context.view_layer.objects.active = obj
-        context.scene.frame_set(context.scene.frame_start)
-        obj.update_from_editmode()
-        depsgraph = context.evaluated_depsgraph_get()
-        ob_eval = obj.evaluated_get(depsgraph)
-        mesh = ob_eval.to_mesh()
-
-        surf = MD3Surface(obj.name)
-        surf.obj = obj
-
-        # set up shader, tris and texcoords
-        make_shader(operator, surf, mesh)
-        vertlist = build_tris(mesh, surf)
-        ob_eval.to_mesh_clear()
-
-        # build verts
-        for fno in range(context.scene.frame_start, context.scene.frame_end + 1):
-            context.scene.frame_set(fno)
+    frames = range(context.scene.frame_start, context.scene.frame_end + 1)
+    context.scene.frame_set(context.scene.frame_start)
+    evaluated = []
+    try:
+        for i, obj in enumerate(objects):
+            yield ("Preparing", i, len(objects))
             obj.update_from_editmode()
             depsgraph = context.evaluated_depsgraph_get()
-            ob_eval = obj.evaluated_get(depsgraph)
-            mesh = ob_eval.to_mesh()
-            if xform:
-                mesh.transform(obj.matrix_world)
-                mesh.calc_normals_split()
-            make_surface(surf, mesh, vertlist)
+            evaluated.append(obj.evaluated_get(depsgraph))
+        meshes = [ob_eval.to_mesh() for ob_eval in evaluated]
+        mdl.surfaces, vertlists = build_surfaces(objects, meshes,
+                                                 max_verts, max_tris)
+    finally:
+        for ob_eval in evaluated:
             ob_eval.to_mesh_clear()
+    operator.report({'INFO'}, "%d surfaces: %s" % (len(mdl.surfaces),
+                    ", ".join("%s %d/%d" % (surf.name, len(surf.texcoords),
+                                            len(surf.triangles))
+                              for surf in mdl.surfaces)))
+    if len(mdl.surfaces) > MaxSurfaces:
+        operator.report({'WARNING'}, "%d surfaces, more than the %d quake 3 "
+                        "loads" % (len(mdl.surfaces), MaxSurfaces))
 
-        mdl.surfaces.append(surf)
+    # build verts
+    co = [np.empty((len(frames), len(vl), 3), dtype=np.float32)
+          for vl in vertlists]
+    normal = [np.empty((len(frames), len(vl)), dtype=np.uint16)
+              for vl in vertlists]
+    matrices = objects if xform else None
+    sweep = yield from make_sweep(operator, context, objects, frames,
+                                  matrices, workers, use_cache, sweep)
+    for f, (fno, verts) in enumerate(sweep):
+        yield ("Frames", f, len(frames))
+        # surfaces take their vertices from any of the objects
+        mco = np.concatenate([v[0] for v in verts])
+        mno = np.concatenate([v[1] for v in verts])
+        for i, vertlist in enumerate(vertlists):
+            make_surface(co[i][f], normal[i][f], mco, mno, vertlist)
+    if use_reduce:
+        frames = reduce_anim(operator, context, name_obj, frames, co, normal,
+                             reduce_tolerance)
+    for i, surf in enumerate(mdl.surfaces):
+        scale_surface(surf, co[i], normal[i])
 
     # set up frames, since we need the bounds first anyways
-    for fno in range(context.scene.frame_start, context.scene.frame_end + 1):
-        mdl.frames.append(MD3Frame(name_frame(fno)))
-
-    # scale verts
-    for surf in mdl.surfaces:
-        for vert in surf.verts:
-            vert.xyz = tuple(map(lambda x: int(x * MD3Vertex.Scale), vert.xyz))
+    make_frames(mdl, frames, name_obj)
+    if use_reduce:
+        # the levels of detail have the same frames, so one table does
+        table = frame_table_path(filepath)
+        mdl.companions = [(table, frame_table(frames, [frame.name for frame
+                                                       in mdl.frames]))]
+        operator.report({'INFO'}, "Frames renumbered, see %s"
+                        % os.path.basename(table))
 
+    yield ("Writing", 0, 1)
     mdl.write(filepath)
+
+    # Levels of detail (model_1.md3, ...): each is decimated from the one
+    # before on the first frame, and the frames are gathered from the full
+    # resolution capture.
+    tris = [surf.triangles['v'].astype(np.int64) for surf in mdl.surfaces]
+    base, ext = os.path.splitext(filepath)
+    for lod in range(1, lods + 1):
+        yield ("Level of detail", lod, lods)
+        lodmdl = MD3(mdl.name)
+        before = sum(len(t) for t in tris)
+        for i, surf in enumerate(mdl.surfaces):
+            tris[i] = simplify(co[i][0], tris[i],
+                               int(len(tris[i]) * lod_ratio))
+            lodmdl.surfaces.append(lod_surface(surf, tris[i],
+                                               co[i], normal[i]))
+        # locked boundaries can keep a level from getting much smaller
+        after = sum(len(t) for t in tris)
+        ratio = after / max(before, 1)
+        level = 'INFO' if ratio <= lod_ratio * 1.1 else 'WARNING'
+        operator.report({level}, "Level of detail %d: %d of %d triangles "
+                        "(%.2f, asked for %.2f)"
+                        % (lod, after, before, ratio, lod_ratio))
+        make_frames(lodmdl, frames, name_obj)
+        lodmdl.write("%s_%d%s" % (base, lod, ext))
     return {'FINISHED'}
@@ -0,0 +1,132 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Vertex animation texture export: the first frame as a static md3, plus
+# position and normal textures holding every frame, for playing the
+# animation in a vertex shader. Texture column i is the i-th vertex of the
+# md3, counting through the surfaces in order; the bounds, frame rate and
+# each surface's first column are written to a json file next to the model.
+
+import json
+import os
+
+import numpy as np
+
+from ..quakenorm import encode_md3_normals
+from ..capture import make_sweep
+from .export_md3 import build_surfaces, scale_surface, make_frames, name_frame
+from .vat import pack_texels, write_dds, MaxWidth
+from .md3 import *
+
+def export_vat(
+    operator,
+    context,
+    filepath = "",
+    xform = True,
+    workers = 0,
+    use_cache = False,
+    vat_format = 'RGBA16F'
+    ):
+
+    objects = context.selected_objects
+    mdl = MD3(filepath)
+
+    name_obj = objects[-1] if objects else None
+
+    # set up surfaces, exactly as for md3
+    frames = range(context.scene.frame_start, context.scene.frame_end + 1)
+    context.scene.frame_set(context.scene.frame_start)
+    evaluated = []
+    try:
+        for i, obj in enumerate(objects):
+            yield ("Preparing", i, len(objects))
+            obj.update_from_editmode()
+            depsgraph = context.evaluated_depsgraph_get()
+            evaluated.append(obj.evaluated_get(depsgraph))
+        meshes = [ob_eval.to_mesh() for ob_eval in evaluated]
+        mdl.surfaces, vertlists = build_surfaces(objects, meshes)
+    finally:
+        for ob_eval in evaluated:
+            ob_eval.to_mesh_clear()
+    columns = np.cumsum([0] + [len(vl) for vl in vertlists])
+    if columns[-1] > MaxWidth:
+        operator.report({'ERROR'}, "%d vertices, more than the %d texels "
+                        "a texture row can hold" % (columns[-1], MaxWidth))
+        return {'CANCELLED'}
+    vertlist = np.concatenate(vertlists) if vertlists else np.empty(0, int)
+
+    # capture every frame of every vertex
+    co = np.empty((len(frames), columns[-1], 3), dtype=np.float32)
+    no = np.empty((len(frames), columns[-1], 3), dtype=np.float32)
+    matrices = objects if xform else None
+    sweep = yield from make_sweep(operator, context, objects, frames,
+                                  matrices, workers, use_cache)
+    for f, (fno, verts) in enumerate(sweep):
+        yield ("Frames", f, len(frames))
+        mco = np.concatenate([v[0] for v in verts])
+        mno = np.concatenate([v[1] for v in verts])
+        np.take(mco, vertlist, axis=0, out=co[f])
+        np.take(mno, vertlist, axis=0, out=no[f])
+
+    # the static mesh: the first frame
+    yield ("Writing", 0, 3)
+    for i, surf in enumerate(mdl.surfaces):
+        cols = slice(columns[i], columns[i + 1])
+        scale_surface(surf, co[:1, cols], encode_md3_normals(no[:1, cols]))
+    make_frames(mdl, frames[:1], name_obj)
+    mdl.write(filepath)
+
+    # the textures, normalized to the bounds of the whole animation
+    yield ("Writing", 1, 3)
+    if co.size:
+        mins = co.min(axis=(0, 1)).astype(np.float64)
+        maxs = co.max(axis=(0, 1)).astype(np.float64)
+    else:
+        mins = maxs = np.zeros(3)
+    extent = np.where(maxs > mins, maxs - mins, 1)
+    base = os.path.splitext(filepath)[0]
+    write_dds(base + "_pos.dds", pack_texels((co - mins) / extent, vat_format),
+              vat_format)
+    write_dds(base + "_norm.dds", pack_texels(no * 0.5 + 0.5, vat_format),
+              vat_format)
+
+    yield ("Writing", 2, 3)
+    render = context.scene.render
+    info = {
+        "model": os.path.basename(filepath),
+        "positions": os.path.basename(base + "_pos.dds"),
+        "normals": os.path.basename(base + "_norm.dds"),
+        "format": vat_format,
+        "frames": len(frames),
+        "vertices": int(columns[-1]),
+        "fps": render.fps / render.fps_base,
+        "bounds_min": mins.tolist(),
+        "bounds_max": maxs.tolist(),
+        "frame_names": [name_frame(name_obj, fno) for fno in frames],
+        "surfaces": [{"name": surf.name, "first_column": int(columns[i]),
+                      "columns": int(columns[i + 1] - columns[i])}
+                     for i, surf in enumerate(mdl.surfaces)],
+    }
+    with open(base + "_vat.json", "w") as f:
+        json.dump(info, f, indent=1)
+    operator.report({'INFO'}, "%d frames of %d vertices in %s textures"
+                    % (len(frames), columns[-1], vat_format))
+    return {'FINISHED'}
@@ -21,63 +21,62 @@
 
 import bpy
 from mathutils import Vector,Matrix
+import numpy as np
 
+from ..quakenorm import decode_md3_normals, set_custom_normals
+from ..cache import data_hash, file_hash, tag, find, link_mesh, copy_settings, set_frame_range, new_skin, cached_keys
+from ..batch import decoded
+from ..progress import Snapshot
 from .md3 import MD3, MD3Frame, MD3Shader, MD3Surface, MD3TexCoord, MD3Triangle, MD3Vertex
 
-def make_verts(mdl: MD3, surf: MD3Surface, framenum: int):
+def frame_verts(mdl: MD3, surf: MD3Surface, framenum: int):
     num_verts = len(surf.verts) // len(mdl.frames)
     verts_start = framenum * num_verts
     verts_end = verts_start + num_verts
-    verts = []
-    for i in range(verts_start, verts_end):
-        verts.append(list(map(lambda x: x / MD3Vertex.Scale, surf.verts[i].xyz)))
-    return verts
+    return surf.verts[verts_start:verts_end]
+
+def make_normals(mdl: MD3, surf: MD3Surface, framenum: int):
+    return decode_md3_normals(frame_verts(mdl, surf, framenum)['normal'])
 
 def make_faces(surf: MD3Surface):
-    faces = []
-    uvs = []
-    tri: MD3Triangle
-    for tri in surf.triangles:
-        tv = list(tri.v)
-        sts = [ list(surf.texcoords[tv[0]].st), list(surf.texcoords[tv[1]].st), list(surf.texcoords[tv[2]].st) ]
-        for st in sts:
-            # quake textures are top to bottom, but blender images
-            # are bottom to top
-            st[1] = 1 - st[1]
-        # blender's and quake's vertex order seem to be opposed
-        tv.reverse()
-        sts.reverse()
-        # annoyingly, blender can't have 0 in the final vertex, so rotate the
-        # face vertices and uvs
-        if not tv[2]:
-            tv = [tv[2]] + tv[:2]
-            sts = [sts[2]] + sts[:2]
-        faces.append(tv)
-        uvs.append(sts)
+    tv = surf.triangles['v']
+    uvs = surf.texcoords['st'][tv]
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    uvs[..., 1] = 1 - uvs[..., 1]
+    # blender's and quake's vertex order seem to be opposed
+    faces = tv[:, ::-1]
+    uvs = uvs[:, ::-1]
+    # annoyingly, blender can't have 0 in the final vertex, so rotate the
+    # face vertices and uvs
+    rot = faces[:, 2] == 0
+    faces = np.where(rot[:, None], np.roll(faces, 1, axis=1), faces)
+    uvs = np.where(rot[:, None, None], np.roll(uvs, 1, axis=1), uvs)
     return faces, uvs
 
 def load_skins(mdl: MD3, surf: MD3Surface):
     def load_skin(skin: MD3Shader):
-        img = bpy.data.images.new(skin.name, 1, 1)
+        # the shaders are external, so the name is the data
+        skin.key = data_hash(skin.name)
+        img = mdl.cache and find(bpy.data.images, skin.key)
+        if img:
+            surf.images.append(img)
+            return
+        # the real skin isn't loaded, so this is just a black placeholder,
+        # and not worth a file in the skin cache
+        storage = mdl.skin_storage
+        if storage == 'CACHE':
+            storage = 'GENERATED'
+        img = new_skin(skin.name, skin.key, 1, 1, bytes(1), ((0, 0, 0),),
+                       storage)
         surf.images.append(img)
-        p = [0.0] * 1 * 1 * 4
-        for j in range(1):
-            for k in range(1):
-                l = ((1 - 1 - j) * 1 + k) * 4
-                p[l + 0] = 0
-                p[l + 1] = 0
-                p[l + 2] = 0
-                p[l + 3] = 1.0
-        img.pixels[:] = p[:]
-        img.pack()
-        img.use_fake_user = True
 
     surf.images=[]
     for i, skin in enumerate(surf.shaders):
         load_skin(skin)
 
 def setup_main_material(mdl: MD3, surf: MD3Surface, skin: MD3Shader):
-    mat = bpy.data.materials.new(skin.name)
+    mat = tag(bpy.data.materials.new(skin.name), skin.key)
     mat.blend_method = 'OPAQUE'
     mat.diffuse_color = (1, 1, 1, 1)
     mat.metallic = 1
@@ -89,14 +88,15 @@ def setup_main_material(mdl: MD3, surf: MD3Surface, skin: MD3Shader):
 def setup_skins(mdl: MD3, surf: MD3Surface, uvs):
     load_skins(mdl, surf)
     uvloop = surf.mesh.uv_layers.new(name = surf.name)
-    for i in range(len(surf.mesh.polygons)):
-        poly = surf.mesh.polygons[i]
-        mdl_uv = uvs[i]
-        for j,k in enumerate(poly.loop_indices):
-            uvloop.data[k].uv = mdl_uv[j]
+    # from_pydata creates the loops in face order
+    uvloop.data.foreach_set("uv", uvs.ravel())
 
     #Load all skins
     for i, skin in enumerate(surf.shaders):
+        mat = mdl.cache and find(bpy.data.materials, skin.key)
+        if mat:
+            surf.mesh.materials.append(mat)
+            continue
         mat = setup_main_material(mdl, surf, skin)
 
         # TODO: turn transform to True and position it properly in editor
@@ -122,10 +122,7 @@ def make_shape_key(mdl: MD3, surf: MD3Surface, framenum):
     surf.framekeys.append(surf.obj.shape_key_add(name=frame.name))
     surf.framekeys[framenum].value = 0.0
     surf.keys.append(surf.framekeys[framenum])
-    num_verts = len(surf.verts) // len(mdl.frames)
-    for i in range(num_verts):
-        offset = (framenum * num_verts) + i
-        surf.framekeys[framenum].data[i].co = list(map(lambda x: x / MD3Vertex.Scale, surf.verts[offset].xyz))
+    surf.framekeys[framenum].data.foreach_set("co", surf.co[framenum].ravel())
 
 def build_shape_keys(mdl: MD3, surf: MD3Surface):
     surf.framekeys = []
@@ -137,6 +134,7 @@ def build_shape_keys(mdl: MD3, surf: MD3Surface):
     for i, _ in enumerate(mdl.frames):
         make_shape_key(mdl, surf, i)
         bpy.context.scene.frame_end += 1
+        yield ("%s: frames" % surf.name, i + 1, len(mdl.frames))
 
     bpy.context.scene.frame_start = 1
 
@@ -172,37 +170,111 @@ def build_actions(mdl: MD3, surf: MD3Surface):
         track.strips.new(act.name, start_frame, act)
         start_frame += 1
 
-def import_md3(operator, context, filepath):
-    bpy.context.preferences.edit.use_global_undo = False
+def surface_key(key, surfnum):
+    return data_hash(key, str(surfnum))
 
-    for obj in bpy.context.scene.collection.objects:
-        obj.select_set(False)
+def import_cached(context, key):
+    # all or nothing: a partially cached model is imported from scratch
+    meshes = []
+    while True:
+        mesh = find(bpy.data.meshes, surface_key(key, len(meshes)))
+        if not mesh:
+            break
+        meshes.append(mesh)
+    if not meshes or meshes[0].get("qfmd_surfaces") != len(meshes):
+        return False
+    for mesh in meshes:
+        obj = link_mesh(context, mesh.name, mesh)
+        copy_settings(obj, "qfmd3")
+        set_frame_range(context, mesh)
+    return True
 
+def decode_md3(filepath, cached=()):
+    # runs in an import thread: no bpy allowed
     mdl = MD3()
-    if not mdl.read(filepath):
-        operator.report({'ERROR'},
-            "Unrecognized format: %s %d" % (mdl.ident, mdl.version))
-        return {'CANCELLED'}
-
-    for surf in mdl.surfaces:
-        faces, uvs = make_faces(surf)
-        verts = make_verts(mdl, surf, 0)
-        surf.mesh = bpy.data.meshes.new(surf.name)
-        surf.mesh.from_pydata(verts, [], faces)
+    mdl.filepath = filepath
+    mdl.key = None
+    mdl.decoded = False
+    mdl.error = None
+    try:
+        mdl.key = file_hash(filepath)
+        if surface_key(mdl.key, 0) in cached:
+            return mdl
+        if not mdl.read(filepath):
+            mdl.error = "Unrecognized format: %s %d" % (mdl.ident,
+                                                          mdl.version)
+            return mdl
+        for surf in mdl.surfaces:
+            surf.faces, surf.uvs = make_faces(surf)
+            surf.normals = make_normals(mdl, surf, 0)
+            surf.co = surf.verts['xyz'].reshape(len(mdl.frames), -1, 3)
+            surf.co = surf.co / np.float32(MD3Vertex.Scale)
+        mdl.decoded = True
+    except Exception as err:
+        # a damaged file fails on its own, without stopping the rest of a
+        # multi-file import
+        mdl.error = "%s: %s" % (type(err).__name__, err)
+    return mdl
+
+def build_md3(operator, context, mdl: MD3, cache, skin_storage, skin_cache):
+    if not mdl.error and cache and import_cached(context, mdl.key):
+        return True
+    if not mdl.decoded and not mdl.error:
+        # it was cached when the import started, but isn't now
+        mdl = decode_md3(mdl.filepath)
+    if mdl.error:
+        operator.report({'ERROR'}, "%s: %s" % (mdl.filepath, mdl.error))
+        return False
+    mdl.cache = cache
+    mdl.skin_storage = skin_storage
+    mdl.skin_cache = skin_cache
+
+    for i, surf in enumerate(mdl.surfaces):
+        surf.mesh = tag(bpy.data.meshes.new(surf.name),
+                        surface_key(mdl.key, i))
+        surf.mesh["qfmd_surfaces"] = len(mdl.surfaces)
+        surf.mesh.from_pydata(surf.co[0].tolist(), [], surf.faces.tolist())
+        set_custom_normals(surf.mesh, surf.normals)
         surf.obj = bpy.data.objects.new(surf.name, surf.mesh)
 
         bpy.context.scene.collection.objects.link(surf.obj)
         surf.obj.select_set(True)
         bpy.context.view_layer.objects.active = surf.obj
-        setup_skins(mdl, surf, uvs)
+        setup_skins(mdl, surf, surf.uvs)
 
         bpy.context.scene.frame_start = 1
         bpy.context.scene.frame_end = 1
         if len(mdl.frames) > 1:
-            build_shape_keys(mdl, surf)
+            yield from build_shape_keys(mdl, surf)
             build_actions(mdl, surf)
 
-    surf.mesh.update()
+        surf.mesh.update()
+    return True
+
+def import_md3(operator, context, filepath = "", cache = True,
+               skin_storage = 'PACK', skin_cache = "", filepaths = ()):
+    bpy.context.preferences.edit.use_global_undo = False
+
+    for obj in bpy.context.scene.collection.objects:
+        obj.select_set(False)
 
-    bpy.context.preferences.edit.use_global_undo = True
-    return {'FINISHED'}
\ No newline at end of file
+    filepaths = filepaths or [filepath]
+    cached = cached_keys(bpy.data.meshes) if cache else set()
+    decode = lambda path: decode_md3(path, cached)
+    imported = 0
+    try:
+        for i, mdl in enumerate(decoded(filepaths, decode)):
+            yield ("Importing", i, len(filepaths))
+            # a cancelled or failed model is removed entirely; finished
+            # ones stay
+            snapshot = Snapshot()
+            try:
+                if (yield from build_md3(operator, context, mdl, cache,
+                                         skin_storage, skin_cache)):
+                    imported += 1
+            except BaseException:
+                snapshot.rollback()
+                raise
+    finally:
+        bpy.context.preferences.edit.use_global_undo = True
+    return {'FINISHED'} if imported else {'CANCELLED'}
@@ -20,9 +20,13 @@
 # <pep8 compliant>
 
 from struct import unpack, pack
+import numpy as np
 from mathutils import Vector
 
+from ..safewrite import SafeWrite
+
 MaxPath = 64
+MaxSurfaces = 32
 
 class MD3Frame:
     MaxFrameName = 16
@@ -81,6 +85,7 @@ class MD3Shader:
 
 class MD3Triangle:
     Size = 4 * 3
+    dtype = np.dtype([('v', '<i4', 3)])
 
     def __init__(self, v=None):
         self.v = ( 0, 0, 0 ) if not v else v
@@ -92,6 +97,7 @@ class MD3Triangle:
 
 class MD3TexCoord:
     Size = 4 * 2
+    dtype = np.dtype([('st', '<f4', 2)])
 
     def __init__(self, st=None):
         self.st = ( 0, 0 ) if not st else st
@@ -104,6 +110,7 @@ class MD3TexCoord:
 class MD3Vertex:
     Size = 2 * 4
     Scale = 64.0
+    dtype = np.dtype([('xyz', '<i2', 3), ('normal', '<u2')])
 
     def __init__(self, xyz=None, normal=0):
         self.xyz = (0, 0, 0) if not xyz else xyz
@@ -127,9 +134,9 @@ class MD3Surface:
         self.texcoords = []
         self.verts = []
     def read(self, mdl):
+        start = mdl.file.tell()
         ident = mdl.read_string(4)
         if ident != "IDP3":
-            self.file.close()
             return None
         self.name = mdl.read_path(MaxPath)
         self.flags = mdl.read_int()
@@ -145,14 +152,17 @@ class MD3Surface:
         ofs_xyznormal = mdl.read_int()
         ofs_eof = mdl.read_int()
 
-        for _ in range(num_triangles):
-            self.triangles.append(MD3Triangle().read(mdl))
+        # the offsets are relative to the start of the surface
+        mdl.file.seek(start + ofs_triangles)
+        self.triangles = mdl.read_array(MD3Triangle.dtype, num_triangles)
+        mdl.file.seek(start + ofs_shaders)
         for _ in range(num_shaders):
             self.shaders.append(MD3Shader().read(mdl))
-        for _ in range(num_verts):
-            self.texcoords.append(MD3TexCoord().read(mdl))
-        for _ in range(num_verts * num_frames):
-            self.verts.append(MD3Vertex().read(mdl))
+        mdl.file.seek(start + ofs_st)
+        self.texcoords = mdl.read_array(MD3TexCoord.dtype, num_verts)
+        mdl.file.seek(start + ofs_xyznormal)
+        self.verts = mdl.read_array(MD3Vertex.dtype, num_verts * num_frames)
+        mdl.file.seek(start + ofs_eof)
         return self
     def write(self, mdl):
         mdl.write_string(mdl.ident, 4)
@@ -176,19 +186,16 @@ class MD3Surface:
         mdl.write_int(ofs_xyznormal)
         mdl.write_int(ofs_eof)
 
-        for tri in self.triangles:
-            tri.write(mdl)
+        mdl.write_array(np.asarray(self.triangles, MD3Triangle.dtype))
         for shader in self.shaders:
             shader.write(mdl)
-        for tc in self.texcoords:
-            tc.write(mdl)
-        for v in self.verts:
-            v.write(mdl)
+        mdl.write_array(np.asarray(self.texcoords, MD3TexCoord.dtype))
+        mdl.write_array(self.verts)
 
     def calculate_size(self):
         return MD3Surface.BaseSize + (MD3Shader.Size * len(self.shaders)) + (MD3Triangle.Size * len(self.triangles)) + (MD3TexCoord.Size * len(self.texcoords)) + (MD3Vertex.Size * len(self.verts))
 
-class MD3:
+class MD3(SafeWrite):
     def read_byte(self, count=1):
         size = 1 * count
         data = self.file.read(size)
@@ -232,6 +239,10 @@ class MD3:
     def read_bytes(self, size):
         return self.file.read(size)
 
+    def read_array(self, dtype, count):
+        data = self.file.read(dtype.itemsize * count)
+        return np.frombuffer(data, dtype=dtype, count=count)
+
     def read_string(self, size):
         data = self.file.read(size)
         s = ""
@@ -264,6 +275,9 @@ class MD3:
             data = (data,)
         self.file.write(pack(("<%df" % len(data)), *data))
 
+    def write_array(self, data):
+        self.file.write(np.ascontiguousarray(data).tobytes())
+
     def write_bytes(self, data, size=-1):
         if size == -1:
             size = len(data)
@@ -339,32 +353,35 @@ class MD3:
         return self
     
     def write(self, filepath):
-        self.file = open(filepath, "wb")
-        self.write_string(self.ident, 4)
-        self.write_int(self.version)
-        self.write_path(self.name, MaxPath)
-        self.write_int(self.flags)
-
-        self.write_int(len(self.frames))
-        self.write_int(len(self.tags))
-        self.write_int(len(self.surfaces))
-        self.write_int(0)
-
-        ofs_frames = self.file.tell() + (4 * 4)
-        ofs_tags = ofs_frames + (MD3Frame.Size * len(self.frames))
-        ofs_surfaces = ofs_tags + (MD3Tag.Size * len(self.tags))
-        ofs_eof = ofs_surfaces + self.calculate_surface_size()
-
-        self.write_int(ofs_frames)
-        self.write_int(ofs_tags)
-        self.write_int(ofs_surfaces)
-        self.write_int(ofs_eof)
-
-        for frame in self.frames:
-            frame.write(self)
-        for tag in self.tags:
-            tag.write(self)
-        for surf in self.surfaces:
-            surf.write(self)
-
-        self.file.close()
\ No newline at end of file
+        self.begin_write(filepath)
+        try:
+            self.write_string(self.ident, 4)
+            self.write_int(self.version)
+            self.write_path(self.name, MaxPath)
+            self.write_int(self.flags)
+
+            self.write_int(len(self.frames))
+            self.write_int(len(self.tags))
+            self.write_int(len(self.surfaces))
+            self.write_int(0)
+
+            ofs_frames = self.file.tell() + (4 * 4)
+            ofs_tags = ofs_frames + (MD3Frame.Size * len(self.frames))
+            ofs_surfaces = ofs_tags + (MD3Tag.Size * len(self.tags))
+            ofs_eof = ofs_surfaces + self.calculate_surface_size()
+
+            self.write_int(ofs_frames)
+            self.write_int(ofs_tags)
+            self.write_int(ofs_surfaces)
+            self.write_int(ofs_eof)
+
+            for frame in self.frames:
+                frame.write(self)
+            for tag in self.tags:
+                tag.write(self)
+            for surf in self.surfaces:
+                surf.write(self)
+        except BaseException:
+            self.end_write(False)
+            raise
+        self.end_write()
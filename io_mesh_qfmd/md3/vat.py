@@ -0,0 +1,67 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Vertex animation textures: one texel per vertex (columns) per frame
+# (rows), written as DX10 DDS files so engines can load them as is.
+# Positions are stored normalized to the animation's bounds, normals as
+# n * 0.5 + 0.5.
+
+import os
+from struct import pack
+import numpy as np
+
+DDS_MAGIC = b"DDS "
+DDSD_FLAGS = 0x100f         # CAPS | HEIGHT | WIDTH | PITCH | PIXELFORMAT
+DDPF_FOURCC = 0x4
+DDSCAPS_TEXTURE = 0x1000
+D3D10_RESOURCE_DIMENSION_TEXTURE2D = 3
+
+FORMATS = {
+    # name: (DXGI format, bytes per texel)
+    'RGBA16F': (10, 8),     # DXGI_FORMAT_R16G16B16A16_FLOAT
+    'RGB10A2': (24, 4),     # DXGI_FORMAT_R10G10B10A2_UNORM
+}
+MaxWidth = 16384            # widest texture d3d11 class hardware takes
+
+def pack_texels(data, fmt):
+    # data: (rows, columns, 3) in [0, 1]
+    data = np.clip(data, 0, 1)
+    if fmt == 'RGBA16F':
+        texels = np.ones(data.shape[:2] + (4,), dtype='<f2')
+        texels[..., :3] = data
+        return texels
+    q = (data * 1023 + 0.5).astype(np.uint32)
+    return (q[..., 0] | (q[..., 1] << 10) | (q[..., 2] << 20)
+            | np.uint32(3 << 30)).astype('<u4')
+
+def write_dds(filepath, texels, fmt):
+    dxgi, size = FORMATS[fmt]
+    height, width = texels.shape[:2]
+    header = pack("<4s7I44x", DDS_MAGIC, 124, DDSD_FLAGS, height, width,
+                  width * size, 0, 0)
+    pixelformat = pack("<2I4s5I", 32, DDPF_FOURCC, b"DX10", 0, 0, 0, 0, 0)
+    caps = pack("<5I", DDSCAPS_TEXTURE, 0, 0, 0, 0)
+    dx10 = pack("<5I", dxgi, D3D10_RESOURCE_DIMENSION_TEXTURE2D, 0, 1, 0)
+    # written under another name and renamed into place, like the models
+    with open(filepath + ".tmp", "wb") as f:
+        f.write(header + pixelformat + caps + dx10)
+        f.write(np.ascontiguousarray(texels).tobytes())
+    os.replace(filepath + ".tmp", filepath)
@@ -19,14 +19,20 @@
 
 # <pep8 compliant>
 
+import tempfile
+
 import bpy
 from bpy_extras.object_utils import object_data_add
 from mathutils import Vector,Matrix
+import numpy as np
 
 from .qfplist import pldata, PListError
 from .quakepal import quakepal
 from .hexen2pal import hexen2pal
-from ..quakenorm import map_normal
+from ..quakenorm import encode_anorms
+from ..capture import make_sweep, mesh_loops, tri_materials, texels
+from ..exportcache import pixels_key, load_skin, store_skin
+from ..atlas import Atlas, image_pixels
 from .mdl import MDL
 from ..__init__ import SYNCTYPE, EFFECTS
 
@@ -51,46 +57,48 @@ def check_faces(mesh):
     mesh.update()
     return True
 
-def convert_image(image, palette):
+def convert_pixels(pixels, palette):
+    # pixels: (height, width, 4) as blender stores them
     if(palette == 0):
         pal = quakepal
     else:
         pal = hexen2pal
-    size = image.size
+    pal = np.array(pal[:256], dtype=np.int64)
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    rgb = pixels[::-1, :, :3].reshape(-1, 3).astype(np.float64) # ignore alpha
+    rgb = (rgb * 255 + 0.5).astype(np.int64)
+    colors, inverse = np.unique(rgb, axis=0, return_inverse=True)
+    index = np.empty(len(colors), dtype=np.uint8)
+    for i in range(0, len(colors), 4096):
+        c = colors[i:i + 4096]
+        dist = ((c[:, None, :] - pal[None, :, :]) ** 2).sum(axis=2)
+        index[i:i + 4096] = dist.argmin(axis=1)  # first of equals
+    return bytearray(index[inverse.ravel()].tobytes())
+
+def convert_skin(pixels, palette, use_cache=False):
     skin = MDL.Skin()
     skin.type = 0
-    skin.pixels = bytearray(size[0] * size[1]) # preallocate
-    cache = {}
-    pixels = image.pixels[:]
-    for y in range(size[1]):
-        for x in range(size[0]):
-            outind = y * size[0] + x
-            # quake textures are top to bottom, but blender images
-            # are bottom to top
-            inind = ((size[1] - 1 - y) * size[0] + x) * 4
-            rgb = pixels[inind : inind + 3] # ignore alpha
-            rgb = tuple(map(lambda x: int(x * 255 + 0.5), rgb))
-            if rgb not in cache:
-                best = (3*256*256, -1)
-                for i, p in enumerate(pal):
-                    if i > 255:     # should never happen
-                        break
-                    r = 0
-                    for x in map(lambda a, b: (a - b) ** 2, rgb, p):
-                        r += x
-                    if r < best[0]:
-                        best = (r, i)
-                cache[rgb] = best[1]
-            skin.pixels[outind] = cache[rgb]
+    # the result is cached under the hash of the pixels
+    key = use_cache and pixels_key(pixels, palette)
+    skin.pixels = key and load_skin(key)
+    if skin.pixels and len(skin.pixels) == pixels.shape[0] * pixels.shape[1]:
+        return skin
+    skin.pixels = convert_pixels(pixels, palette)
+    if key:
+        store_skin(key, skin.pixels)
     return skin
 
+def convert_image(image, palette, use_cache=False):
+    return convert_skin(image_pixels(image), palette, use_cache)
+
 def null_skin(size):
     skin = MDL.Skin()
     skin.type = 0
     skin.pixels = bytearray(size[0] * size[1]) # black skin
     return skin
 
-def make_skin(operator, mdl, mesh):
+def make_skin(operator, mdl, mesh, use_cache=False):
     mdl.skinwidth, mdl.skinheight = (4, 4)
     skin = null_skin((mdl.skinwidth, mdl.skinheight))
 
@@ -110,7 +118,7 @@ def make_skin(operator, mdl, mesh):
                     if node.type == "TEX_IMAGE":
                         image = node.image
                         mdl.skinwidth, mdl.skinheight = image.size
-                        skin = convert_image(image,mdl.palette)
+                        skin = convert_image(image, mdl.palette, use_cache)
                         skingroup.skins.append(skin)
                         skingroup.times.append(0.1)                 # hardcoded at the moment
                 mdl.skins.append(skingroup)
@@ -119,14 +127,14 @@ def make_skin(operator, mdl, mesh):
                     if node.type == "TEX_IMAGE":
                         image = node.image
                         mdl.skinwidth, mdl.skinheight = image.size
-                        skin = convert_image(image,mdl.palette)
+                        skin = convert_image(image, mdl.palette, use_cache)
                         mdl.skins.append(skin)
             else:
                 mdl.skins.append(skin)                              # add empty skin - no texture nodes
     else:
         mdl.skins.append(skin)                                      # add empty skin - no materials
 
-def build_tris(meshes):
+def build_tris(mdl, meshes, atlas=None):
     # mdl files have a 1:1 relationship between stverts and 3d verts.
     # a bit sucky, but it does allow faces to take less memory
     #
@@ -136,87 +144,111 @@ def build_tris(meshes):
     # the layout. However, there seems to be nothing in the mdl format
     # preventing the use of duplicate 3d vertices to allow complete freedom
     # of the UV layout.
+    #
+    # UVs are welded on the texel they land on, so seams whose UVs differ
+    # only by float noise don't duplicate vertices.
 
-    stverts = []
     tris = []
+    stverts = []
     vertmap = list()    # map mdl vert num to blender vert num (for 3d verts)
-    vuvdict = {}
-
-    for m in range(len(meshes)):
-        uvfaces = meshes[m].uv_layers.active.data
-        vertmap.append([])
-        for face in meshes[m].polygons:
-            fv = list(face.vertices)
-            uv = uvfaces[face.loop_start:face.loop_start + face.loop_total]
-            uv = list(map(lambda a: a.uv, uv))
-            face_tris = []
-            for i in range(1, len(fv) - 1):
-                # blender's and quake's vertex order are opposed
-                face_tris.append([(fv[0], tuple(uv[0])),
-                                  (fv[i + 1], tuple(uv[i + 1])),
-                                  (fv[i], tuple(uv[i]))])
-            for ft in face_tris:
-                tv = []
-                for vuv in ft:
-                    if vuv not in vuvdict:
-                        vuvdict[vuv] = len(stverts)
-                        vertmap[m].append(vuv[0])
-                        stverts.append(vuv[1])
-                    tv.append(vuvdict[vuv])
-                tris.append(MDL.Tri(tv))
-    return tris, stverts, vertmap
-
-def convert_stverts(mdl, stverts):
-    for i, st in enumerate(stverts):
-        s, t = st
-        # quake textures are top to bottom, but blender images
-        # are bottom to top
-        s = int(s * (mdl.skinwidth - 1) + 0.5)
-        t = int((1 - t) * (mdl.skinheight - 1) + 0.5)
-        # ensure st is within the skin
-        s = ((s % mdl.skinwidth) + mdl.skinwidth) % mdl.skinwidth
-        t = ((t % mdl.skinheight) + mdl.skinheight) % mdl.skinheight
-        stverts[i] = MDL.STVert((s, t))
-
-def make_frame(frame, mesh, vertmap):
-    #frame = MDL.Frame()
-    #frame.name = "frame" + str(idx)
-
-    #if bpy.context.object.data.shape_keys:
-    #    shape_keys_amount = len(bpy.context.object.data.shape_keys.key_blocks)
-    #    if shape_keys_amount > idx:
-    #        frame.name = bpy.context.object.data.shape_keys.key_blocks[idx].name
-
-    for v in vertmap:
-        mv = mesh.vertices[v]
-        vert = MDL.Vert(tuple(mv.co), map_normal(mv.normal))
-        frame.add_vert(vert)
-    return frame
-
-def scale_verts(mdl):
-    tf = MDL.Frame()
-    for f in mdl.frames:
-        tf.add_frame(f, 0.0)    # let the frame class do the dirty work for us
-    size = Vector(tf.maxs) - Vector(tf.mins)
-    rsqr = tuple(map(lambda a, b: max(abs(a), abs(b)) ** 2, tf.mins, tf.maxs))
-    mdl.boundingradius = (rsqr[0] + rsqr[1] + rsqr[2]) ** 0.5
-    mdl.scale_origin = tf.mins
-    mdl.scale = tuple(map(lambda x: x / 255.0, size))
-    for f in mdl.frames:
-        f.scale(mdl)
-
-def calc_average_area(mdl):
-    frame = mdl.frames[0]
-    if frame.type:
-        frame = frame.frames[0]
-    totalarea = 0.0
-    for tri in mdl.tris:
-        verts = tuple(map(lambda i: frame.verts[i], tri.verts))
-        a = Vector(verts[0].r) - Vector(verts[1].r)
-        b = Vector(verts[2].r) - Vector(verts[1].r)
-        c = a.cross(b)
-        totalarea += (c @ c) ** 0.5 / 2.0
-    return totalarea / len(mdl.tris)
+    numverts = 0
+
+    for m, mesh in enumerate(meshes):
+        loops, verts, uv = mesh_loops(mesh)
+        uv = uv[loops]
+        if atlas:
+            uv = atlas.remap(m, uv, tri_materials(mesh).repeat(3))
+        s, t = texels(mdl, uv, rounded=True)
+        v = verts[loops]
+        # one mdl vertex per (blender vertex, texel), numbered in order of
+        # first use
+        keys = (v * mdl.skinheight + t) * mdl.skinwidth + s
+        _, first, inverse = np.unique(keys, return_index=True,
+                                      return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        first = first[order]
+        tris.append(rank[inverse.ravel()].reshape(-1, 3) + numverts)
+        vertmap.append(v[first])
+        stverts.append(np.stack((s[first], t[first]), axis=1))
+        numverts += len(first)
+
+    tris = np.concatenate(tris) if tris else np.empty((0, 3), np.int64)
+    stverts = np.concatenate(stverts) if stverts else np.empty((0, 2))
+    mdl_tris = np.zeros(len(tris), dtype=MDL.Tri.dtype)
+    mdl_tris['facesfront'] = 1
+    mdl_tris['verts'] = tris
+    mdl_stverts = np.zeros(len(stverts), dtype=MDL.STVert.dtype)
+    mdl_stverts['s'] = stverts[:, 0]
+    mdl_stverts['t'] = stverts[:, 1]
+    return mdl_tris, mdl_stverts, vertmap
+
+def merge_onseam(mdl, vertmap):
+    # modelgen style half skins: a vertex on the seam between the front and
+    # back halves is stored once, flagged onseam, and quake adds half the
+    # skin width to its s on triangles that don't face front. Where a
+    # blender vertex got two mdl vertices exactly half a skin apart, the
+    # shifted one is merged into the other as long as no triangle would
+    # need both. Returns the new vertmap and the number of vertices saved.
+    half = mdl.skinwidth // 2
+    if not half or mdl.skinwidth % 2:
+        return vertmap, 0
+    st = mdl.stverts
+    m = np.repeat(np.arange(len(vertmap)), [len(vm) for vm in vertmap])
+    v = np.concatenate(vertmap)
+    vid = m * (v.max(initial=0) + 1) + v
+    keys = (vid * mdl.skinheight + st['t']) * mdl.skinwidth + st['s']
+    order = np.argsort(keys)
+    # shifted[i]: the vertex the shifted vertex i merges into, or -1
+    pos = np.minimum(np.searchsorted(keys[order], keys - half),
+                     len(keys) - 1)
+    found = (st['s'] >= half) & (keys[order][pos] == keys - half)
+    shifted = np.where(found, order[pos], -1)
+    tris = mdl.tris['verts'].astype(np.int64)
+    while True:
+        base = np.zeros(len(keys), dtype=bool)
+        base[shifted[shifted >= 0]] = True
+        conflict = ((shifted[tris] >= 0).any(axis=1)
+                    & base[tris].any(axis=1))
+        if not conflict.any():
+            break
+        bad = np.unique(tris[conflict])
+        shifted[bad] = -1
+        shifted[np.isin(shifted, bad)] = -1
+
+    back = (shifted[tris] >= 0).any(axis=1)
+    keep = shifted < 0
+    remap = (np.cumsum(keep) - 1)[np.where(keep, np.arange(len(keys)),
+                                           shifted)]
+    mdl.tris['verts'] = remap[tris]
+    mdl.tris['facesfront'][back] = 0
+    st['onseam'][shifted[shifted >= 0]] = MDL.ALIAS_ONSEAM
+    mdl.stverts = st[keep]
+    offsets = np.cumsum([0] + [len(vm) for vm in vertmap])
+    vertmap = [vm[keep[offsets[m]:offsets[m + 1]]]
+               for m, vm in enumerate(vertmap)]
+    return vertmap, int(len(keep) - keep.sum())
+
+def make_frame(co, ni, mco, mno, vertmap):
+    # co and ni are this object's slice of the frame's vertex arrays
+    np.take(mco, vertmap, axis=0, out=co)
+    ni[:] = encode_anorms(np.take(mno, vertmap, axis=0))
+
+def scale_verts(mdl, mins, maxs):
+    # mins and maxs bound every frame; the bounds include the origin
+    mins = np.minimum(mins, 0).astype(np.float64)
+    maxs = np.maximum(maxs, 0).astype(np.float64)
+    rsqr = np.maximum(abs(mins), abs(maxs)) ** 2
+    mdl.boundingradius = float(rsqr.sum() ** 0.5)
+    mdl.scale_origin = tuple(map(float, mins))
+    mdl.scale = tuple(map(float, (maxs - mins) / 255.0))
+
+def calc_average_area(mdl, co):
+    # co is the first frame's (verts, 3)
+    v = co[mdl.tris['verts']].astype(np.float64)
+    c = np.cross(v[:, 0] - v[:, 1], v[:, 2] - v[:, 1])
+    return float(np.linalg.norm(c, axis=1).sum() / 2.0) / len(mdl.tris)
 
 def get_properties(
             operator,
@@ -343,59 +375,111 @@ def export_mdl(
     rotate = False,
     effects = EFFECTS[1],
     xform = True,
-    md16 = False
+    md16 = False,
+    workers = 0,
+    use_cache = False,
+    onseam = False,
+    use_atlas = False,
+    objects = None,
+    sweep = None
     ):
 
     print("Start MDL Export...\n")
 
+    if objects is None:
+        objects = context.selected_objects
     meshes = []
-    objects = context.selected_objects
-    for i in range(len(objects)):
-        print("Object name: " + str(objects[i].name))
-        bpy.ops.object.select_all(action='DESELECT')
-        objects[i].select_set(True)
-        context.view_layer.objects.active = objects[i]
-        objects[i].update_from_editmode()
-        depsgraph = context.evaluated_depsgraph_get()
-        ob_eval = objects[i].evaluated_get(depsgraph)
-        mesh = ob_eval.to_mesh()
-        meshes.append(mesh)
-        if i == 0:
-            mdl = MDL(objects[0].name)
-            mdl.obj = objects[0]
-            if not mdl.skins:
-                make_skin(operator, mdl, mesh)
-        if not get_properties(
-                operator,
-                mdl,
-                palette,
-                eyeposition,
-                synctype,
-                rotate,
-                effects,
-                xform,
-                md16):
-                    return {'CANCELLED'}
-    mdl.tris, mdl.stverts, vertmap = build_tris(meshes)
-
-    if not mdl.frames:
-        for fno in range(context.scene.frame_start, context.scene.frame_end + 1):
-            context.scene.frame_set(fno)
+    evaluated = []
+    try:
+        for i in range(len(objects)):
+            yield ("Preparing", i, len(objects))
+            print("Object name: " + str(objects[i].name))
+            bpy.ops.object.select_all(action='DESELECT')
+            objects[i].select_set(True)
+            context.view_layer.objects.active = objects[i]
+            objects[i].update_from_editmode()
+            depsgraph = context.evaluated_depsgraph_get()
+            ob_eval = objects[i].evaluated_get(depsgraph)
+            mesh = ob_eval.to_mesh()
+            evaluated.append(ob_eval)
+            meshes.append(mesh)
+            if i == 0:
+                mdl = MDL(objects[0].name)
+                mdl.obj = objects[0]
+                if not mdl.skins and not use_atlas:
+                    make_skin(operator, mdl, mesh, use_cache)
+            if not get_properties(
+                    operator,
+                    mdl,
+                    palette,
+                    eyeposition,
+                    synctype,
+                    rotate,
+                    effects,
+                    xform,
+                    md16):
+                        return {'CANCELLED'}
+        atlas = None
+        if use_atlas:
+            # every material's image packed into one skin
+            atlas = Atlas(objects)
+            if not atlas.fits():
+                operator.report({'WARNING'}, "%dx%d atlas, larger than quake "
+                                "skins may be" % atlas.size)
+            mdl.skinwidth, mdl.skinheight = atlas.size
+            mdl.skins = [convert_skin(atlas.pixels, mdl.palette, use_cache)]
+        mdl.tris, mdl.stverts, vertmap = build_tris(mdl, meshes, atlas)
+    finally:
+        # the meshes are only needed for the triangles and skin
+        for ob_eval in evaluated:
+            ob_eval.to_mesh_clear()
+    del meshes
+    if onseam:
+        vertmap, saved = merge_onseam(mdl, vertmap)
+        operator.report({'INFO'}, "onseam saved %d vertices" % saved)
+    # each object's vertices are a contiguous run of mdl vertices
+    offsets = np.cumsum([0] + [len(vm) for vm in vertmap])
+
+    frames = range(context.scene.frame_start, context.scene.frame_end + 1)
+    matrices = [mdl.obj] * len(objects) if xform else None
+    sweep = yield from make_sweep(operator, context, objects, frames,
+                                  matrices, workers, use_cache, sweep)
+    # The whole animation is needed for the scale before any vertex can be
+    # quantized, so the captured frames are spilled to a temporary file and
+    # only the running bounds are kept. The spill is then read back a frame
+    # at a time while writing.
+    numverts = len(mdl.stverts)
+    record = np.dtype([('co', '<f4', (numverts, 3)), ('ni', 'u1', numverts)])
+    with tempfile.TemporaryFile() as spill:
+        data = np.memmap(spill, dtype=record, mode='w+', shape=len(frames))
+        co, ni = data['co'], data['ni']
+        mins = np.full(3, np.inf)
+        maxs = np.full(3, -np.inf)
+        names = []
+        for f, (fno, verts) in enumerate(sweep):
+            yield ("Frames", f, len(frames))
+            names.append(name_frame(fno))
+            for i, (mco, mno) in enumerate(verts):
+                start, end = offsets[i], offsets[i + 1]
+                make_frame(co[f, start:end], ni[f, start:end], mco, mno,
+                           vertmap[i])
+            mins = np.minimum(mins, co[f].min(axis=0))
+            maxs = np.maximum(maxs, co[f].max(axis=0))
+
+        mdl.size = calc_average_area(mdl, co[0])
+        scale_verts(mdl, mins, maxs)
+        mdl.begin_write(filepath)
+        try:
+            mdl.write_header(len(names))
             frame = MDL.Frame()
-            frame.name = name_frame(fno)
-            for i in range(len(objects)):
-                objects[i].update_from_editmode()
-                depsgraph = context.evaluated_depsgraph_get()
-                ob_eval = objects[i].evaluated_get(depsgraph)
-                mesh = ob_eval.to_mesh()
-                if xform:
-                    mesh.transform(mdl.obj.matrix_world)
-                    mesh.calc_normals_split()
-                frame = make_frame(frame, mesh, vertmap[i])
-            mdl.frames.append(frame)
-
-    convert_stverts(mdl, mdl.stverts)
-    mdl.size = calc_average_area(mdl)
-    scale_verts(mdl)
-    mdl.write(filepath)
+            for f, name in enumerate(names):
+                yield ("Writing", f, len(names))
+                frame.name = name
+                frame.quantize(mdl, co[f], ni[f])
+                frame.write(mdl)
+        except BaseException:
+            mdl.end_write(False)
+            raise
+        mdl.end_write()
+        del co, ni, data
     return {'FINISHED'}
@@ -22,52 +22,53 @@
 import bpy
 from bpy_extras.object_utils import object_data_add
 from mathutils import Vector,Matrix
+import numpy as np
 
+from ..quakenorm import decode_anorms, set_custom_normals
+from ..cache import data_hash, file_hash, tag, find, link_mesh, copy_settings, set_frame_range, new_skin, cached_keys
+from ..batch import decoded
+from ..progress import Snapshot
 from .quakepal import quakepal
 from .hexen2pal import hexen2pal
 from .mdl import MDL
 from .qfplist import pldata
 
-def make_verts(mdl, framenum, subframenum=0):
+def get_frame(mdl, framenum, subframenum=0):
     frame = mdl.frames[framenum]
     if frame.type:
         frame = frame.frames[subframenum]
-    verts = []
-    s = Vector(mdl.scale)
-    o = Vector(mdl.scale_origin)
-    m = Matrix(((s.x,  0,  0,o.x),
-                (  0,s.y,  0,o.y),
-                (  0,  0,s.z,o.z),
-                (  0,  0,  0,  1)))
-    for v in frame.verts:
-        verts.append(m @ Vector(v.r))
-    return verts
+    return frame
+
+def frame_verts(mdl, frame):
+    s = np.array(mdl.scale, dtype=np.float32)
+    o = np.array(mdl.scale_origin, dtype=np.float32)
+    return frame.coords() * s + o
+
+def make_verts(mdl, framenum, subframenum=0):
+    return frame_verts(mdl, get_frame(mdl, framenum, subframenum))
+
+def make_normals(mdl, framenum, subframenum=0):
+    return decode_anorms(get_frame(mdl, framenum, subframenum).verts['ni'])
 
 def make_faces(mdl):
-    faces = []
-    uvs = []
-    for tri in mdl.tris:
-        tv = list(tri.verts)
-        sts = []
-        for v in tri.verts:
-            stv = mdl.stverts[v]
-            s = stv.s
-            t = stv.t
-            if stv.onseam and not tri.facesfront:
-                s += mdl.skinwidth / 2
-            # quake textures are top to bottom, but blender images
-            # are bottom to top
-            sts.append(((s + 0.5) / mdl.skinwidth, 1 - (t + 0.5) / mdl.skinheight))
-        # blender's and quake's vertex order seem to be opposed
-        tv.reverse()
-        sts.reverse()
-        # annoyingly, blender can't have 0 in the final vertex, so rotate the
-        # face vertices and uvs
-        if not tv[2]:
-            tv = [tv[2]] + tv[:2]
-            sts = [sts[2]] + sts[:2]
-        faces.append(tv)
-        uvs.append(sts)
+    verts = mdl.tris['verts']
+    st = mdl.stverts[verts]
+    s = st['s'].astype(np.float32)
+    t = st['t'].astype(np.float32)
+    back = (st['onseam'] != 0) & (mdl.tris['facesfront'] == 0)[:, None]
+    s[back] += mdl.skinwidth / 2
+    # quake textures are top to bottom, but blender images
+    # are bottom to top
+    uvs = np.stack(((s + 0.5) / mdl.skinwidth,
+                    1 - (t + 0.5) / mdl.skinheight), axis=-1)
+    # blender's and quake's vertex order seem to be opposed
+    faces = verts[:, ::-1]
+    uvs = uvs[:, ::-1]
+    # annoyingly, blender can't have 0 in the final vertex, so rotate the
+    # face vertices and uvs
+    rot = faces[:, 2] == 0
+    faces = np.where(rot[:, None], np.roll(faces, 1, axis=1), faces)
+    uvs = np.where(rot[:, None, None], np.roll(uvs, 1, axis=1), uvs)
     return faces, uvs
 
 def load_skins(mdl):
@@ -76,24 +77,17 @@ def load_skins(mdl):
             pal = quakepal
         else:
             pal = hexen2pal
+        skin.key = data_hash(skin.pixels, str(mdl.palette),
+                             "%dx%d" % (mdl.skinwidth, mdl.skinheight))
+        img = mdl.cache and find(bpy.data.images, skin.key)
+        if img:
+            skin.name = img.name
+            mdl.images.append(img)
+            return
         skin.name = name
-        img = bpy.data.images.new(name, mdl.skinwidth, mdl.skinheight)
+        img = new_skin(name, skin.key, mdl.skinwidth, mdl.skinheight,
+                       skin.pixels, pal, mdl.skin_storage, mdl.skin_cache)
         mdl.images.append(img)
-        p = [0.0] * mdl.skinwidth * mdl.skinheight * 4
-        d = skin.pixels
-        for j in range(mdl.skinheight):
-            for k in range(mdl.skinwidth):
-                c = pal[d[j * mdl.skinwidth + k]]
-                # quake textures are top to bottom, but blender images
-                # are bottom to top
-                l = ((mdl.skinheight - 1 - j) * mdl.skinwidth + k) * 4
-                p[l + 0] = c[0] / 255.0
-                p[l + 1] = c[1] / 255.0
-                p[l + 2] = c[2] / 255.0
-                p[l + 3] = 1.0
-        img.pixels[:] = p[:]
-        img.pack()
-        img.use_fake_user = True
 
     mdl.images=[]
     for i, skin in enumerate(mdl.skins):
@@ -103,8 +97,8 @@ def load_skins(mdl):
         else:
             load_skin(skin, "%s_%d" % (mdl.name, i))
 
-def setup_main_material(mdl):
-    mat = bpy.data.materials.new(mdl.name)
+def setup_main_material(mdl, key):
+    mat = tag(bpy.data.materials.new(mdl.name), key)
     mat.blend_method = 'OPAQUE'
     mat.diffuse_color = (1, 1, 1, 1)
     mat.metallic = 1
@@ -120,18 +114,23 @@ def setup_skins(mdl, uvs):
 #    uvloop = mdl.mesh.uv_layers[0]
 #    for i, texpoly in enumerate(uvlay.data):
     uvloop = mdl.mesh.uv_layers.new(name = mdl.name)
-    for i in range(len(mdl.mesh.polygons)):
-        poly = mdl.mesh.polygons[i]
-        mdl_uv = uvs[i]
-#        texpoly.image = img	# TODO: commented out by jazz
-        for j,k in enumerate(poly.loop_indices):
-            uvloop.data[k].uv = mdl_uv[j]
+    # from_pydata creates the loops in face order
+    uvloop.data.foreach_set("uv", uvs.ravel())
 
     #Load all skins
     img_counter = 0
     for i, skin in enumerate(mdl.skins):
         if skin.type:
-            mat = setup_main_material(mdl)
+            key = data_hash(*map(lambda s: s.key, skin.skins))
+        else:
+            key = skin.key
+        mat = mdl.cache and find(bpy.data.materials, key)
+        if mat:
+            img_counter += len(skin.skins) if skin.type else 1
+            mdl.mesh.materials.append(mat)
+            continue
+        if skin.type:
+            mat = setup_main_material(mdl, key)
             emissionNode = mat.node_tree.nodes.new("ShaderNodeEmission")
             shaderOut = mat.node_tree.nodes["Material Output"]
             mat.node_tree.nodes.remove(mat.node_tree.nodes["Principled BSDF"])
@@ -158,7 +157,7 @@ def setup_skins(mdl, uvs):
             mdl.mesh.materials.append(mat)
 
         else:
-            mat = setup_main_material(mdl)
+            mat = setup_main_material(mdl, key)
 
             # TODO: turn transform to True and position it properly in editor
             emissionNode = mat.node_tree.nodes.new("ShaderNodeEmission")
@@ -191,14 +190,7 @@ def make_shape_key(mdl, framenum, subframenum=0):
     frame.key = mdl.obj.shape_key_add(name=name)
     frame.key.value = 0.0
     mdl.keys.append(frame.key)
-    s = Vector(mdl.scale)
-    o = Vector(mdl.scale_origin)
-    m = Matrix(((s.x,  0,  0,o.x),
-                (  0,s.y,  0,o.y),
-                (  0,  0,s.z,o.z),
-                (  0,  0,  0,  1)))
-    for i, v in enumerate(frame.verts):
-        frame.key.data[i].co = m @ Vector(v.r)
+    frame.key.data.foreach_set("co", frame.co.ravel())
 
 def build_shape_keys(mdl):
     mdl.keys = []
@@ -206,15 +198,20 @@ def build_shape_keys(mdl):
     mdl.mesh.shape_keys.name = mdl.name
     mdl.obj.active_shape_key_index = 0
     bpy.context.scene.frame_end = 0
+    count = sum(len(f.frames) if f.type else 1 for f in mdl.frames)
     for i, frame in enumerate(mdl.frames):
         frame = mdl.frames[i]
         if frame.type:
             for j in range(len(frame.frames)):
                 make_shape_key(mdl, i, j)
                 bpy.context.scene.frame_end += 1
+                yield ("%s: frames" % mdl.name, bpy.context.scene.frame_end,
+                       count)
         else:
             make_shape_key(mdl, i)
             bpy.context.scene.frame_end += 1
+            yield ("%s: frames" % mdl.name, bpy.context.scene.frame_end,
+                   count)
 
     bpy.context.scene.frame_start = 1
 
@@ -398,39 +395,106 @@ def set_properties(mdl):
     #mdl.obj.qfmdl.script = mdl.text.name #FIXME really want the text object
     mdl.obj.qfmdl.md16 = (mdl.ident == "MD16")
 
-def import_mdl(operator, context, filepath, palette = 'PAL_QUAKE'):
-    bpy.context.preferences.edit.use_global_undo = False
-
-    for obj in bpy.context.scene.collection.objects:
-        obj.select_set(False)
-
+def import_cached(context, filepath, key):
+    mesh = find(bpy.data.meshes, key)
+    if not mesh:
+        return False
+    name = filepath.split('/')[-1].split('.')[0]
+    obj = link_mesh(context, name, mesh)
+    copy_settings(obj, "qfmdl")
+    set_frame_range(context, mesh)
+    return True
+
+def decode_mdl(filepath, palette, cached=()):
+    # runs in an import thread: no bpy allowed
     mdl = MDL()
-    if not mdl.read(filepath):
-        operator.report({'ERROR'},
-            "Unrecognized format: %s %d" % (mdl.ident, mdl.version))
-        return {'CANCELLED'}
-    faces, uvs = make_faces(mdl)
-    verts = make_verts(mdl, 0)
-    mdl.mesh = bpy.data.meshes.new(mdl.name)
-    mdl.mesh.from_pydata(verts, [], faces)
+    mdl.filepath = filepath
+    mdl.key = None
+    mdl.decoded = False
+    mdl.error = None
+    try:
+        mdl.key = file_hash(filepath, palette)
+        if mdl.key in cached:
+            return mdl
+        if not mdl.read(filepath):
+            mdl.error = "Unrecognized format: %s %d" % (mdl.ident,
+                                                          mdl.version)
+            return mdl
+        mdl.palette = MDL.PALETTE[palette]
+        mdl.faces, mdl.uvs = make_faces(mdl)
+        mdl.verts = make_verts(mdl, 0)
+        mdl.normals = make_normals(mdl, 0)
+        for frame in mdl.frames:
+            for f in frame.frames if frame.type else [frame]:
+                f.co = frame_verts(mdl, f)
+        mdl.decoded = True
+    except Exception as err:
+        # a damaged file fails on its own, without stopping the rest of a
+        # multi-file import
+        mdl.error = "%s: %s" % (type(err).__name__, err)
+    return mdl
+
+def build_mdl(operator, context, mdl, palette, cache, skin_storage,
+              skin_cache):
+    if (not mdl.error and cache
+            and import_cached(context, mdl.filepath, mdl.key)):
+        return True
+    if not mdl.decoded and not mdl.error:
+        # it was cached when the import started, but isn't now
+        mdl = decode_mdl(mdl.filepath, palette)
+    if mdl.error:
+        operator.report({'ERROR'}, "%s: %s" % (mdl.filepath, mdl.error))
+        return False
+    mdl.cache = cache
+    mdl.skin_storage = skin_storage
+    mdl.skin_cache = skin_cache
+    mdl.mesh = tag(bpy.data.meshes.new(mdl.name), mdl.key)
+    mdl.mesh.from_pydata(mdl.verts.tolist(), [], mdl.faces.tolist())
+    set_custom_normals(mdl.mesh, mdl.normals)
     mdl.obj = bpy.data.objects.new(mdl.name, mdl.mesh)
 
     bpy.context.scene.collection.objects.link(mdl.obj)
     mdl.obj.select_set(True)
     bpy.context.view_layer.objects.active = mdl.obj
-    mdl.palette = MDL.PALETTE[palette]
-    setup_skins(mdl, uvs)
+    setup_skins(mdl, mdl.uvs)
 
     bpy.context.scene.frame_start = 1
     bpy.context.scene.frame_end = 1
     if len(mdl.frames) > 1 or mdl.frames[0].type:
-        build_shape_keys(mdl)
+        yield from build_shape_keys(mdl)
         merge_frames(mdl)
         build_actions(mdl)
     write_text(mdl)
     set_properties(mdl)
 
     mdl.mesh.update()
+    return True
+
+def import_mdl(operator, context, filepath = "", palette = 'PAL_QUAKE',
+               cache = True, skin_storage = 'PACK', skin_cache = "",
+               filepaths = ()):
+    bpy.context.preferences.edit.use_global_undo = False
 
-    bpy.context.preferences.edit.use_global_undo = True
-    return {'FINISHED'}
\ No newline at end of file
+    for obj in bpy.context.scene.collection.objects:
+        obj.select_set(False)
+
+    filepaths = filepaths or [filepath]
+    cached = cached_keys(bpy.data.meshes) if cache else set()
+    decode = lambda path: decode_mdl(path, palette, cached)
+    imported = 0
+    try:
+        for i, mdl in enumerate(decoded(filepaths, decode)):
+            yield ("Importing", i, len(filepaths))
+            # a cancelled or failed model is removed entirely; finished
+            # ones stay
+            snapshot = Snapshot()
+            try:
+                if (yield from build_mdl(operator, context, mdl, palette,
+                                         cache, skin_storage, skin_cache)):
+                    imported += 1
+            except BaseException:
+                snapshot.rollback()
+                raise
+    finally:
+        bpy.context.preferences.edit.use_global_undo = True
+    return {'FINISHED'} if imported else {'CANCELLED'}
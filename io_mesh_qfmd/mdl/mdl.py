@@ -20,8 +20,12 @@
 # <pep8 compliant>
 
 from struct import unpack, pack
+import numpy as np
 
-class MDL:
+from ..safewrite import SafeWrite
+
+class MDL(SafeWrite):
+    ALIAS_ONSEAM = 0x20     # stvert flag: shifted half a skin on back faces
     ST_SYNC = 0
     ST_RAND = 1
     SYNCTYPE={'ST_SYNC':ST_SYNC, 'ST_RAND':ST_RAND,
@@ -87,6 +91,7 @@ class MDL:
             self.pixels = mdl.read_bytes(size)
 
     class STVert:
+        dtype = np.dtype([('onseam', '<i4'), ('s', '<i4'), ('t', '<i4')])
         def __init__(self, st=None, onseam=False):
             if not st:
                 st = (0, 0)
@@ -102,6 +107,7 @@ class MDL:
             mdl.write_int((self.s, self.t))
 
     class Tri:
+        dtype = np.dtype([('facesfront', '<i4'), ('verts', '<i4', 3)])
         def __init__(self, verts=None, facesfront=True):
             if not verts:
                 verts = (0, 0, 0)
@@ -122,6 +128,7 @@ class MDL:
             self.mins = [0, 0, 0]
             self.maxs = [0, 0, 0]
             self.verts = []
+            self.verts_low = None
             self.frames = []
             self.times = []
         def info(self):
@@ -137,29 +144,16 @@ class MDL:
             if self.name:
                 info['name'] = self.name
             return info
-        def add_vert(self, vert):
-            self.verts.append(vert)
-            for i, v in enumerate(vert.r):
-                self.mins[i] = min(self.mins[i], v)
-                self.maxs[i] = max(self.maxs[i], v)
         def add_frame(self, frame, time):
+            # frame has been quantized; a group's bounds are those of its
+            # frames
             self.type = 1
             self.frames.append(frame)
             self.times.append(time)
-            for i in range(3):
-                self.mins[i] = min(self.mins[i], frame.mins[i])
-                self.maxs[i] = max(self.maxs[i], frame.maxs[i])
-        def scale(self, mdl):
-            self.mins = tuple(map(lambda x, s, t: int((x - t) / s),
-                                  self.mins, mdl.scale, mdl.scale_origin))
-            self.maxs = tuple(map(lambda x, s, t: int((x - t) / s),
-                                  self.maxs, mdl.scale, mdl.scale_origin))
-            if self.type:
-                for subframe in self.frames:
-                    subframe.scale(mdl)
-            else:
-                for vert in self.verts:
-                    vert.scale(mdl)
+            mins = np.array([f.mins for f in self.frames])
+            maxs = np.array([f.maxs for f in self.frames])
+            self.mins = tuple(map(int, mins.min(axis=0)))
+            self.maxs = tuple(map(int, maxs.max(axis=0)))
         def read(self, mdl, numverts, sub=0):
             if sub:
                 self.type = 0
@@ -208,23 +202,42 @@ class MDL:
             mdl.write_byte(self.mins + (0,))
             mdl.write_byte(self.maxs + (0,))
         def read_verts(self, mdl, num):
-            self.verts = []
-            for i in range(num):
-                self.verts.append(MDL.Vert().read(mdl))
+            self.verts = mdl.read_array(MDL.Vert.dtype, num)
+            self.verts_low = None
             if mdl.ident == 'MD16':
-                for i in range(num):
-                    v = MDL.Vert().read(mdl)
-                    r = tuple(map(lambda a, b: a + b / 256.0,
-                                  self.verts[i].r, v.r))
-                    self.verts[i].r = r
+                self.verts_low = mdl.read_array(MDL.Vert.dtype, num)
+        def coords(self):
+            # vertex positions in (unscaled) mdl units
+            r = self.verts['r'].astype(np.float32)
+            if self.verts_low is not None:
+                r += self.verts_low['r'] / 256.0
+            return r
+        def quantize(self, mdl, co, ni):
+            # only used for writing: co is the (verts, 3) positions in
+            # blender units, ni the normal indices
+            s = np.array(mdl.scale)
+            t = np.array(mdl.scale_origin)
+            s[s == 0] = 1       # flat along that axis
+            r = (co - t) / s
+            self.verts = np.empty(len(co), dtype=MDL.Vert.dtype)
+            self.verts['r'] = r.astype(np.int64) & 255
+            self.verts['ni'] = ni
+            if mdl.ident == 'MD16':
+                self.verts_low = np.empty_like(self.verts)
+                self.verts_low['r'] = (r * 256).astype(np.int64) & 255
+                self.verts_low['ni'] = ni
+            # the frame bounds include the origin
+            mins = (np.minimum(co.min(axis=0), 0) - t) / s
+            maxs = (np.maximum(co.max(axis=0), 0) - t) / s
+            self.mins = tuple(map(int, mins))
+            self.maxs = tuple(map(int, maxs))
         def write_verts(self, mdl):
-            for vert in self.verts:
-                vert.write(mdl, True)
+            mdl.write_array(self.verts)
             if mdl.ident == 'MD16':
-                for vert in self.verts:
-                    vert.write(mdl, False)
+                mdl.write_array(self.verts_low)
 
     class Vert:
+        dtype = np.dtype([('r', 'u1', 3), ('ni', 'u1')])
         def __init__(self, r=None, ni=0):
             if not r:
                 r = (0, 0, 0)
@@ -242,9 +255,6 @@ class MDL:
                 r = tuple(map(lambda a: int(a) & 255, self.r))
             mdl.write_byte(r)
             mdl.write_byte(self.ni)
-        def scale(self, mdl):
-            self.r = tuple(map(lambda x, s, t: (x - t) / s,
-                               self.r, mdl.scale, mdl.scale_origin))
 
     def read_byte(self, count=1):
         size = 1 * count
@@ -273,6 +283,10 @@ class MDL:
     def read_bytes(self, size):
         return self.file.read(size)
 
+    def read_array(self, dtype, count):
+        data = self.file.read(dtype.itemsize * count)
+        return np.frombuffer(data, dtype=dtype, count=count)
+
     def read_string(self, size):
         data = self.file.read(size)
         s = ""
@@ -295,6 +309,9 @@ class MDL:
             data = (data,)
         self.file.write(pack(("<%df" % len(data)), *data))
 
+    def write_array(self, data):
+        self.file.write(np.ascontiguousarray(data).tobytes())
+
     def write_bytes(self, data, size=-1):
         if size == -1:
             size = len(data)
@@ -348,21 +365,18 @@ class MDL:
         for i in range(numskins):
             self.skins.append(MDL.Skin().read(self))
         #read in the st verts (uv map)
-        self.stverts = []
-        for i in range(numverts):
-            self.stverts.append(MDL.STVert().read(self))
+        self.stverts = self.read_array(MDL.STVert.dtype, numverts)
         #read in the tris
-        self.tris = []
-        for i in range(numtris):
-            self.tris.append(MDL.Tri().read(self))
+        self.tris = self.read_array(MDL.Tri.dtype, numtris)
         #read in the frames
         self.frames = []
         for i in range(numframes):
             self.frames.append(MDL.Frame().read(self, numverts))
+        self.file.close()
         return self
 
-    def write(self, filepath):
-        self.file = open(filepath, "wb")
+    def write_header(self, numframes):
+        # everything up to the frames, which follow in order
         self.write_string(self.ident, 4)
         self.write_int(self.version)
         self.write_float(self.scale)
@@ -373,7 +387,7 @@ class MDL:
         self.write_int((self.skinwidth, self.skinheight))
         self.write_int(len(self.stverts))
         self.write_int(len(self.tris))
-        self.write_int(len(self.frames))
+        self.write_int(numframes)
         self.write_int(self.synctype)
         if self.version == 6:
             self.write_int(self.flags)
@@ -382,12 +396,18 @@ class MDL:
         for skin in self.skins:
             skin.write(self)
         #write out the st verts (uv map)
-        for stvert in self.stverts:
-            stvert.write(self)
+        self.write_array(self.stverts.astype(MDL.STVert.dtype))
         #write out the tris
-        for tri in self.tris:
-            tri.write(self)
-        #write out the frames
-        for frame in self.frames:
-            frame.write(self)
-        self.file.close()
+        self.write_array(self.tris.astype(MDL.Tri.dtype))
+
+    def write(self, filepath):
+        self.begin_write(filepath)
+        try:
+            self.write_header(len(self.frames))
+            #write out the frames
+            for frame in self.frames:
+                frame.write(self)
+        except BaseException:
+            self.end_write(False)
+            raise
+        self.end_write()
@@ -0,0 +1,289 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Exporting one model to several formats from a single capture.
+#
+# The timeline is swept once, with the usual FrameSweep, CachedSweep or
+# ProcessSweep, and every frame is recorded to a temporary file. Each
+# exporter then replays the recording in place of its own sweep, and
+# quantizes the frames its own way. The recording is captured with every
+# object's own transform (as for md3); a format whose objects take another
+# object's transform (mdl and md2 use the first object's) gets the
+# difference applied on replay, from the world matrices recorded with each
+# frame. Animated transforms are only right in a sweep that steps the
+# scene, so then the frames are captured here, by FrameSweep.
+#
+# Batch export works the same way, with one recording of all the objects
+# replayed once per output model.
+
+import os
+import tempfile
+
+import bpy
+from mathutils import Matrix
+import numpy as np
+
+from .capture import VertexCapture, static_transform, make_sweep
+from .workers import record_dtype
+from .mdl import export_mdl
+from .md2 import export_md2
+from .md3 import export_md3
+
+class RecordedSweep:
+    # matrices: None or the objects themselves, as the world matrix of
+    # every object is recorded with each frame
+    def __init__(self, sweep, objects, matrices=None):
+        self.sweep = sweep
+        self.objects = list(objects)
+        self.matrices = matrices
+        self.fast = sweep.fast
+        self.frames = []
+        self.counts = []
+        self.worlds = []
+        self.file = tempfile.TemporaryFile()
+        self.data = None
+
+    def record(self):
+        # generator: captures every frame, yielding progress
+        total = len(self.sweep.frames)
+        for f, (fno, verts) in enumerate(self.sweep):
+            yield ("Frames", f, total)
+            if not self.frames:
+                self.counts = [len(co) for co, no in verts]
+            for co, no in verts:
+                self.file.write(np.ascontiguousarray(co, '<f4').tobytes())
+                self.file.write(np.ascontiguousarray(no, '<f4').tobytes())
+            self.worlds.append([np.array(obj.matrix_world)
+                                for obj in self.objects])
+            self.frames.append(fno)
+        self.file.flush()
+        self.worlds = np.array(self.worlds).reshape(-1, len(self.objects),
+                                                    4, 4)
+        dtype = record_dtype(self.counts)
+        if self.frames:
+            self.data = np.memmap(self.file, dtype=dtype, mode='r',
+                                  shape=len(self.frames))
+        else:
+            self.data = np.empty(0, dtype=dtype)
+
+    def view(self, matrices=None, objects=None):
+        # the recording of objects (all of them by default) as a sweep with
+        # the given matrix objects, which must be among the recorded ones
+        if objects is None:
+            objects = self.objects
+        indices = [self.objects.index(obj) for obj in objects]
+        corrections = []
+        for i, index in enumerate(indices):
+            want = matrices and self.objects.index(matrices[i])
+            have = self.matrices and index
+            if want == have:
+                corrections.append(None)
+            else:
+                corrections.append((want, have))
+        return Replay(self, indices, corrections)
+
+    def correction(self, f, want, have):
+        # from the recorded object's transform at frame f to want's
+        m = np.identity(4)
+        if have is not None:
+            m = np.linalg.inv(self.worlds[f, have])
+        if want is not None:
+            m = self.worlds[f, want] @ m
+        return Matrix(m.tolist())
+
+    def close(self):
+        self.data = None
+        self.file.close()
+
+class Replay:
+    # iterates like a FrameSweep
+    fast = 0
+
+    def __init__(self, recording, indices, corrections):
+        self.recording = recording
+        self.indices = indices
+        self.corrections = corrections
+        self.captures = [VertexCapture() for c in corrections]
+
+    def __iter__(self):
+        recording = self.recording
+        for f, fno in enumerate(recording.frames):
+            record = recording.data[f]
+            verts = []
+            for i, correction in enumerate(self.corrections):
+                index = self.indices[i]
+                co, no = record["co%d" % index], record["no%d" % index]
+                if correction is not None:
+                    cap = self.captures[i]
+                    bco, bno = cap.buffers(len(co))
+                    bco[:] = co
+                    bno[:] = no
+                    co, no = cap.transform(bco, bno,
+                                           recording.correction(f,
+                                                                *correction))
+                verts.append((co, no))
+            yield fno, verts
+
+def record(operator, context, objects, frames, matrices, workers, use_cache):
+    # generator: one sweep of the timeline for all the objects, returning
+    # the recording
+    if matrices and not all(static_transform(obj) for obj in objects):
+        # the world matrices are recorded with each frame, which takes the
+        # scene stepped to every frame in this blender
+        if workers or use_cache:
+            operator.report({'INFO'}, "Animated object transforms: frames "
+                            "captured without workers or cache")
+        workers, use_cache = 0, False
+    sweep = yield from make_sweep(operator, context, objects, frames,
+                                  matrices, workers, use_cache)
+    recording = RecordedSweep(sweep, objects, matrices)
+    try:
+        yield from recording.record()
+    except BaseException:
+        recording.close()
+        raise
+    return recording
+
+def export_all(
+    operator,
+    context,
+    filepath = "",
+    xform = True,
+    workers = 0,
+    use_cache = False,
+    use_mdl = True,
+    use_md2 = True,
+    use_md3 = True
+    ):
+
+    objects = list(context.selected_objects)
+    active = context.view_layer.objects.active
+    base = os.path.splitext(filepath)[0]
+    frames = range(context.scene.frame_start, context.scene.frame_end + 1)
+    matrices = objects if xform else None
+    recording = yield from record(operator, context, objects, frames,
+                                  matrices, workers, use_cache)
+    options = dict(xform=xform, use_cache=use_cache, objects=objects,
+                   sweep=recording)
+    try:
+        exports = []
+        if use_mdl:
+            exports.append(export_mdl.export_mdl(operator, context,
+                                                 base + ".mdl", **options))
+        if use_md2:
+            exports.append(export_md2.export_md2(operator, context,
+                                                 base + ".md2", **options))
+        if use_md3:
+            exports.append(export_md3.export_md3(operator, context,
+                                                 base + ".md3", **options))
+        for export in exports:
+            result = yield from export
+            if result != {'FINISHED'}:
+                return result
+    finally:
+        recording.close()
+        # the exporters leave only their last object selected
+        for obj in objects:
+            obj.select_set(True)
+        context.view_layer.objects.active = active
+    operator.report({'INFO'}, "%d formats exported from one sweep"
+                    % len(exports))
+    return {'FINISHED'}
+
+def batch_groups(operator, context, batch):
+    # (name, objects) for each model of a batch export: every selected mesh
+    # object on its own, or the selected mesh objects of each child
+    # collection of the active collection together
+    selected = [obj for obj in context.selected_objects if obj.type == 'MESH']
+    if batch == 'OBJECT':
+        return [(obj.name, [obj]) for obj in selected]
+    groups = []
+    parent = context.view_layer.active_layer_collection.collection
+    for coll in parent.children:
+        objects = [obj for obj in selected if obj.name in coll.all_objects]
+        if objects:
+            groups.append((coll.name, objects))
+    grouped = [obj for name, objects in groups for obj in objects]
+    skipped = [obj.name for obj in selected if obj not in grouped]
+    if skipped:
+        operator.report({'WARNING'}, "Not in a child collection of %s, "
+                        "skipped: %s" % (parent.name, ", ".join(skipped)))
+    shared = sorted(set(obj.name for obj in grouped
+                        if grouped.count(obj) > 1))
+    if shared:
+        operator.report({'WARNING'}, "In more than one collection, exported "
+                        "with each: %s" % ", ".join(shared))
+    return groups
+
+def batch_paths(operator, groups, directory, ext):
+    # one file per group; names that clean up to the same file (eg, "a.b"
+    # and "a_b", or differing only in case) get a number instead of
+    # overwriting each other
+    paths = []
+    used = set()
+    for name, group in groups:
+        base = bpy.path.clean_name(name)
+        fname = base
+        n = 0
+        while fname.lower() in used:
+            n += 1
+            fname = "%s_%d" % (base, n)
+        if n:
+            operator.report({'WARNING'}, "%s exported as %s%s"
+                            % (name, fname, ext))
+        used.add(fname.lower())
+        paths.append(os.path.join(directory, fname + ext))
+    return paths
+
+def export_batch(operator, context, export, batch, filepath="", xform=True,
+                 workers=0, use_cache=False, **options):
+    # export (one of the format's export functions, with its options) for
+    # each group from batch_groups, to a file named after the group next to
+    # filepath, all from one sweep of the timeline
+    groups = batch_groups(operator, context, batch)
+    if not groups:
+        operator.report({'ERROR'}, "Nothing to export")
+        return {'CANCELLED'}
+    objects = []
+    for name, group in groups:
+        objects += [obj for obj in group if obj not in objects]
+    active = context.view_layer.objects.active
+    paths = batch_paths(operator, groups, os.path.dirname(filepath),
+                        os.path.splitext(filepath)[1])
+    frames = range(context.scene.frame_start, context.scene.frame_end + 1)
+    matrices = objects if xform else None
+    recording = yield from record(operator, context, objects, frames,
+                                  matrices, workers, use_cache)
+    try:
+        for (name, group), path in zip(groups, paths):
+            result = yield from export(operator, context, path, xform=xform,
+                                       use_cache=use_cache, objects=group,
+                                       sweep=recording, **options)
+            if result != {'FINISHED'}:
+                return result
+    finally:
+        recording.close()
+        for obj in objects:
+            obj.select_set(True)
+        context.view_layer.objects.active = active
+    operator.report({'INFO'}, "%d models exported from one sweep"
+                    % len(groups))
+    return {'FINISHED'}
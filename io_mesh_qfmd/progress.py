@@ -0,0 +1,118 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Progress reporting and cancellation for the import/export operators.
+#
+# The import and export functions are generators: they yield
+# (text, done, total) between units of work (a model, a frame) and return
+# the operator result. ModalJob runs such a generator a slice at a time from
+# a timer, so blender can show the progress and the user can press Esc.
+# Cancelling closes the generator, raising GeneratorExit at the yield where
+# it stopped, and the function cleans up after itself (see Snapshot, and the
+# begin_write/end_write temporary files of the model writers).
+
+import time
+
+import bpy
+
+class ModalJob:
+    job_slice = 0.1     # seconds of work between event handling
+
+    def run_job(self, context, job):
+        self._job = job
+        if bpy.app.background or not context.window:
+            # nobody to show progress to or to press Esc
+            try:
+                while True:
+                    next(job)
+            except StopIteration as ret:
+                return ret.value or {'FINISHED'}
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self._timer = wm.event_timer_add(0.001, window=context.window)
+        self._tick = None
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self._job.close()
+            self.end_job(context)
+            self.report({'WARNING'}, "%s cancelled" % self.bl_label)
+            return {'CANCELLED'}
+        if event.type != 'TIMER' or not self.own_tick():
+            # the job holds on to blender data, so nothing else may run
+            # until it's done
+            return {'RUNNING_MODAL'}
+        end = time.monotonic() + self.job_slice
+        try:
+            while time.monotonic() < end:
+                text, done, total = next(self._job)
+        except StopIteration as ret:
+            self.end_job(context)
+            return ret.value or {'FINISHED'}
+        except Exception as err:
+            self.end_job(context)
+            self.report({'ERROR'}, "%s failed: %s" % (self.bl_label, err))
+            return {'CANCELLED'}
+        context.window_manager.progress_update(100 * done // max(total, 1))
+        context.workspace.status_text_set("%s: %s (%d/%d), Esc to cancel"
+                                          % (self.bl_label, text,
+                                             done, total))
+        return {'RUNNING_MODAL'}
+
+    def own_tick(self):
+        # events don't say whose timer fired, but a timer's duration only
+        # advances when it fires
+        tick = self._timer.time_duration
+        if tick == self._tick:
+            return False
+        self._tick = tick
+        return True
+
+    def cancel(self, context):
+        self._job.close()
+        self.end_job(context)
+
+    def end_job(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+class Snapshot:
+    # Remembers which datablocks exist so that the ones created by a
+    # cancelled import can be removed again.
+    collections = ("objects", "meshes", "materials", "images", "actions",
+                   "texts")
+
+    def __init__(self):
+        self.ids = {}
+        for name in Snapshot.collections:
+            coll = getattr(bpy.data, name)
+            self.ids[name] = set(id.as_pointer() for id in coll)
+
+    def rollback(self):
+        for name in Snapshot.collections:
+            coll = getattr(bpy.data, name)
+            for id in list(coll):
+                if id.as_pointer() not in self.ids[name]:
+                    coll.remove(id)
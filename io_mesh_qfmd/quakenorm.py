@@ -19,6 +19,7 @@
 
 # <pep8 compliant>
 
+import numpy as np
 from mathutils import Vector
 
 # Covert normals to quake's normal palette. Implementation taken from ajmdl
@@ -96,6 +97,193 @@ def map_normal(n):
         quadrant += 1
     return group[best][1][quadrant]
 
+# The 162 MDL/MD2 vertex normals (anorms.h), indexed by Vert.ni
+anorms = np.array((
+    (-0.525731,  0.000000,  0.850651),
+    (-0.442863,  0.238856,  0.864188),
+    (-0.295242,  0.000000,  0.955423),
+    (-0.309017,  0.500000,  0.809017),
+    (-0.162460,  0.262866,  0.951056),
+    ( 0.000000,  0.000000,  1.000000),
+    ( 0.000000,  0.850651,  0.525731),
+    (-0.147621,  0.716567,  0.681718),
+    ( 0.147621,  0.716567,  0.681718),
+    ( 0.000000,  0.525731,  0.850651),
+    ( 0.309017,  0.500000,  0.809017),
+    ( 0.525731,  0.000000,  0.850651),
+    ( 0.295242,  0.000000,  0.955423),
+    ( 0.442863,  0.238856,  0.864188),
+    ( 0.162460,  0.262866,  0.951056),
+    (-0.681718,  0.147621,  0.716567),
+    (-0.809017,  0.309017,  0.500000),
+    (-0.587785,  0.425325,  0.688191),
+    (-0.850651,  0.525731,  0.000000),
+    (-0.864188,  0.442863,  0.238856),
+    (-0.716567,  0.681718,  0.147621),
+    (-0.688191,  0.587785,  0.425325),
+    (-0.500000,  0.809017,  0.309017),
+    (-0.238856,  0.864188,  0.442863),
+    (-0.425325,  0.688191,  0.587785),
+    (-0.716567,  0.681718, -0.147621),
+    (-0.500000,  0.809017, -0.309017),
+    (-0.525731,  0.850651,  0.000000),
+    ( 0.000000,  0.850651, -0.525731),
+    (-0.238856,  0.864188, -0.442863),
+    ( 0.000000,  0.955423, -0.295242),
+    (-0.262866,  0.951056, -0.162460),
+    ( 0.000000,  1.000000,  0.000000),
+    ( 0.000000,  0.955423,  0.295242),
+    (-0.262866,  0.951056,  0.162460),
+    ( 0.238856,  0.864188,  0.442863),
+    ( 0.262866,  0.951056,  0.162460),
+    ( 0.500000,  0.809017,  0.309017),
+    ( 0.238856,  0.864188, -0.442863),
+    ( 0.262866,  0.951056, -0.162460),
+    ( 0.500000,  0.809017, -0.309017),
+    ( 0.850651,  0.525731,  0.000000),
+    ( 0.716567,  0.681718,  0.147621),
+    ( 0.716567,  0.681718, -0.147621),
+    ( 0.525731,  0.850651,  0.000000),
+    ( 0.425325,  0.688191,  0.587785),
+    ( 0.864188,  0.442863,  0.238856),
+    ( 0.688191,  0.587785,  0.425325),
+    ( 0.809017,  0.309017,  0.500000),
+    ( 0.681718,  0.147621,  0.716567),
+    ( 0.587785,  0.425325,  0.688191),
+    ( 0.955423,  0.295242,  0.000000),
+    ( 1.000000,  0.000000,  0.000000),
+    ( 0.951056,  0.162460,  0.262866),
+    ( 0.850651, -0.525731,  0.000000),
+    ( 0.955423, -0.295242,  0.000000),
+    ( 0.864188, -0.442863,  0.238856),
+    ( 0.951056, -0.162460,  0.262866),
+    ( 0.809017, -0.309017,  0.500000),
+    ( 0.681718, -0.147621,  0.716567),
+    ( 0.850651,  0.000000,  0.525731),
+    ( 0.864188,  0.442863, -0.238856),
+    ( 0.809017,  0.309017, -0.500000),
+    ( 0.951056,  0.162460, -0.262866),
+    ( 0.525731,  0.000000, -0.850651),
+    ( 0.681718,  0.147621, -0.716567),
+    ( 0.681718, -0.147621, -0.716567),
+    ( 0.850651,  0.000000, -0.525731),
+    ( 0.809017, -0.309017, -0.500000),
+    ( 0.864188, -0.442863, -0.238856),
+    ( 0.951056, -0.162460, -0.262866),
+    ( 0.147621,  0.716567, -0.681718),
+    ( 0.309017,  0.500000, -0.809017),
+    ( 0.425325,  0.688191, -0.587785),
+    ( 0.442863,  0.238856, -0.864188),
+    ( 0.587785,  0.425325, -0.688191),
+    ( 0.688191,  0.587785, -0.425325),
+    (-0.147621,  0.716567, -0.681718),
+    (-0.309017,  0.500000, -0.809017),
+    ( 0.000000,  0.525731, -0.850651),
+    (-0.525731,  0.000000, -0.850651),
+    (-0.442863,  0.238856, -0.864188),
+    (-0.295242,  0.000000, -0.955423),
+    (-0.162460,  0.262866, -0.951056),
+    ( 0.000000,  0.000000, -1.000000),
+    ( 0.295242,  0.000000, -0.955423),
+    ( 0.162460,  0.262866, -0.951056),
+    (-0.442863, -0.238856, -0.864188),
+    (-0.309017, -0.500000, -0.809017),
+    (-0.162460, -0.262866, -0.951056),
+    ( 0.000000, -0.850651, -0.525731),
+    (-0.147621, -0.716567, -0.681718),
+    ( 0.147621, -0.716567, -0.681718),
+    ( 0.000000, -0.525731, -0.850651),
+    ( 0.309017, -0.500000, -0.809017),
+    ( 0.442863, -0.238856, -0.864188),
+    ( 0.162460, -0.262866, -0.951056),
+    ( 0.238856, -0.864188, -0.442863),
+    ( 0.500000, -0.809017, -0.309017),
+    ( 0.425325, -0.688191, -0.587785),
+    ( 0.716567, -0.681718, -0.147621),
+    ( 0.688191, -0.587785, -0.425325),
+    ( 0.587785, -0.425325, -0.688191),
+    ( 0.000000, -0.955423, -0.295242),
+    ( 0.000000, -1.000000,  0.000000),
+    ( 0.262866, -0.951056, -0.162460),
+    ( 0.000000, -0.850651,  0.525731),
+    ( 0.000000, -0.955423,  0.295242),
+    ( 0.238856, -0.864188,  0.442863),
+    ( 0.262866, -0.951056,  0.162460),
+    ( 0.500000, -0.809017,  0.309017),
+    ( 0.716567, -0.681718,  0.147621),
+    ( 0.525731, -0.850651,  0.000000),
+    (-0.238856, -0.864188, -0.442863),
+    (-0.500000, -0.809017, -0.309017),
+    (-0.262866, -0.951056, -0.162460),
+    (-0.850651, -0.525731,  0.000000),
+    (-0.716567, -0.681718, -0.147621),
+    (-0.716567, -0.681718,  0.147621),
+    (-0.525731, -0.850651,  0.000000),
+    (-0.500000, -0.809017,  0.309017),
+    (-0.238856, -0.864188,  0.442863),
+    (-0.262866, -0.951056,  0.162460),
+    (-0.864188, -0.442863,  0.238856),
+    (-0.809017, -0.309017,  0.500000),
+    (-0.688191, -0.587785,  0.425325),
+    (-0.681718, -0.147621,  0.716567),
+    (-0.442863, -0.238856,  0.864188),
+    (-0.587785, -0.425325,  0.688191),
+    (-0.309017, -0.500000,  0.809017),
+    (-0.147621, -0.716567,  0.681718),
+    (-0.425325, -0.688191,  0.587785),
+    (-0.162460, -0.262866,  0.951056),
+    ( 0.442863, -0.238856,  0.864188),
+    ( 0.162460, -0.262866,  0.951056),
+    ( 0.309017, -0.500000,  0.809017),
+    ( 0.147621, -0.716567,  0.681718),
+    ( 0.000000, -0.525731,  0.850651),
+    ( 0.425325, -0.688191,  0.587785),
+    ( 0.587785, -0.425325,  0.688191),
+    ( 0.688191, -0.587785,  0.425325),
+    (-0.955423,  0.295242,  0.000000),
+    (-0.951056,  0.162460,  0.262866),
+    (-1.000000,  0.000000,  0.000000),
+    (-0.850651,  0.000000,  0.525731),
+    (-0.955423, -0.295242,  0.000000),
+    (-0.951056, -0.162460,  0.262866),
+    (-0.864188,  0.442863, -0.238856),
+    (-0.951056,  0.162460, -0.262866),
+    (-0.809017,  0.309017, -0.500000),
+    (-0.864188, -0.442863, -0.238856),
+    (-0.951056, -0.162460, -0.262866),
+    (-0.809017, -0.309017, -0.500000),
+    (-0.681718,  0.147621, -0.716567),
+    (-0.681718, -0.147621, -0.716567),
+    (-0.850651,  0.000000, -0.525731),
+    (-0.688191,  0.587785, -0.425325),
+    (-0.587785,  0.425325, -0.688191),
+    (-0.425325,  0.688191, -0.587785),
+    (-0.425325, -0.688191, -0.587785),
+    (-0.587785, -0.425325, -0.688191),
+    (-0.688191, -0.587785, -0.425325),
+), dtype=np.float32)
+
+def decode_anorms(ni):
+    # out of range indices (some tools write 255) are clamped to the table
+    return anorms[np.minimum(ni, len(anorms) - 1)]
+
+def encode_anorms(normals):
+    # nearest table entry for each of an array of unit normals: the
+    # vectorized map_normal
+    ni = np.empty(len(normals), dtype=np.uint8)
+    for i in range(0, len(normals), 65536):
+        dots = normals[i:i + 65536] @ anorms.T
+        ni[i:i + 65536] = np.argmax(dots, axis=1)
+    return ni
+
+def set_custom_normals(mesh, normals):
+    # normals are per vertex, but blender wants them per loop
+    loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_verts)
+    if hasattr(mesh, "use_auto_smooth"):
+        mesh.use_auto_smooth = True     # blender < 4.1
+    mesh.normals_split_custom_set(normals[loop_verts])
+
 # Quake III normal stuff
 from math import pi, cos, sin, atan2, acos
 
@@ -107,10 +295,35 @@ def decode_md3_normal(b):
     z = cos(lon)
     return [ x, y, z ]
 
+_md3_angles = np.arange(256) * 2 * pi / 255.0
+_md3_cos = np.cos(_md3_angles).astype(np.float32)
+_md3_sin = np.sin(_md3_angles).astype(np.float32)
+
+def decode_md3_normals(normals):
+    # same as decode_md3_normal, but for a whole array of packed normals
+    lat = (normals >> 8) & 255
+    lon = normals & 255
+    n = np.empty(normals.shape + (3,), dtype=np.float32)
+    n[..., 0] = _md3_cos[lat] * _md3_sin[lon]
+    n[..., 1] = _md3_sin[lat] * _md3_sin[lon]
+    n[..., 2] = _md3_cos[lon]
+    return n
+
 def encode_md3_normal(n):
     x, y, z = n
     if x == 0 and y == 0:
         return 0 if z > 0 else ((128 << 8) | 0)
     lon = int(atan2(y, x) * 255 / (2 * pi)) & 255
     lat = int(acos(z) * 255 / (2 * pi)) & 255
-    return (lon << 8) | lat
\ No newline at end of file
+    return (lon << 8) | lat
+
+def encode_md3_normals(normals):
+    # same as encode_md3_normal, but for a whole array of normals
+    n = normals.astype(np.float64)
+    x, y, z = n[..., 0], n[..., 1], n[..., 2]
+    lon = (np.arctan2(y, x) * 255 / (2 * pi)).astype(np.int64) & 255
+    lat = (np.arccos(np.clip(z, -1, 1)) * 255 / (2 * pi)).astype(np.int64) & 255
+    packed = (lon << 8) | lat
+    pole = (x == 0) & (y == 0)
+    packed[pole] = np.where(z[pole] > 0, 0, 128 << 8)
+    return packed.astype(np.uint16)
@@ -0,0 +1,56 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Writing model files in place of an old version.
+#
+# The model goes to a temporary file that end_write renames into place, so
+# a failed or cancelled export leaves neither a partial file nor a missing
+# one. The format classes (MDL, MD2, MD3) take begin_write and end_write
+# from SafeWrite.
+
+import os
+
+class SafeWrite:
+    companions = ()     # (path, save(path)) written by end_write
+
+    def begin_write(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath + ".tmp", "wb")
+
+    def end_write(self, ok=True):
+        self.file.close()
+        if not ok:
+            os.remove(self.filepath + ".tmp")
+            return
+        # the files that go with the model (see companions) are only
+        # written once the model is complete, and renamed with it
+        try:
+            for path, save in self.companions:
+                save(path + ".tmp")
+        except BaseException:
+            for path, save in self.companions:
+                if os.path.exists(path + ".tmp"):
+                    os.remove(path + ".tmp")
+            os.remove(self.filepath + ".tmp")
+            raise
+        for path, save in self.companions:
+            os.replace(path + ".tmp", path)
+        os.replace(self.filepath + ".tmp", self.filepath)
@@ -0,0 +1,160 @@
+# vim:ts=4:et
+# ##### BEGIN GPL LICENSE BLOCK #####
+#
+#  This program is free software; you can redistribute it and/or
+#  modify it under the terms of the GNU General Public License
+#  as published by the Free Software Foundation; either version 2
+#  of the License, or (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software Foundation,
+#  Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+#
+# ##### END GPL LICENSE BLOCK #####
+
+# <pep8 compliant>
+
+# Frame capture in background blender processes.
+#
+# A copy of the .blend is saved to a temporary directory and the frame range
+# is split into contiguous slices, one per `blender -b` worker. Each worker
+# runs a FrameSweep over its slice and writes the captured positions and
+# normals, as raw float32, to its own file. ProcessSweep then reads the
+# files back in frame order, so the exporters use it just like a FrameSweep
+# and do the bounds, scaling and writing themselves as usual.
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import bpy
+import numpy as np
+
+from .capture import FrameSweep
+from .cache import KeepDeferred
+
+def record_dtype(counts):
+    # one frame: every object's positions, then its normals
+    fields = []
+    for i, n in enumerate(counts):
+        fields.append(("co%d" % i, '<f4', (n, 3)))
+        fields.append(("no%d" % i, '<f4', (n, 3)))
+    return np.dtype(fields)
+
+class ProcessSweep:
+    fast = 0
+
+    def __init__(self, context, objects, frames, matrices=None, workers=2):
+        self.frames = list(frames)
+        self.objects = [obj.name for obj in objects]
+        self.matrices = matrices and [obj.name for obj in matrices]
+        self.scene = context.scene.name
+        depsgraph = context.evaluated_depsgraph_get()
+        self.counts = []
+        for obj in objects:
+            obj.update_from_editmode()
+            ob_eval = obj.evaluated_get(depsgraph)
+            self.counts.append(len(ob_eval.to_mesh().vertices))
+            ob_eval.to_mesh_clear()
+        self.dtype = record_dtype(self.counts)
+        workers = max(1, min(workers, len(self.frames)))
+        self.slices = [s.tolist()
+                       for s in np.array_split(self.frames, workers)]
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="qfmd")
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    def command(self, blend, spec):
+        package = __name__.rpartition(".")[0]
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        expr = ("import sys; sys.path.insert(0, %r); "
+                "from %s import workers; workers.worker_main()"
+                % (root, package))
+        # --factory-startup turns auto-exec off: python drivers have to
+        # evaluate the same way as in this blender, which ran them unless
+        # it blocked them
+        autoexec = "-Y" if bpy.app.autoexec_fail else "-y"
+        return [bpy.app.binary_path, "-b", "--factory-startup", autoexec,
+                "-noaudio", blend, "--python-exit-code", "1",
+                "--python-expr", expr, "--", spec]
+
+    def run(self):
+        # generator: starts the workers and yields progress until they
+        # have all finished
+        blend = self.path("scene.blend")
+        # saving the copy mustn't pack the skins that were deferred for
+        # the real save
+        with KeepDeferred():
+            bpy.ops.wm.save_as_mainfile(filepath=blend, copy=True,
+                                        check_existing=False)
+        procs = []
+        try:
+            for i, frames in enumerate(self.slices):
+                spec = self.path("spec%d.json" % i)
+                with open(spec, "w") as f:
+                    json.dump({"scene": self.scene, "objects": self.objects,
+                               "matrices": self.matrices, "frames": frames,
+                               "output": self.path("frames%d" % i)}, f)
+                log = open(self.path("log%d.txt" % i), "wb")
+                procs.append(subprocess.Popen(self.command(blend, spec),
+                                              stdout=log,
+                                              stderr=subprocess.STDOUT))
+                log.close()
+            while True:
+                done = sum(p.poll() is not None for p in procs)
+                yield ("Capturing in %d processes" % len(procs), done,
+                       len(procs))
+                if done == len(procs):
+                    break
+                time.sleep(0.05)
+            for i, p in enumerate(procs):
+                if p.returncode:
+                    with open(self.path("log%d.txt" % i), "rb") as f:
+                        log = f.read().decode(errors="replace")
+                    raise RuntimeError("frame capture process failed:\n%s"
+                                       % log[-2000:])
+        finally:
+            for p in procs:
+                if p.poll() is None:
+                    p.kill()
+                    p.wait()
+
+    def __iter__(self):
+        try:
+            for i, frames in enumerate(self.slices):
+                data = np.memmap(self.path("frames%d" % i), dtype=self.dtype,
+                                 mode='r', shape=len(frames))
+                for f, fno in enumerate(frames):
+                    record = data[f]
+                    yield fno, [(record["co%d" % j], record["no%d" % j])
+                                for j in range(len(self.counts))]
+                del data
+        finally:
+            self.tmpdir.cleanup()
+
+def worker_main():
+    # runs in the worker: blender -b copy.blend --python-expr ... -- spec
+    with open(sys.argv[sys.argv.index("--") + 1]) as f:
+        spec = json.load(f)
+    context = bpy.context
+    if context.scene.name != spec["scene"]:
+        raise RuntimeError("%s is not the active scene" % spec["scene"])
+    objects = [bpy.data.objects[name] for name in spec["objects"]]
+    matrices = spec["matrices"]
+    if matrices:
+        matrices = [bpy.data.objects[name] for name in matrices]
+    sweep = FrameSweep(context, objects, spec["frames"], matrices)
+    with open(spec["output"], "wb") as out:
+        for fno, verts in sweep:
+            for co, no in verts:
+                out.write(np.ascontiguousarray(co).tobytes())
+                out.write(np.ascontiguousarray(no).tobytes())